@@ -0,0 +1,225 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import importlib
+import importlib.util
+import traceback
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from utils import (get_datasets_dict, get_file_fingerprint, get_comb_dets_path, get_det_store_dir, get_labelled_clips_path,
+                   COSTA_RICA_SITE_INFO_PATH)
+
+# Signatures of each node's last successful run, so later builds know what is up to date
+BUILD_STATE_PATH = 'build_state.json'
+STATS_REPORT_NAME = 'combined_data_stats.txt'
+
+FIG_3_PANELS = ['brazil', 'costa-rica', 'norway', 'taiwan']
+# Panels drawn from the aggregate cubes, rather than straight from the detection store
+AGG_CUBE_PANELS = ['brazil', 'taiwan']
+FIG_3_PANEL_MODULES = {'brazil': 'fig_3_brazil_diurnal', 'costa-rica': 'fig_3_costarica_land_use_activity',
+                       'norway': 'fig_3_norway_species_latitudinal', 'taiwan': 'fig_3_taiwan_seasonal'}
+# Modules every node's results can depend on, whichever module it calls
+SHARED_MODULES = ['utils', 'solar_time']
+
+
+def get_module_path(module_name):
+    return importlib.util.find_spec(module_name).origin
+
+
+def get_build_graph(figs_dir='figs'):
+    # Nodes by name, each with the nodes it depends on, the files it reads and writes, and the (module, function,
+    # args) that builds it. Intermediate results live in the caches of cached_compute, so their nodes just fill
+    # those caches. Each node also depends on the source of the module it calls and of the shared modules
+    import fig_2
+    graph = {}
+
+    for ds in get_datasets_dict():
+        ds_name = ds['short_name']
+        store_meta_path = os.path.join(get_det_store_dir(ds_name), 'meta.json')
+        labelled_path = get_labelled_clips_path(ds_name)
+
+        graph['store:' + ds_name] = {'deps': [], 'inputs': [get_comb_dets_path(ds_name), store_meta_path], 'outputs': [store_meta_path],
+                                     'fn': ('utils', 'update_det_store', [ds_name])}
+        graph['calib:' + ds_name] = {'deps': ['store:' + ds_name], 'inputs': [labelled_path], 'outputs': [],
+                                     'fn': ('utils', 'get_opt_spec_bn_threshs', [ds_name, fig_2.TARGET_PREC])}
+        graph['agg:' + ds_name] = {'deps': ['calib:' + ds_name], 'inputs': [], 'outputs': [],
+                                   'fn': ('utils', 'load_agg_cubes', [ds_name, ds.get('tz')])}
+
+    for panel in FIG_3_PANELS:
+        graph['panel:' + panel] = {'deps': ['calib:' + panel] + (['agg:' + panel] if panel in AGG_CUBE_PANELS else []),
+                                   'inputs': ([COSTA_RICA_SITE_INFO_PATH] if panel == 'costa-rica' else []) + 
+                                             [get_module_path(FIG_3_PANEL_MODULES[panel])], 'outputs': [],
+                                   'fn': ('fig_3', 'load_panel_data', [panel])}
+
+    ds_names = [ds['short_name'] for ds in get_datasets_dict()]
+    graph['fig2'] = {'deps': ['calib:' + d for d in ds_names], 'inputs': [],
+                     'outputs': [os.path.join(figs_dir, 'fig_2.{}'.format(ext)) for ext in ['pdf', 'svg', 'png']],
+                     'fn': ('fig_2', 'make_fig_2', [figs_dir])}
+    graph['fig3'] = {'deps': ['panel:' + p for p in FIG_3_PANELS], 'inputs': [get_module_path(FIG_3_PANEL_MODULES[p]) for p in FIG_3_PANELS],
+                     'outputs': [os.path.join(figs_dir, 'fig_3.{}'.format(ext)) for ext in ['pdf', 'svg', 'png']],
+                     'fn': ('fig_3', 'make_fig_3', [figs_dir])}
+    graph['stats'] = {'deps': ['calib:' + d for d in ds_names], 'inputs': [],
+                      'outputs': [os.path.join(figs_dir, STATS_REPORT_NAME)], 'fn': ('combined_data_stats', 'run_stats', []),
+                      'stdout_path': os.path.join(figs_dir, STATS_REPORT_NAME)}
+
+    for node in graph.values():
+        for module_name in [node['fn'][0]] + SHARED_MODULES:
+            if get_module_path(module_name) not in node['inputs']: node['inputs'] = node['inputs'] + [get_module_path(module_name)]
+
+    return graph
+
+
+def get_build_order(graph, targets=None):
+    # The targets and everything they depend on, each after its dependencies
+    order = []
+    def visit(name, path):
+        if name in order: return
+        if name in path: raise ValueError('Dependency cycle through {}'.format(' -> '.join(path + [name])))
+        for dep in graph[name]['deps']: visit(dep, path + [name])
+        order.append(name)
+
+    for name in (targets or graph.keys()):
+        if name not in graph: raise ValueError('Unknown target {}, should be one of {}'.format(name, list(graph.keys())))
+        visit(name, [])
+
+    return order
+
+
+def get_node_signature(graph, name, dep_signatures):
+    node = graph[name]
+    sig_key = json.dumps([name, node['fn'], [get_file_fingerprint(p) for p in node['inputs']], [dep_signatures[d] for d in node['deps']]],
+                         sort_keys=True, default=str)
+    return hashlib.sha1(sig_key.encode('utf-8')).hexdigest()[:16]
+
+
+def node_is_stale(graph, name, signature, build_state):
+    return build_state.get(name) != signature or not all([os.path.exists(p) for p in graph[name]['outputs']])
+
+
+def read_build_state(state_path=BUILD_STATE_PATH):
+    if not os.path.exists(state_path): return {}
+    with open(state_path, 'r') as f_handle:
+        return json.load(f_handle)
+
+
+def write_build_state(build_state, state_path=BUILD_STATE_PATH):
+    tmp_path = '{}.tmp'.format(state_path)
+    with open(tmp_path, 'w') as f_handle:
+        json.dump(build_state, f_handle, indent=1, sort_keys=True)
+    os.replace(tmp_path, state_path)
+
+
+def run_node_fn(module_name, fn_name, args, stdout_path=None):
+    fn = getattr(importlib.import_module(module_name), fn_name)
+    start_t = time.perf_counter()
+    if stdout_path is None:
+        fn(*args)
+    else:
+        # Output is written next to its destination and only moved there once complete
+        out_dir = os.path.dirname(stdout_path)
+        if out_dir and not os.path.exists(out_dir): os.makedirs(out_dir)
+        with open('{}.tmp'.format(stdout_path), 'w') as f_handle:
+            with redirect_stdout(f_handle):
+                fn(*args)
+        os.replace('{}.tmp'.format(stdout_path), stdout_path)
+
+    return time.perf_counter() - start_t
+
+
+def submit_node(executor, graph, name):
+    module_name, fn_name, args = graph[name]['fn']
+    if executor is not None: return executor.submit(run_node_fn, module_name, fn_name, args, graph[name].get('stdout_path'))
+
+    # Run in this process, as an already finished future
+    fut = Future()
+    try:
+        fut.set_result(run_node_fn(module_name, fn_name, args, graph[name].get('stdout_path')))
+    except Exception as e:
+        e.traceback_str = traceback.format_exc()
+        fut.set_exception(e)
+    return fut
+
+
+def run_build(graph, targets=None, workers=1, force=False, dry_run=False, state_path=BUILD_STATE_PATH):
+    # Runs the stale nodes needed for targets, each as soon as its dependencies are done, over up to workers processes.
+    # A node is stale when its signature (its inputs' fingerprints and its dependencies' signatures) differs from its
+    # last successful run or any of its outputs is missing. Returns the names of nodes that failed
+    order = get_build_order(graph, targets)
+    build_state = read_build_state(state_path)
+
+    if dry_run:
+        signatures = {}
+        will_run = set()
+        for name in order:
+            signatures[name] = get_node_signature(graph, name, signatures)
+            if force or node_is_stale(graph, name, signatures[name], build_state) or any([d in will_run for d in graph[name]['deps']]):
+                will_run.add(name)
+            print('{} {}'.format('would build' if name in will_run else 'up to date ', name))
+        return []
+
+    signatures = {}
+    failed = []
+    running = {}
+    n_built = 0
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        while True:
+            # Start (or skip) every node whose dependencies have all finished, until no more can be
+            n_started = -1
+            while n_started != 0:
+                n_started = 0
+                for name in order:
+                    if name in signatures or name in failed or name in running.values(): continue
+                    if any([d in failed for d in graph[name]['deps']]):
+                        failed.append(name)
+                        print('skipped {} (a dependency failed)'.format(name))
+                        n_started += 1
+                        continue
+                    if not all([d in signatures for d in graph[name]['deps']]): continue
+
+                    sig = get_node_signature(graph, name, signatures)
+                    if not force and not node_is_stale(graph, name, sig, build_state):
+                        signatures[name] = sig
+                    else:
+                        print('building {}'.format(name))
+                        running[submit_node(executor, graph, name)] = name
+                    n_started += 1
+
+            if len(running) == 0: break
+
+            done_futs, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for fut in done_futs:
+                name = running.pop(fut)
+                if fut.exception() is not None:
+                    failed.append(name)
+                    print('FAILED {}: {}'.format(name, getattr(fut.exception(), 'traceback_str', repr(fut.exception()))))
+                    continue
+
+                # Signed again after the run, as a node can update its own inputs (such as the store's meta.json)
+                signatures[name] = get_node_signature(graph, name, signatures)
+                build_state[name] = signatures[name]
+                write_build_state(build_state, state_path)
+                n_built += 1
+                print('built {} ({:.1f}s)'.format(name, fut.result()))
+    finally:
+        if executor is not None: executor.shutdown(cancel_futures=True)
+
+    print('{} built, {} up to date, {} failed'.format(n_built, len(signatures) - n_built, len(failed)))
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild the figures, statistics and intermediate results whose inputs changed')
+    parser.add_argument('targets', nargs='*', help='Nodes to bring up to date, e.g. fig2 or calib:norway (default everything)')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes to run independent nodes over (1 runs serially)')
+    parser.add_argument('--figs-dir', default='figs')
+    parser.add_argument('--force', action='store_true', help='Rebuild every node needed for the targets')
+    parser.add_argument('--dry-run', action='store_true', help='List the nodes that would be built')
+    args = parser.parse_args()
+
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    failed = run_build(get_build_graph(args.figs_dir), args.targets or None, args.workers, args.force, args.dry_run)
+    if len(failed) > 0: sys.exit(1)
@@ -0,0 +1,153 @@
+import time
+CLI_START_T = time.perf_counter()
+
+import os
+import sys
+import argparse
+import subprocess
+
+# Only the standard library is imported up front, each command imports what it needs once it runs. Figures are
+# drawn with a non-interactive backend unless --backend says otherwise
+DEFAULT_BACKEND = 'Agg'
+HEAVY_MODULES = ['pandas', 'matplotlib', 'scipy', 'pytz']
+FIG_3_PANELS = ['brazil', 'costa-rica', 'norway', 'taiwan']
+
+# Seconds from interpreter start until a command is ready to run (checked by the startup command)
+STARTUP_BUDGETS = {'stats': 0.5, 'fig2': 1.5, 'fig3': 1.5}
+QUERY_TOP_SPECS = 20
+STARTUP_REPEATS = 5
+
+
+def run_query(args):
+    # Counts of the detections matching the query, in total and for the most detected species
+    from datetime import datetime
+    import numpy as np
+    from utils import get_dataset, select_dets
+
+    det_store = get_dataset(args.dataset)
+    start_t = time.perf_counter()
+    sel_dets = select_dets(det_store, args.species, args.sites, None if args.start is None else datetime.fromisoformat(args.start),
+                           None if args.end is None else datetime.fromisoformat(args.end), args.min_conf)
+    query_secs = time.perf_counter() - start_t
+
+    print('{} detections ({:.3f}s)'.format(f'{sel_dets["n_dets"]:,}', query_secs))
+    spec_counts = np.bincount(sel_dets['det_spec_ixs'], minlength=len(det_store['spec_names']))
+    for spec_ix in np.argsort(-spec_counts, kind='stable')[:QUERY_TOP_SPECS]:
+        if spec_counts[spec_ix] > 0: print('---- {}: {}'.format(det_store['spec_names'][spec_ix], f'{spec_counts[spec_ix]:,}'))
+
+
+def import_command(command, args):
+    # Imports a command's modules and hands back the function that runs it
+    if command == 'stats':
+        import combined_data_stats
+        return lambda: combined_data_stats.run_stats_command(args)
+
+    if command == 'query':
+        import utils
+        return lambda: run_query(args)
+
+    if command == 'build':
+        # Nodes may run in worker processes, which pick the backend up from the environment
+        os.environ['MPLBACKEND'] = args.backend
+        import build
+        graph = build.get_build_graph(args.figs_dir)
+        return lambda: sys.exit(1 if len(build.run_build(graph, args.targets or None, args.workers, args.force, args.dry_run)) > 0 else 0)
+
+    import matplotlib
+    matplotlib.use(args.backend)
+
+    if command == 'fig2':
+        import fig_2
+        return lambda: fig_2.make_fig_2(args.figs_dir, args.ci_method)
+
+    if command == 'fig3':
+        import fig_3
+        if args.panel is None: return lambda: fig_3.make_fig_3(args.figs_dir)
+        return lambda: [fig_3.make_fig_3_panel(p, args.figs_dir) for p in args.panel]
+
+    raise ValueError('Unknown command {}'.format(command))
+
+
+def get_loaded_heavy_modules():
+    return [m for m in HEAVY_MODULES if m in sys.modules]
+
+
+def check_startup(commands, repeats=STARTUP_REPEATS, budgets=STARTUP_BUDGETS):
+    # Times each command up to the point it would start work, in a fresh interpreter each time,
+    # and reports any over its budget
+    n_over_budget = 0
+    for command in commands:
+        all_secs = []
+        for _ in range(repeats):
+            start_t = time.perf_counter()
+            out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--startup-only', command]).decode()
+            all_secs.append(time.perf_counter() - start_t)
+
+        secs = sorted(all_secs)[len(all_secs) // 2]
+        over_budget = secs > budgets[command]
+        n_over_budget += over_budget
+        print('{}{}: {:.3f}s (budget {:.1f}s), {}'.format('OVER BUDGET ' if over_budget else '', command, secs, budgets[command],
+                                                          out.strip().split('\n')[-1]))
+
+    return n_over_budget
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reproduce the paper\'s figures and statistics')
+    parser.add_argument('--backend', default=os.environ.get('MPLBACKEND', DEFAULT_BACKEND), help='matplotlib backend for figures')
+    parser.add_argument('--startup-only', action='store_true', help='Import what the command needs and report the time taken, without running it')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    stats_parser = subparsers.add_parser('stats', help='Print the combined dataset statistics')
+    stats_parser.add_argument('--workers', type=int, default=1, help='Worker processes to spread datasets over (1 runs serially)')
+    stats_parser.add_argument('--bn-conf-thresh', type=float, default=0.8, help='BirdNET confidence detections are counted over')
+    stats_parser.add_argument('--n-det-thresh', type=int, default=50, help='Detections a species needs to count as valid')
+    stats_parser.add_argument('--target-prec', type=float, default=0.9, help='Calibrated precision of high precision species')
+    stats_parser.add_argument('--sweep-bn-threshs', type=float, nargs='+', default=None, help='Report the stats over these BirdNET thresholds')
+    stats_parser.add_argument('--sweep-target-precs', type=float, nargs='+', default=None, help='Report the stats over these target precisions')
+    stats_parser.add_argument('--sweep-csv', default=None, help='Also write the sweep table to this csv')
+
+    query_parser = subparsers.add_parser('query', help='Count the detections of a dataset matching species, sites, times and confidence')
+    query_parser.add_argument('dataset', help='Short name of the dataset, e.g. norway')
+    query_parser.add_argument('--species', nargs='+', default=None, help='Common names (default all)')
+    query_parser.add_argument('--sites', nargs='+', default=None, help='Site names (default all)')
+    query_parser.add_argument('--start', default=None, help='Earliest detection time, e.g. 2022-05-01 or 2022-05-01T06:00')
+    query_parser.add_argument('--end', default=None, help='Latest detection time (inclusive)')
+    query_parser.add_argument('--min-conf', type=float, default=None)
+
+    fig2_parser = subparsers.add_parser('fig2', help='Per species precision at the calibrated thresholds')
+    fig2_parser.add_argument('--figs-dir', default='figs')
+    fig2_parser.add_argument('--ci-method', choices=['bootstrap', 'exact'], default=None, 
+                             help='Add whiskers with this confidence interval on each precision (default none)')
+
+    fig3_parser = subparsers.add_parser('fig3', help='The four dataset panels, or chosen panels as separate figures')
+    fig3_parser.add_argument('--panel', nargs='+', choices=FIG_3_PANELS, default=None)
+    fig3_parser.add_argument('--figs-dir', default='figs')
+
+    build_parser = subparsers.add_parser('build', help='Rebuild the figures, statistics and intermediate results whose inputs changed')
+    build_parser.add_argument('targets', nargs='*', help='Nodes to bring up to date, e.g. fig2 or calib:norway (default everything)')
+    build_parser.add_argument('--workers', type=int, default=1, help='Worker processes to run independent nodes over (1 runs serially)')
+    build_parser.add_argument('--figs-dir', default='figs')
+    build_parser.add_argument('--force', action='store_true', help='Rebuild every node needed for the targets')
+    build_parser.add_argument('--dry-run', action='store_true', help='List the nodes that would be built')
+
+    startup_parser = subparsers.add_parser('startup', help='Check each command\'s start up time against its budget')
+    startup_parser.add_argument('commands', nargs='*', help='Any of {} (default all)'.format(list(STARTUP_BUDGETS.keys())))
+    startup_parser.add_argument('--repeats', type=int, default=STARTUP_REPEATS)
+
+    args = parser.parse_args()
+
+    if args.command == 'startup':
+        unknown_commands = [c for c in args.commands if c not in STARTUP_BUDGETS.keys()]
+        if len(unknown_commands) > 0: parser.error('no startup budget for {}'.format(unknown_commands))
+        sys.exit(1 if check_startup(args.commands or list(STARTUP_BUDGETS.keys()), args.repeats) > 0 else 0)
+
+    run_command = import_command(args.command, args)
+    startup_secs = time.perf_counter() - CLI_START_T
+    if args.startup_only:
+        print('imports {:.3f}s, loaded {}'.format(startup_secs, get_loaded_heavy_modules() or 'none of {}'.format(HEAVY_MODULES)))
+        sys.exit(0)
+
+    from profiling import stage
+    with stage('cli_{}'.format(args.command)):
+        run_command()
@@ -1,82 +1,233 @@
-import os 
-import pickle 
-from utils import expand_to_valid_dets, get_datasets_dict, get_opt_spec_bn_threshs
-import numpy as np 
+from utils import (get_datasets_dict, get_opt_spec_bn_threshs, get_dataset, get_spec_conf_counts, dt_to_epoch, epoch_to_dt,
+                   get_store_spec_ids, read_spec_index, spec_ids_to_bitset, bitsets_to_member_counts)
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import csv
+import argparse
+import functools
+import numpy as np
+from profiling import profiled, stage
 
 N_DET_THRESH = 50
 TARGET_PREC = 0.9
 BN_CONF_THRESH = 0.8
 
-all_datasets = get_datasets_dict() 
-comb_data_dir = 'combined_detection_data'
-labelled_data_dir = 'precision_labelled_data'
+SWEEP_COLUMNS = ['dataset', 'bn_conf_thresh', 'target_prec', 'specs', 'valid_specs', 'dets', 'valid_spec_dets', 'high_prec_specs', 
+                 'high_prec_dets']
 
-totals = dict({'hrs': 0, 'sites': 0, 'specs': [], 'valid_specs': [], 'dets': 0, 
-               'valid_spec_dets': 0, 'high_prec_specs': [], 'high_prec_dets': 0})
 
-for ds in all_datasets:
-    comb_dets_path = os.path.join(comb_data_dir, '{}_combined_dets_0-8_thresh.pickle'.format(ds['short_name']))
+def get_high_prec_spec_ids(ds_short_name, target_prec=TARGET_PREC):
+    # Global IDs of the species calibrated to at least target_prec. Labelled clips are drawn from the dataset's own
+    # detections, so once its store's species are in the index (get_store_spec_ids) every labelled name has an ID
+    bn_threshs, spec_precs, _, _ = get_opt_spec_bn_threshs(ds_short_name, target_prec)
+    spec_codes = {s: ix for ix, s in enumerate(read_spec_index())}
+    high_prec_specs = [s for s_ix, s in enumerate(bn_threshs.keys()) if spec_precs[s_ix] >= target_prec]
 
-    with open(comb_dets_path, 'rb') as f_handle:
-        all_f_dets = pickle.load(f_handle)
+    missing_specs = [s for s in high_prec_specs if s not in spec_codes]
+    if len(missing_specs) > 0:
+        raise ValueError('Labelled species of {} not in any detection store (check their names match): {}'.format(ds_short_name,
+                                                                                                                   missing_specs))
+
+    return np.asarray([spec_codes[s] for s in high_prec_specs], dtype='int32')
+
+
+def summarise_spec_counts(spec_counts, store_spec_ids, high_prec_spec_ids, n_det_thresh=N_DET_THRESH):
+    # Species sets (bitsets over the global species index) and detection totals of a dataset from its counts per 
+    # species code. Species are handled by their global IDs, so membership is looked up in arrays rather than by names
+    is_valid_spec = spec_counts >= n_det_thresh
+
+    n_specs = int(max(np.max(store_spec_ids, initial=-1), np.max(high_prec_spec_ids, initial=-1)) + 1)
+    is_high_prec_id = np.zeros(n_specs, dtype='bool')
+    is_high_prec_id[high_prec_spec_ids] = True
+
+    return {'specs': spec_ids_to_bitset(store_spec_ids[spec_counts > 0], n_specs),
+            'valid_specs': spec_ids_to_bitset(store_spec_ids[is_valid_spec], n_specs),
+            'high_prec_specs': spec_ids_to_bitset(high_prec_spec_ids, n_specs),
+            'dets': int(np.sum(spec_counts)), 'valid_spec_dets': int(np.sum(spec_counts[is_valid_spec])),
+            'high_prec_dets': int(np.sum(spec_counts[is_high_prec_id[store_spec_ids]]))}
+
+
+def count_bitset(bitset):
+    return int(np.sum(np.unpackbits(bitset)))
+
+
+@profiled(n_items=lambda summary: summary['dets'])
+def get_ds_summary(ds, bn_conf_thresh=BN_CONF_THRESH, n_det_thresh=N_DET_THRESH, target_prec=TARGET_PREC):
+    # Everything the report needs from one dataset, small enough to send back from a worker process
+    det_store = get_dataset(ds['short_name'])
+
+    valid_f_epochs = det_store['file_epochs'][det_store['file_epochs'] >= dt_to_epoch(datetime(1971, 1, 1))]
+    first_dt = epoch_to_dt(np.min(valid_f_epochs), det_store['tz_aware'])
+    last_dt = epoch_to_dt(np.max(valid_f_epochs), det_store['tz_aware'])
 
-    all_fd_dts = np.asarray([fd['dt'] for fd in all_f_dets if fd['dt'].year > 1970])
-    
     if ds['short_name'] == 'taiwan':
-        tot_mins = 0
-        for f in all_f_dets:
-            tot_mins += f['f_len_mins']
+        tot_mins = np.sum(det_store['file_len_mins'])
         ds_hours = tot_mins / 60
     else:
-        ds_hours = int(np.round(ds['mins_per_f'] * len(all_f_dets) / 60))
-    totals['hrs'] += ds_hours
-
-    bn_threshs, spec_precs, _, _ = get_opt_spec_bn_threshs(ds['short_name'], TARGET_PREC)
-    specs = np.asarray(list(bn_threshs.keys()))
-    
-    all_valid_dets = expand_to_valid_dets(all_f_dets, bn_conf_thresh=BN_CONF_THRESH)
-    totals['dets'] += len(all_valid_dets)
-
-    unq_sites = np.unique([fd['site'] for fd in all_f_dets])
-    totals['sites'] += len(unq_sites)
-
-    all_specs = np.asarray([d['common_name'] for d in all_valid_dets])
-    unq_specs, unq_spec_inv_ixs, unq_spec_counts = np.unique(all_specs, return_inverse=True, return_counts=True)
-    totals['specs'].extend(unq_specs)
-
-    unq_valid_spec_ixs = np.where((unq_spec_counts >= N_DET_THRESH))[0]
-    unq_valid_specs = unq_specs[unq_valid_spec_ixs]
-    totals['valid_specs'].extend(unq_valid_specs)
-
-    valid_spec_dets = np.where((np.isin(unq_spec_inv_ixs, unq_valid_spec_ixs) == True))[0]
-    totals['valid_spec_dets'] += len(valid_spec_dets)
-    
-    high_prec_specs = []
-    for s_ix, spec in enumerate(specs):
-        if spec_precs[s_ix] >= TARGET_PREC: high_prec_specs.append(spec)
-    totals['high_prec_specs'].extend(high_prec_specs)
-
-    high_prec_dets = [d for d in all_valid_dets if d['common_name'] in high_prec_specs]
-    perc_high_prec_dets = int(np.round(len(high_prec_dets)/len(all_valid_dets)*100))
-    totals['high_prec_dets'] += len(high_prec_dets)
+        ds_hours = int(np.round(ds['mins_per_f'] * det_store['n_files'] / 60))
+
+    # Per species counts over the BirdNET threshold come from the store's sorted confidences
+    spec_counts = get_spec_conf_counts(det_store, bn_conf_thresh)
+    unq_sites = np.unique(det_store['file_site_ixs'])
+
+    summary = {'hrs': ds_hours, 'n_files': det_store['n_files'], 'n_sites': len(unq_sites),
+               'first_day': first_dt.strftime('%Y-%m-%d'), 'last_day': last_dt.strftime('%Y-%m-%d'),
+               'bn_conf_thresh': bn_conf_thresh, 'n_det_thresh': n_det_thresh, 'target_prec': target_prec}
+    store_spec_ids = get_store_spec_ids(det_store)
+    summary.update(summarise_spec_counts(spec_counts, store_spec_ids, get_high_prec_spec_ids(ds['short_name'], target_prec), n_det_thresh))
+    return summary
+
+
+def print_ds_summary(ds, summary):
+    perc_high_prec_dets = int(np.round(summary['high_prec_dets']/max(summary['dets'], 1)*100))
 
     print('{}:'.format(ds['name']))
-    print('---- {} sites'.format(len(unq_sites)))
-    print('---- {} - {}'.format(np.min(all_fd_dts).strftime('%Y-%m-%d'), np.max(all_fd_dts).strftime('%Y-%m-%d')))
-    print('---- {} hours ({} files)'.format(f'{ds_hours:,}', f'{len(all_f_dets):,}'))    
-    print('---- {} species'.format(len(unq_specs)))
-    print('---- {} raw detections'.format(f'{len(all_valid_dets):,}'))
-    print('---- {} species with over {} detections ({} BN conf thresh)'.format(len(unq_valid_spec_ixs), N_DET_THRESH, BN_CONF_THRESH))
-    print('---- {} detections after filtering species'.format(f'{len(valid_spec_dets):,}'))
-    print('---- {} species with precision >= {}'.format(len(high_prec_specs), TARGET_PREC))
-    print('---- {} detections of species with precision >= {} ({}%)'.format(f'{len(high_prec_dets):,}', TARGET_PREC, perc_high_prec_dets))
-
-print('Totals: {} hrs, {} sites, {} specs, {} valid_specs, {} dets, {} valid_spec_dets, {} high_prec_specs, {} high_prec_dets'
-      .format(totals['hrs'], totals['sites'], len(np.unique(totals['specs'])), len(np.unique(totals['valid_specs'])), totals['dets'], 
-              totals['valid_spec_dets'], len(np.unique(totals['high_prec_specs'])), totals['high_prec_dets']))
-
-unq_valid_specs, valid_spec_counts = np.unique(totals['valid_specs'], return_counts=True)
-print('In >1 dataset - {}'.format(['{} ({})'.format(s, s_c) for s, s_c in zip(unq_valid_specs, valid_spec_counts) if s_c > 1]))
-
-unq_high_prec_specs, high_prec_spec_counts = np.unique(totals['high_prec_specs'], return_counts=True)
-print('Prec >= {}: {}'.format(TARGET_PREC, ['{} ({})'.format(s, s_c) for s, s_c in zip(unq_high_prec_specs, high_prec_spec_counts) if s_c > 1]))
+    print('---- {} sites'.format(summary['n_sites']))
+    print('---- {} - {}'.format(summary['first_day'], summary['last_day']))
+    print('---- {} hours ({} files)'.format(f'{summary["hrs"]:,}', f'{summary["n_files"]:,}'))
+    print('---- {} species'.format(count_bitset(summary['specs'])))
+    print('---- {} raw detections'.format(f'{summary["dets"]:,}'))
+    print('---- {} species with over {} detections ({} BN conf thresh)'.format(count_bitset(summary['valid_specs']), summary['n_det_thresh'],
+                                                                               summary['bn_conf_thresh']))
+    print('---- {} detections after filtering species'.format(f'{summary["valid_spec_dets"]:,}'))
+    print('---- {} species with precision >= {}'.format(count_bitset(summary['high_prec_specs']), summary['target_prec']))
+    print('---- {} detections of species with precision >= {} ({}%)'.format(f'{summary["high_prec_dets"]:,}', summary['target_prec'], 
+                                                                          perc_high_prec_dets))
+
+
+def print_report(all_datasets, ds_summaries, target_prec=TARGET_PREC):
+    # ds_summaries can be a lazy iterable, datasets are reported in order as soon as their summary arrives
+    # Species sets are bitsets over the global species index, combined across datasets by counting members
+    totals = dict({'hrs': 0, 'sites': 0, 'specs': [], 'valid_specs': [], 'dets': 0,
+                   'valid_spec_dets': 0, 'high_prec_specs': [], 'high_prec_dets': 0})
+
+    for ds, summary in zip(all_datasets, ds_summaries):
+        totals['hrs'] += summary['hrs']
+        totals['sites'] += summary['n_sites']
+        for k in ['specs', 'valid_specs', 'high_prec_specs']: totals[k].append(summary[k])
+        for k in ['dets', 'valid_spec_dets', 'high_prec_dets']: totals[k] += summary[k]
+
+        print_ds_summary(ds, summary)
+
+    spec_index = np.asarray(read_spec_index(), dtype='str')
+    n_ds_per_spec = {k: bitsets_to_member_counts(totals[k], len(spec_index)) for k in ['specs', 'valid_specs', 'high_prec_specs']}
+
+    print('Totals: {} hrs, {} sites, {} specs, {} valid_specs, {} dets, {} valid_spec_dets, {} high_prec_specs, {} high_prec_dets'
+          .format(totals['hrs'], totals['sites'], np.count_nonzero(n_ds_per_spec['specs']), np.count_nonzero(n_ds_per_spec['valid_specs']),
+                  totals['dets'], totals['valid_spec_dets'], np.count_nonzero(n_ds_per_spec['high_prec_specs']), totals['high_prec_dets']))
+
+    for k, label in [('valid_specs', 'In >1 dataset - {}'), ('high_prec_specs', 'Prec >= {}: '.format(target_prec) + '{}')]:
+        multi_ds_spec_ids = np.where((n_ds_per_spec[k] > 1))[0]
+        multi_ds_spec_ids = multi_ds_spec_ids[np.argsort(spec_index[multi_ds_spec_ids], kind='stable')]
+        print(label.format(['{} ({})'.format(spec_index[s_id], n_ds_per_spec[k][s_id]) for s_id in multi_ds_spec_ids]))
+
+
+@profiled(n_items=lambda sweep_rows: len(sweep_rows))
+def get_ds_sweep(ds, bn_conf_threshs, target_precs, n_det_thresh=N_DET_THRESH):
+    # Species sets and detection totals of one dataset at every BirdNET threshold x target precision. The counts
+    # at all the thresholds come from a single binary search of the sorted confidences
+    det_store = get_dataset(ds['short_name'])
+    store_spec_ids = get_store_spec_ids(det_store)
+    thresh_spec_counts = get_spec_conf_counts(det_store, np.asarray(bn_conf_threshs, dtype='float64')[:, np.newaxis])
+
+    sweep_rows = []
+    for target_prec in target_precs:
+        high_prec_spec_ids = get_high_prec_spec_ids(ds['short_name'], target_prec)
+        for bn_conf_thresh, spec_counts in zip(bn_conf_threshs, thresh_spec_counts):
+            sweep_row = {'bn_conf_thresh': bn_conf_thresh, 'target_prec': target_prec}
+            sweep_row.update(summarise_spec_counts(spec_counts, store_spec_ids, high_prec_spec_ids, n_det_thresh))
+            sweep_rows.append(sweep_row)
+
+    return sweep_rows
+
+
+def get_sweep_table(all_datasets, ds_sweeps):
+    # Rows of SWEEP_COLUMNS for every dataset and grid point, then the totals over datasets at each grid point
+    # (with species in several datasets counted once)
+    sweep_table = []
+    all_ds_rows = []
+    for ds, sweep_rows in zip(all_datasets, ds_sweeps):
+        all_ds_rows.append(sweep_rows)
+        for r in sweep_rows:
+            sweep_table.append({'dataset': ds['name'], 'bn_conf_thresh': r['bn_conf_thresh'], 'target_prec': r['target_prec'],
+                                'specs': count_bitset(r['specs']), 'valid_specs': count_bitset(r['valid_specs']), 'dets': r['dets'],
+                                'valid_spec_dets': r['valid_spec_dets'], 'high_prec_specs': count_bitset(r['high_prec_specs']),
+                                'high_prec_dets': r['high_prec_dets']})
+
+    n_specs = len(read_spec_index())
+    for grid_rows in zip(*all_ds_rows):
+        tot_row = {'dataset': 'Total', 'bn_conf_thresh': grid_rows[0]['bn_conf_thresh'], 'target_prec': grid_rows[0]['target_prec']}
+        for k in ['specs', 'valid_specs', 'high_prec_specs']:
+            tot_row[k] = int(np.count_nonzero(bitsets_to_member_counts([r[k] for r in grid_rows], n_specs)))
+        for k in ['dets', 'valid_spec_dets', 'high_prec_dets']: tot_row[k] = sum([r[k] for r in grid_rows])
+        sweep_table.append(tot_row)
+
+    return sweep_table
+
+
+def print_sweep_table(sweep_table):
+    print(''.join(['{:>16}'.format(c) for c in SWEEP_COLUMNS]))
+    for r in sweep_table:
+        print(''.join(['{:>16}'.format(f'{r[c]:,}' if isinstance(r[c], int) else str(r[c])) for c in SWEEP_COLUMNS]))
+
+
+def write_sweep_table(sweep_table, csv_path):
+    with open(csv_path, 'w', newline='') as f_handle:
+        writer = csv.DictWriter(f_handle, fieldnames=SWEEP_COLUMNS)
+        writer.writeheader()
+        writer.writerows(sweep_table)
+
+
+def map_datasets(ds_fn, all_datasets, workers=1):
+    # ds_fn over the datasets, lazily and in order, spread over worker processes if workers > 1
+    if workers <= 1:
+        yield from map(ds_fn, all_datasets)
+        return
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(all_datasets))) as executor:
+        yield from executor.map(ds_fn, all_datasets)
+
+
+def run_stats(workers=1, bn_conf_thresh=BN_CONF_THRESH, n_det_thresh=N_DET_THRESH, target_prec=TARGET_PREC):
+    all_datasets = get_datasets_dict()
+
+    with stage('combined_data_stats'):
+        ds_fn = functools.partial(get_ds_summary, bn_conf_thresh=bn_conf_thresh, n_det_thresh=n_det_thresh, target_prec=target_prec)
+        print_report(all_datasets, map_datasets(ds_fn, all_datasets, workers), target_prec)
+
+
+def run_sweep(bn_conf_threshs, target_precs, n_det_thresh=N_DET_THRESH, workers=1, csv_path=None):
+    # The stats of every dataset (and their totals) over a grid of BirdNET thresholds and target precisions
+    all_datasets = get_datasets_dict()
+
+    with stage('combined_data_stats_sweep'):
+        ds_fn = functools.partial(get_ds_sweep, bn_conf_threshs=list(bn_conf_threshs), target_precs=list(target_precs), 
+                                  n_det_thresh=n_det_thresh)
+        sweep_table = get_sweep_table(all_datasets, map_datasets(ds_fn, all_datasets, workers))
+
+    print_sweep_table(sweep_table)
+    if csv_path is not None: write_sweep_table(sweep_table, csv_path)
+    return sweep_table
+
+
+def run_stats_command(args):
+    # Sweeps when given a list of thresholds or target precisions (the other defaulting to its single value)
+    if args.sweep_bn_threshs is None and args.sweep_target_precs is None:
+        run_stats(args.workers, args.bn_conf_thresh, args.n_det_thresh, args.target_prec)
+    else:
+        run_sweep(args.sweep_bn_threshs or [args.bn_conf_thresh], args.sweep_target_precs or [args.target_prec], args.n_det_thresh, 
+                  args.workers, args.sweep_csv)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes to spread datasets over (1 runs serially)')
+    parser.add_argument('--bn-conf-thresh', type=float, default=BN_CONF_THRESH, help='BirdNET confidence detections are counted over')
+    parser.add_argument('--n-det-thresh', type=int, default=N_DET_THRESH, help='Detections a species needs to count as valid')
+    parser.add_argument('--target-prec', type=float, default=TARGET_PREC, help='Calibrated precision of high precision species')
+    parser.add_argument('--sweep-bn-threshs', type=float, nargs='+', default=None, help='Report the stats over these BirdNET thresholds')
+    parser.add_argument('--sweep-target-precs', type=float, nargs='+', default=None, help='Report the stats over these target precisions')
+    parser.add_argument('--sweep-csv', default=None, help='Also write the sweep table to this csv')
+    args = parser.parse_args()
+
+    run_stats_command(args)
@@ -1,14 +1,7 @@
-import fig_3_brazil_diurnal
-import fig_3_norway_species_latitudinal
-import fig_3_taiwan_seasonal
-import fig_3_costarica_land_use_activity
-import matplotlib.pyplot as plt 
-import os 
+import os
+from profiling import stage
 
 title_font_sz = 18
-plt.rc('axes', labelsize=15)    
-plt.rc('xtick', labelsize=12)    
-plt.rc('ytick', labelsize=12)    
 
 SPEC_PREC_THR = 0.9
 MIN_DETS_PER_SPEC = 20
@@ -16,31 +9,97 @@ MIN_DETS_PER_SPEC = 20
 COSTA_RICA_SPEC = 'Yellow-throated Toucan'
 NORWAY_SPEC = 'Willow Warbler'
 
-fig3 = plt.figure(figsize=((18,17)), constrained_layout=True)
-gs = fig3.add_gridspec(12, 2)
+FIG_3_PANELS = ['brazil', 'costa-rica', 'norway', 'taiwan']
+# Size and file name of each panel when drawn on its own
+PANEL_FIGS = {'brazil': {'figsize': (8,4), 'f_name': 'fig_3_brazil_diurnal'},
+              'costa-rica': {'figsize': (8,4), 'f_name': 'fig_3_costa-rica_land_use'},
+              'norway': {'figsize': (16,4), 'f_name': 'fig_3_norway_species_arrival_time'},
+              'taiwan': {'figsize': (16,6), 'f_name': 'fig_3_taiwan_seasonal'}}
 
-f3_ax1 = fig3.add_subplot(gs[0:4, 0])
-plt.sca(f3_ax1)
-fig_3_brazil_diurnal.do_plot(spec_prec_thresh=SPEC_PREC_THR, min_dets_per_spec=MIN_DETS_PER_SPEC)
-f3_ax1.set_title('Brazil', fontsize=title_font_sz)
 
-f3_ax2 = fig3.add_subplot(gs[0:4, 1])
-plt.sca(f3_ax2)
-fig_3_costarica_land_use_activity.do_plot(COSTA_RICA_SPEC)
-f3_ax2.set_title('Costa Rica: {}'.format(COSTA_RICA_SPEC), fontsize=title_font_sz)
+def plot_panel(panel):
+    # Panel modules are imported here, so drawing one panel doesn't load the others' dependencies
+    if panel == 'brazil':
+        import fig_3_brazil_diurnal
+        fig_3_brazil_diurnal.do_plot(spec_prec_thresh=SPEC_PREC_THR, min_dets_per_spec=MIN_DETS_PER_SPEC)
+        return 'Brazil'
+    if panel == 'costa-rica':
+        import fig_3_costarica_land_use_activity
+        fig_3_costarica_land_use_activity.do_plot(COSTA_RICA_SPEC)
+        return 'Costa Rica: {}'.format(COSTA_RICA_SPEC)
+    if panel == 'norway':
+        import fig_3_norway_species_latitudinal
+        fig_3_norway_species_latitudinal.do_plot(NORWAY_SPEC)
+        return 'Norway: {}'.format(NORWAY_SPEC)
+    if panel == 'taiwan':
+        import fig_3_taiwan_seasonal
+        fig_3_taiwan_seasonal.do_plot(spec_prec_thresh=SPEC_PREC_THR, min_dets_per_spec=MIN_DETS_PER_SPEC)
+        return 'Taiwan'
+    raise ValueError('panel should be one of {}, not {}'.format(FIG_3_PANELS, panel))
 
-f3_ax3 = fig3.add_subplot(gs[4:7, :])
-plt.sca(f3_ax3)
-fig_3_norway_species_latitudinal.do_plot(NORWAY_SPEC)
-f3_ax3.set_title('Norway: {}'.format(NORWAY_SPEC), fontsize=title_font_sz)
 
-f3_ax4 = fig3.add_subplot(gs[7:, :])
-plt.sca(f3_ax4)
-fig_3_taiwan_seasonal.do_plot(spec_prec_thresh=SPEC_PREC_THR, min_dets_per_spec=MIN_DETS_PER_SPEC)
-f3_ax4.set_title('Taiwan', fontsize=title_font_sz)
+def load_panel_data(panel):
+    # Computes (or reads from the cache) what plot_panel draws, without drawing it
+    if panel == 'brazil':
+        import fig_3_brazil_diurnal
+        return fig_3_brazil_diurnal.load_hourly_activity(SPEC_PREC_THR, MIN_DETS_PER_SPEC)
+    if panel == 'costa-rica':
+        import fig_3_costarica_land_use_activity
+        return fig_3_costarica_land_use_activity.load_hab_rates_table()
+    if panel == 'norway':
+        import fig_3_norway_species_latitudinal
+        return fig_3_norway_species_latitudinal.load_spec_site_day_cube({'short_name': 'norway', 'name': 'Norway', 'mins_per_f': 5},
+                                                                         fig_3_norway_species_latitudinal.START_DT,
+                                                                         fig_3_norway_species_latitudinal.END_DT)
+    if panel == 'taiwan':
+        import fig_3_taiwan_seasonal
+        return fig_3_taiwan_seasonal.load_dets_mat(SPEC_PREC_THR, MIN_DETS_PER_SPEC)
+    raise ValueError('panel should be one of {}, not {}'.format(FIG_3_PANELS, panel))
 
-plt.tight_layout()
 
-plt.savefig(os.path.join('figs', 'fig_3.pdf'))   
-plt.savefig(os.path.join('figs', 'fig_3.svg'))   
-plt.savefig(os.path.join('figs', 'fig_3.png'))   
+def set_fig_3_style():
+    import matplotlib.pyplot as plt
+    plt.rc('axes', labelsize=15)
+    plt.rc('xtick', labelsize=12)
+    plt.rc('ytick', labelsize=12)
+
+
+def make_fig_3(figs_dir='figs'):
+    import matplotlib.pyplot as plt
+    set_fig_3_style()
+
+    fig3 = plt.figure(figsize=((18,17)), constrained_layout=True)
+    gs = fig3.add_gridspec(12, 2)
+
+    panel_gs = {'brazil': gs[0:4, 0], 'costa-rica': gs[0:4, 1], 'norway': gs[4:7, :], 'taiwan': gs[7:, :]}
+    for panel in FIG_3_PANELS:
+        panel_ax = fig3.add_subplot(panel_gs[panel])
+        plt.sca(panel_ax)
+        panel_ax.set_title(plot_panel(panel), fontsize=title_font_sz)
+
+    if not os.path.exists(figs_dir): os.makedirs(figs_dir)
+    with stage('fig3_render'):
+        plt.tight_layout()
+
+        plt.savefig(os.path.join(figs_dir, 'fig_3.pdf'))
+        plt.savefig(os.path.join(figs_dir, 'fig_3.svg'))
+        plt.savefig(os.path.join(figs_dir, 'fig_3.png'))
+    plt.close(fig3)
+
+
+def make_fig_3_panel(panel, figs_dir='figs'):
+    # A single panel as its own figure, as the panel scripts save it
+    import matplotlib.pyplot as plt
+    set_fig_3_style()
+
+    panel_fig = plt.figure(figsize=PANEL_FIGS[panel]['figsize'])
+    plot_panel(panel)
+
+    if not os.path.exists(figs_dir): os.makedirs(figs_dir)
+    with stage('fig3_render'):
+        plt.savefig(os.path.join(figs_dir, '{}.png'.format(PANEL_FIGS[panel]['f_name'])))
+    plt.close(panel_fig)
+
+
+if __name__ == '__main__':
+    make_fig_3()
@@ -1,76 +1,76 @@
 import os 
-import pickle
 import numpy as np
-import matplotlib.pyplot as plt
-from utils import expand_to_valid_dets, get_opt_spec_bn_threshs
-import pytz
-from suntime import Sun
+from utils import (get_opt_spec_bn_threshs, load_agg_cubes, rollup_agg_cube, get_agg_cube_day_nums, get_ds_input_paths, cached_compute, use_dataset,
+                   get_weighted_median)
+from solar_time import load_site_day_sun_table, get_site_day_sun_times, get_sun_times, get_local_dec_hours
+from profiling import profiled
 
-def do_plot(spec_prec_thresh=0.9, min_dets_per_spec=20):
+# Used for sites recorded without a position
+NOM_LAT_LONG = [-2.080786484477367, -47.48532049576227]
 
-    spec_opt_threshs, spec_precisions, _, num_valid_spec_dets = get_opt_spec_bn_threshs('brazil')
+@profiled('brazil_hourly_activity')
+def get_hourly_activity(ds, spec_prec_thresh, min_dets_per_spec):
+    spec_opt_threshs, spec_precisions, _, num_valid_spec_dets = get_opt_spec_bn_threshs(ds['short_name'])
     specs = np.asarray(list(spec_opt_threshs.keys()))
     allowed_specs = specs[(spec_precisions >= spec_prec_thresh) & (num_valid_spec_dets >= min_dets_per_spec)]
 
-    ds = {'short_name': 'brazil', 'name': 'Brazil', 'mins_per_f': 1}
+    # Potential pytz timezones:  'Brazil/Acre', 'Brazil/DeNoronha', 'Brazil/East', 'Brazil/West'
+    cube = load_agg_cubes(ds['short_name'], ds['tz'])['calibrated']
 
-    comb_data_dir = 'combined_detection_data'
-    comb_dets_path = os.path.join(comb_data_dir, '{}_combined_dets_0-8_thresh.pickle'.format(ds['short_name']))
+    # Day and night are shaded from the sunrise and sunset of every site-day the allowed species were detected on,
+    # taking the median weighted by detections
+    site_day_counts = rollup_agg_cube(cube, ('site', 'day'), spec_names=allowed_specs)
+    det_site_ixs, det_day_ixs = np.nonzero(site_day_counts)
+    det_day_nums = get_agg_cube_day_nums(cube)[det_day_ixs]
 
-    with open(comb_dets_path, 'rb') as f_handle:
-        all_f_dets = pickle.load(f_handle)
-    all_dets = expand_to_valid_dets(all_f_dets)
+    sun_table = load_site_day_sun_table(ds)
+    sunrise_epochs, sunset_epochs, _ = get_site_day_sun_times(sun_table, det_site_ixs, det_day_nums)
+    no_pos_ixs = np.where((np.isnan(sun_table['site_lats'][det_site_ixs]) | np.isnan(sun_table['site_longs'][det_site_ixs])))[0]
+    sunrise_epochs[no_pos_ixs], sunset_epochs[no_pos_ixs], _ = get_sun_times(NOM_LAT_LONG[0], NOM_LAT_LONG[1], det_day_nums[no_pos_ixs])
 
-    print('Applying species specific optimal thresholds')
-    all_valid_dets = []
-    for det in all_dets:
-        if det['common_name'] in allowed_specs and det['confidence'] > spec_opt_threshs[det['common_name']]:
-            all_valid_dets.append(det)
+    site_day_weights = site_day_counts[det_site_ixs, det_day_ixs]
+    sunrise_dec = get_weighted_median(get_local_dec_hours(sunrise_epochs, ds['tz']), site_day_weights)
+    sunset_dec = get_weighted_median(get_local_dec_hours(sunset_epochs, ds['tz']), site_day_weights)
+    print('{} site-days: median sunrise at {:02d}:{:02d}, sunset at {:02d}:{:02d}'.format(len(det_site_ixs), int(sunrise_dec), int(sunrise_dec % 1 * 60),
+                                                                                          int(sunset_dec), int(sunset_dec % 1 * 60)))
 
-    all_det_specs = np.asarray([d['common_name'] for d in all_valid_dets])
+    # Species x hour histograms of all allowed species at once
+    plt_data = rollup_agg_cube(cube, ('spec', 'hour'), spec_names=allowed_specs)
+    plt_data = plt_data / np.max(plt_data, axis=1, keepdims=True)
 
-    # Potential pytz timezones:  'Brazil/Acre', 'Brazil/DeNoronha', 'Brazil/East', 'Brazil/West'
-    all_det_hrs_local_tz = np.asarray([d['det_dt'].astimezone(pytz.timezone('Brazil/East')).hour for d in all_valid_dets])
-    all_det_dts_local_tz = np.asarray([d['det_dt'].astimezone(pytz.timezone('Brazil/East')) for d in all_valid_dets])
+    max_activity_hrs = np.argmax(plt_data, axis=1)
+    plt_specs = np.asarray(allowed_specs)
 
-    mid_dt = sorted(all_det_dts_local_tz)[int(len(all_det_dts_local_tz)/2)]
+    sort_ix = np.argsort(max_activity_hrs)[::-1]
 
-    nom_lat_long = [-2.080786484477367, -47.48532049576227]
-    sunrise_calc = Sun(nom_lat_long[0], nom_lat_long[1])
-    sunrise_time = sunrise_calc.get_local_sunrise_time(mid_dt).astimezone(pytz.timezone('Brazil/East'))
-    sunset_time = sunrise_calc.get_local_sunset_time(mid_dt).astimezone(pytz.timezone('Brazil/East'))
-    print('{}: sunrise at {}, sunset at {}'.format(mid_dt.strftime('%Y-%m-%d'), sunrise_time.strftime('%H:%M'), sunset_time.strftime('%H:%M')))
+    plt_specs = plt_specs[sort_ix]
+    plt_data = plt_data[sort_ix, :]
 
-    y_ticks = np.asarray(range(len(allowed_specs))) * 1.2
+    return plt_data, plt_specs, sunrise_dec, sunset_dec
 
-    plt_data = []
-    max_activity_hrs = []
-    plt_specs = []
-    for spec in allowed_specs:
-        match_det_ixs = np.where((all_det_specs == spec))[0]
-        match_det_hrs = all_det_hrs_local_tz[match_det_ixs]
 
-        hist_data,_ = np.histogram(np.asarray(match_det_hrs), np.asarray(range(25)))
-        hist_data = hist_data / np.max(hist_data)
+def load_hourly_activity(spec_prec_thresh=0.9, min_dets_per_spec=20, force_compute=False):
+    ds = {'short_name': 'brazil', 'name': 'Brazil', 'mins_per_f': 1, 'tz': 'Brazil/East'}
 
-        max_activity_hrs.append(np.argmax(hist_data))
-        plt_data.append(hist_data)
-        plt_specs.append(spec)
+    return cached_compute('fig3_{}'.format(ds['short_name']), {'spec_prec_thresh': spec_prec_thresh, 'min_dets_per_spec': min_dets_per_spec},
+                          get_ds_input_paths(ds['short_name']), lambda: get_hourly_activity(ds, spec_prec_thresh, min_dets_per_spec), force_compute)
 
-    plt_specs = np.asarray(plt_specs)
-    plt_data = np.asarray(plt_data)
 
-    sort_ix = np.argsort(max_activity_hrs)[::-1]
+@profiled('brazil_do_plot')
+def do_plot(spec_prec_thresh=0.9, min_dets_per_spec=20, force_compute=False, dataset=None):
+    # The plotting stack is only imported once something is drawn, so the data side of the panel stays quick to import.
+    # dataset is optionally the Brazil detection store already loaded with get_dataset
+    import matplotlib.pyplot as plt
+    if dataset is not None: use_dataset(dataset)
 
-    plt_specs = plt_specs[sort_ix]
-    plt_data = plt_data[sort_ix, :]
+    plt_data, plt_specs, sunrise_dec, sunset_dec = load_hourly_activity(spec_prec_thresh, min_dets_per_spec, force_compute)
+
+    y_ticks = np.asarray(range(len(plt_specs))) * 1.2
 
     [plt.gca().axvline(x, alpha=0.1, c='k', ls='--', linewidth='1') for x in range(24)]
     [plt.gca().axhline(y, alpha=0.1, c='k', ls='--', linewidth='1') for y in y_ticks]
 
     _ylim = [-0.5, np.max(y_ticks)+2]
-    sunrise_dec = sunrise_time.hour + (sunrise_time.minute/60)
-    sunset_dec = sunset_time.hour + (sunset_time.minute/60)
     plt.gca().fill_betweenx(_ylim, 0, sunrise_dec, facecolor='#13385C', alpha=0.2)
     plt.gca().fill_betweenx(_ylim, sunrise_dec, sunset_dec, facecolor='#FFFF99', alpha=0.2, label='Day')
     plt.gca().fill_betweenx(_ylim, sunset_dec, 24, facecolor='#13385C', alpha=0.2, label='Night')
@@ -92,6 +92,7 @@ def do_plot(spec_prec_thresh=0.9, min_dets_per_spec=20):
 
 
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
     plt.figure(figsize=((8,4)))
     do_plot()
     plt.savefig(os.path.join('figs', 'fig_3_brazil_diurnal.png'))   
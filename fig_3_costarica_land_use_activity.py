@@ -1,84 +1,136 @@
 import os 
-import pickle 
-import matplotlib.pyplot as plt
-from utils import get_costarica_site_info, get_opt_spec_bn_threshs
+import sys
+from utils import (get_costarica_site_attrs, get_opt_spec_bn_threshs, get_ds_input_paths, cached_compute, get_dataset, use_dataset,
+                   expand_to_valid_dets, get_spec_row_lookup, get_min_uint_dtype, map_det_partitions, COSTA_RICA_SITE_INFO_PATH)
 import numpy as np
+from profiling import profiled
 
-def do_plot(target_spec='Yellow-throated Toucan', force_compute=False):
+def count_site_day_dets(det_store, spec_opt_threshs, f_site_day_ranks, spec_rows, n_rows, n_site_days):
+    # Detections over the calibrated thresholds per table row (species) x site-day, f_site_day_ranks giving
+    # each file's site-day column (-1 for files from sites without habitat info)
+    all_valid_dets = expand_to_valid_dets(det_store, spec_opt_threshs, strict=True)
+    det_site_day_ixs = f_site_day_ranks[all_valid_dets['det_file_ixs']]
+    det_rows = spec_rows[all_valid_dets['det_spec_ixs']]
+    keep_det_ixs = np.where((det_site_day_ixs >= 0) & (det_rows >= 0))[0]
 
-    ds = {'short_name': 'costa-rica', 'name': 'Costa Rica', 'mins_per_f': 1}
+    return np.bincount(det_rows[keep_det_ixs] * n_site_days + det_site_day_ixs[keep_det_ixs], 
+                       minlength=n_rows * n_site_days).reshape((n_rows, n_site_days))
 
-    temp_fig_data_path = os.path.join('temp_fig_data', 'fig3_{}.pickle'.format(ds['short_name']))
 
-    if not os.path.exists(temp_fig_data_path) or force_compute:
-        comb_data_dir = 'combined_detection_data'
-        comb_dets_path = os.path.join(comb_data_dir, '{}_combined_dets_0-8_thresh.pickle'.format(ds['short_name']))
+@profiled('costa-rica_hab_rates_table', n_items=lambda table: len(table['site_day_n_files']))
+def get_hab_rates_table(ds, workers=1):
+    # Detection counts of every calibrated species per site-day (over the sites with habitat info) in one 
+    # grouped pass, along with the number of files recorded on each site-day. workers > 1 splits the 
+    # detections over that many processes
+    spec_opt_threshs, _, _, _ = get_opt_spec_bn_threshs(ds['short_name'])
 
-        spec_opt_threshs, _, _, _ = get_opt_spec_bn_threshs(ds['short_name'])
+    det_store = get_dataset(ds['short_name'])
 
-        with open(comb_dets_path, 'rb') as f_handle:
-            all_f_dets = pickle.load(f_handle)
+    site_attrs = get_costarica_site_attrs(det_store['site_names'])
+    has_hab_info = site_attrs['site_rows'] >= 0
+    unq_habs = np.unique(site_attrs['habitat'][has_hab_info])
+    site_hab_ixs = np.where(has_hab_info, np.searchsorted(unq_habs, site_attrs['habitat']), -1)
 
-        sites_with_hab_info = get_costarica_site_info(all_f_dets)
+    # Group the files from sites with habitat info by site and day
+    f_site_ixs = det_store['file_site_ixs'].astype('int64')
+    f_day_nums = det_store['file_epochs'] // 86400
+    keep_f_ixs = np.where((site_hab_ixs[f_site_ixs] >= 0))[0]
 
-        all_fd_site_names = np.asarray([fd['site'] for fd in all_f_dets])
-        keep_fd_ixs = []
-        for s in sites_with_hab_info:
-            match_ixs = np.where((all_fd_site_names == s['name']))[0]
-            keep_fd_ixs.extend(match_ixs)
+    first_day_num = np.min(f_day_nums[keep_f_ixs], initial=0)
+    n_day_nums = np.max(f_day_nums[keep_f_ixs], initial=0) - first_day_num + 1
+    unq_site_day_keys, keep_f_site_day_ixs = np.unique(f_site_ixs[keep_f_ixs] * n_day_nums + f_day_nums[keep_f_ixs] - first_day_num, 
+                                                       return_inverse=True)
 
-        all_valid_fds = np.asarray(all_f_dets[keep_fd_ixs])
-        all_fd_sites = [d['site'] for d in all_valid_fds]
-        unq_sites = np.asarray([s['name'] for s in sites_with_hab_info])
-        unq_site_habitats = np.asarray([s['habitat'] for s in sites_with_hab_info])
+    site_day_n_files = np.bincount(keep_f_site_day_ixs, minlength=len(unq_site_day_keys))
+    site_day_site_ixs = unq_site_day_keys // n_day_nums
+    site_day_day_nums = unq_site_day_keys % n_day_nums + first_day_num
+    site_day_hab_ixs = site_hab_ixs[site_day_site_ixs]
 
-        unq_habs = np.unique(unq_site_habitats)
-        
-        hab_det_rates = []
-        hab_site_day_counts = []
-        for hab in unq_habs:
-            hab_site_day_det_rates = []
-            hab_num_site_days = 0
+    hab_n_sites = np.bincount(site_hab_ixs[site_hab_ixs >= 0], minlength=len(unq_habs))
+    hab_n_files = np.bincount(site_hab_ixs[f_site_ixs[keep_f_ixs]], minlength=len(unq_habs))
+    for hab, n_sites, n_files in zip(unq_habs, hab_n_sites, hab_n_files):
+        print('{}: {} sites, {} files'.format(hab, n_sites, n_files))
 
-            hab_site_names = unq_sites[np.where((unq_site_habitats == hab))[0]]
-            hab_match_fd_ixs = np.where((np.isin(all_fd_sites, hab_site_names)))[0]
-            hab_match_fds = all_valid_fds[hab_match_fd_ixs]
+    # Site-days ordered by habitat, then site name, then day
+    site_name_ranks = np.argsort(np.argsort(det_store['site_names']))
+    site_day_order = np.lexsort((site_day_day_nums, site_name_ranks[site_day_site_ixs], site_day_hab_ixs))
+    site_day_rank = np.empty(len(site_day_order), dtype='int64')
+    site_day_rank[site_day_order] = np.arange(len(site_day_order))
 
-            all_hab_sites = np.asarray([fd['site'] for fd in hab_match_fds])
-            unq_hab_sites = np.unique(all_hab_sites)
+    f_site_day_ranks = np.full(det_store['n_files'], -1, dtype='int64')
+    f_site_day_ranks[keep_f_ixs] = site_day_rank[keep_f_site_day_ixs]
+    table_specs = np.asarray(list(spec_opt_threshs.keys()))
+    spec_rows = get_spec_row_lookup(det_store['spec_names'], table_specs)
 
-            print('{}: {} sites, {} files'.format(hab, len(hab_site_names), len(hab_match_fds)))
+    part_counts = map_det_partitions(det_store, count_site_day_dets, (spec_opt_threshs, f_site_day_ranks, spec_rows, len(table_specs), 
+                                                                      len(site_day_order)), workers)
+    counts = np.sum(part_counts, axis=0)
 
-            for hab_site in unq_hab_sites:
-                hab_site_match_fds = hab_match_fds[all_hab_sites == hab_site]
+    return {'counts': counts.astype(get_min_uint_dtype(np.max(counts, initial=0))), 'spec_names': table_specs, 
+            'site_day_n_files': site_day_n_files[site_day_order], 'site_day_site_ixs': site_day_site_ixs[site_day_order],
+            'site_day_day_nums': site_day_day_nums[site_day_order], 'site_day_hab_ixs': site_day_hab_ixs[site_day_order],
+            'site_names': det_store['site_names'], 'hab_names': unq_habs, 'mins_per_f': ds['mins_per_f']}
 
-                all_hab_site_days = np.asarray([fd['dt'].strftime('%Y-%m-%d') for fd in hab_site_match_fds])
-                unq_hab_site_days = np.unique(all_hab_site_days)
 
-                for hab_day in unq_hab_site_days:
-                    hab_num_site_days += 1
+def get_spec_rates(hab_rates_table):
+    # Daily vocalisation rates (dets/min) of every species on every site-day
+    return hab_rates_table['counts'] / (hab_rates_table['site_day_n_files'] * hab_rates_table['mins_per_f'])
 
-                    hab_site_day_match_fds = hab_site_match_fds[all_hab_site_days == hab_day]
 
-                    num_dets = 0
-                    for fd in hab_site_day_match_fds:
-                        for d in fd['dets']:
-                            if d['common_name'] == target_spec and d['confidence'] > spec_opt_threshs[target_spec]:
-                                num_dets += 1
-                    
-                    hab_site_day_det_rates.append(num_dets / (len(hab_site_day_match_fds)*ds['mins_per_f']))
+def get_hab_det_rates(hab_rates_table, target_spec):
+    spec_row = np.where((hab_rates_table['spec_names'] == target_spec))[0][0]
+    spec_rates = hab_rates_table['counts'][spec_row] / (hab_rates_table['site_day_n_files'] * hab_rates_table['mins_per_f'])
 
-            hab_site_day_counts.append(hab_num_site_days)
-            hab_det_rates.append(hab_site_day_det_rates)
-        
-        hab_site_day_counts = np.asarray(hab_site_day_counts)
+    n_habs = len(hab_rates_table['hab_names'])
+    hab_det_rates = [list(spec_rates[hab_rates_table['site_day_hab_ixs'] == hab_ix]) for hab_ix in range(n_habs)]
+    hab_site_day_counts = np.bincount(hab_rates_table['site_day_hab_ixs'], minlength=n_habs)
 
-        with open(temp_fig_data_path, 'wb') as handle:
-            pickle.dump([hab_det_rates, unq_habs, hab_site_day_counts], handle)
+    return hab_det_rates, hab_rates_table['hab_names'].copy(), hab_site_day_counts
 
-    else:
-        with open(temp_fig_data_path, 'rb') as f_handle:
-            hab_det_rates, unq_habs, hab_site_day_counts = pickle.load(f_handle)
+
+def get_spec_hab_mean_rates(hab_rates_table):
+    # Mean daily vocalisation rate of every species in every habitat (species x habitats)
+    n_habs = len(hab_rates_table['hab_names'])
+    site_day_habs = np.zeros((len(hab_rates_table['site_day_hab_ixs']), n_habs))
+    site_day_habs[np.arange(len(site_day_habs)), hab_rates_table['site_day_hab_ixs']] = 1
+
+    return get_spec_rates(hab_rates_table) @ site_day_habs / np.maximum(np.sum(site_day_habs, axis=0), 1)
+
+
+def load_hab_rates_table(force_compute=False, workers=1):
+    ds = {'short_name': 'costa-rica', 'name': 'Costa Rica', 'mins_per_f': 1}
+
+    input_paths = get_ds_input_paths(ds['short_name']) + [COSTA_RICA_SITE_INFO_PATH]
+    return cached_compute('fig3_{}_hab_rates'.format(ds['short_name']), {}, input_paths, lambda: get_hab_rates_table(ds, workers), force_compute)
+
+
+def print_hab_preferences(min_dets=50, force_compute=False):
+    # Ranks every species with at least min_dets detections by how strongly it prefers its top habitat
+    hab_rates_table = load_hab_rates_table(force_compute)
+    hab_names = np.asarray(['Pasture' if h == 'Grassland' else h for h in hab_rates_table['hab_names']])
+
+    spec_hab_rates = get_spec_hab_mean_rates(hab_rates_table)
+    spec_n_dets = np.sum(hab_rates_table['counts'], axis=1)
+
+    spec_top_hab_ixs = np.argmax(spec_hab_rates, axis=1)
+    spec_top_rates = np.max(spec_hab_rates, axis=1)
+    spec_mean_rates = np.mean(spec_hab_rates, axis=1)
+
+    valid_spec_ixs = np.where((spec_n_dets >= min_dets))[0]
+    pref_ratios = spec_top_rates[valid_spec_ixs] / spec_mean_rates[valid_spec_ixs]
+    for s_ix in valid_spec_ixs[np.argsort(-pref_ratios)]:
+        print('{}: {} ({:.2f}x mean rate, {} dets)'.format(hab_rates_table['spec_names'][s_ix], hab_names[spec_top_hab_ixs[s_ix]],
+                                                          spec_top_rates[s_ix] / spec_mean_rates[s_ix], spec_n_dets[s_ix]))
+
+
+@profiled('costa-rica_do_plot')
+def do_plot(target_spec='Yellow-throated Toucan', force_compute=False, dataset=None):
+    # dataset optionally being the Costa Rica detection store already loaded with get_dataset
+    import matplotlib.pyplot as plt
+    if dataset is not None: use_dataset(dataset)
+
+    hab_rates_table = load_hab_rates_table(force_compute)
+    hab_det_rates, unq_habs, hab_site_day_counts = get_hab_det_rates(hab_rates_table, target_spec)
     
     # "Grasslands" in the dataframe should actually more accurately described as "Pastures" 
     for ix, u in enumerate(unq_habs):
@@ -108,7 +160,11 @@ def do_plot(target_spec='Yellow-throated Toucan', force_compute=False):
     plt.tight_layout()
 
 if __name__ == '__main__':
-    plt.figure(figsize=((8,4)))
-    do_plot()
-    plt.savefig(os.path.join('figs', 'fig_3_costa-rica_land_use.png'))   
-    plt.show()
\ No newline at end of file
+    if '--rank-specs' in sys.argv:
+        print_hab_preferences()
+    else:
+        import matplotlib.pyplot as plt
+        plt.figure(figsize=((8,4)))
+        do_plot()
+        plt.savefig(os.path.join('figs', 'fig_3_costa-rica_land_use.png'))   
+        plt.show()
\ No newline at end of file
@@ -1,76 +1,67 @@
 import os 
-import pickle
+import sys
 import numpy as np
-import matplotlib.pyplot as plt
-from utils import expand_to_valid_dets, get_opt_spec_bn_threshs
-from datetime import datetime, timedelta
+from utils import get_opt_spec_bn_threshs, get_dataset, use_dataset, build_spec_site_day_cube, get_cube_days, get_ds_input_paths, cached_compute
+from datetime import datetime
+from profiling import profiled
 
-def do_plot(chosen_spec = 'Willow Warbler'):
-    ds = {'short_name': 'norway', 'name': 'Norway', 'mins_per_f': 5}
+START_DT = datetime(year=2022, month=4, day=30)
+END_DT = datetime(year=2022, month=6, day=15)
 
+@profiled('norway_spec_site_day_cube')
+def get_spec_site_day_cube(ds, start_dt, end_dt):
     spec_opt_threshs, _, _, _ = get_opt_spec_bn_threshs(ds['short_name'])
-    bn_thresh = spec_opt_threshs[chosen_spec]
-    
-    start_dt = datetime(year=2022, month=4, day=30)
-    end_dt = datetime(year=2022, month=6, day=15)
 
-    comb_data_dir = 'combined_detection_data'
-    comb_dets_path = os.path.join(comb_data_dir, '{}_combined_dets_0-8_thresh.pickle'.format(ds['short_name']))
+    det_store = get_dataset(ds['short_name'])
+    return build_spec_site_day_cube(det_store, spec_opt_threshs, start_dt, end_dt, get_site_lat_groups(det_store['site_names']))
 
-    with open(comb_dets_path, 'rb') as f_handle:
-        all_f_dets = pickle.load(f_handle)
 
-    all_valid_dets = expand_to_valid_dets(all_f_dets, bn_thresh)
+def get_site_lat_groups(site_names):
+    # Sites are grouped by the second word of their name, as the panel has always drawn them
+    return np.asarray([s.split(' ')[1] for s in site_names], dtype='str')
 
-    all_valid_specs = np.asarray([d['common_name'] for d in all_valid_dets])
-    match_spec_dets_ixs = np.where((all_valid_specs == chosen_spec))[0]
-    chosen_spec_dets = [d for d in all_valid_dets[match_spec_dets_ixs] if start_dt <= d['det_dt'] <= end_dt]
-    chosen_spec_dets = np.asarray(chosen_spec_dets)
 
-    #all_det_sites = np.asarray([convert_norway_site_to_lat_group(d['lat'], d['site'].split(' ')[1]) for d in chosen_spec_dets])
-    all_det_sites = np.asarray([d['site'].split(' ')[1] for d in chosen_spec_dets])
-    all_det_sites_lats = np.asarray([d['lat'] for d in chosen_spec_dets])
+def get_site_day_dets_mat(cube, chosen_spec):
+    # Rows for the site groups where chosen_spec was detected, ordered north to south by the latitude of
+    # each group's first detection, each normalised by its busiest day
+    spec_ix = np.where((cube['spec_names'] == chosen_spec))[0][0]
+    spec_dets_mat = cube['counts'][spec_ix].astype('float64')
 
-    unq_sites, unq_site_ixs = np.unique(all_det_sites, return_index=True)
-    unq_site_lats = all_det_sites_lats[unq_site_ixs]
-    sort_ix = np.argsort(unq_site_lats)
-    unq_sites = unq_sites[sort_ix][::-1]
-    unq_site_lats = unq_site_lats[sort_ix][::-1]
-    
-    unq_days = []
-    day_dt = start_dt
-    while day_dt <= end_dt:
-        unq_days.append(day_dt)
-        day_dt += timedelta(days=1)
+    det_site_ixs = np.where((np.sum(spec_dets_mat, axis=1) > 0))[0]
+    sort_ix = np.argsort(cube['spec_site_lats'][spec_ix, det_site_ixs])[::-1]
+    det_site_ixs = det_site_ixs[sort_ix]
+
+    dets_mat = spec_dets_mat[det_site_ixs]
+    norm_dets_mat = dets_mat / np.max(dets_mat, axis=1, keepdims=True)
+    unq_site_lats = cube['spec_site_lats'][spec_ix, det_site_ixs]
 
-    dets_mat = np.empty((len(unq_sites), len(unq_days)))
+    return norm_dets_mat, unq_site_lats, get_cube_days(cube)
 
-    for site_ix, site in enumerate(unq_sites):
-        match_spec_site_det_ixs = np.where((all_det_sites == site))[0]
-        spec_site_dets = chosen_spec_dets[match_spec_site_det_ixs]
-        spec_site_days = np.asarray([d['det_dt'].strftime('%Y-%m-%d') for d in spec_site_dets])
 
-        cumulative_dets = 0
-        cumulative_occs = 0
-        for day_ix, day_dt in enumerate(unq_days):
-            match_site_spec_day_det_ixs = np.where((spec_site_days == day_dt.strftime('%Y-%m-%d')))[0]
-            
-            n_dets = len(match_site_spec_day_det_ixs)
-            occ = 0 if n_dets == 0 else 1 
-            cumulative_dets += n_dets
-            cumulative_occs += occ
+def get_spec_arrival_days(cube, min_dets=1):
+    # First day index at which each species reaches min_dets detections at each site (-1 if never), 
+    # for screening migration timing across every species in the cube
+    over_min = cube['counts'] >= min_dets
+    arrival_day_ixs = np.argmax(over_min, axis=2)
+    arrival_day_ixs[~np.any(over_min, axis=2)] = -1
 
-            dets_mat[site_ix, day_ix] = n_dets
+    return arrival_day_ixs
 
-    norm_dets_mat = []
-    for r_ix, det_row in enumerate(dets_mat):
-        norm_dets = det_row/np.max(det_row)
-        norm_dets_mat.append(norm_dets)
-        #plt.plot(r_ix + norm_dets, label='Relative vocal activity' if r_ix == 0 else None)
-    #plt.legend()
 
-    norm_dets_mat = np.asarray(norm_dets_mat)
+def load_spec_site_day_cube(ds, start_dt, end_dt, force_compute=False):
+    return cached_compute('fig3_{}_cube'.format(ds['short_name']), {'start_dt': start_dt, 'end_dt': end_dt, 'site_groups': 'lat_group'},
+                          get_ds_input_paths(ds['short_name']), lambda: get_spec_site_day_cube(ds, start_dt, end_dt), force_compute)
+
+
+@profiled('norway_do_plot')
+def do_plot(chosen_spec = 'Willow Warbler', force_compute=False, dataset=None):
+    # dataset optionally being the Norway detection store already loaded with get_dataset
+    import matplotlib.pyplot as plt
+    if dataset is not None: use_dataset(dataset)
+    ds = {'short_name': 'norway', 'name': 'Norway', 'mins_per_f': 5}
 
+    cube = load_spec_site_day_cube(ds, START_DT, END_DT, force_compute)
+    norm_dets_mat, unq_site_lats, unq_days = get_site_day_dets_mat(cube, chosen_spec)
 
     plt.matshow(norm_dets_mat, aspect='auto', fignum=0, cmap='Blues')
     plt.colorbar(label='Daily vocal activity', pad=0.022, fraction=0.07)
@@ -94,8 +85,31 @@ def do_plot(chosen_spec = 'Willow Warbler'):
     plt.tight_layout()
 
 
+def print_arrival_summary(min_sites=3, force_compute=False):
+    # All species mode: median arrival date over sites and how arrival shifts with latitude
+    ds = {'short_name': 'norway', 'name': 'Norway', 'mins_per_f': 5}
+
+    cube = load_spec_site_day_cube(ds, START_DT, END_DT, force_compute)
+    arrival_day_ixs = get_spec_arrival_days(cube)
+    cube_days = get_cube_days(cube)
+
+    for spec_ix, spec in enumerate(cube['spec_names']):
+        arr_site_ixs = np.where((arrival_day_ixs[spec_ix] >= 0))[0]
+        if len(arr_site_ixs) < min_sites: continue
+
+        spec_arr_days = arrival_day_ixs[spec_ix, arr_site_ixs]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            lat_corr = np.corrcoef(cube['spec_site_lats'][spec_ix, arr_site_ixs], spec_arr_days)[0, 1]
+        print('{}: {} sites, median arrival {}, latitude corr {:.2f}'.format(spec, len(arr_site_ixs), 
+              cube_days[int(np.median(spec_arr_days))].strftime('%d %B'), lat_corr))
+
+
 if __name__ == '__main__':
-    plt.figure(figsize=((16,4)))
-    do_plot()
-    plt.savefig(os.path.join('figs', 'fig_3_norway_species_arrival_time.png'))   
-    plt.show()
\ No newline at end of file
+    if '--all-specs' in sys.argv:
+        print_arrival_summary()
+    else:
+        import matplotlib.pyplot as plt
+        plt.figure(figsize=((16,4)))
+        do_plot()
+        plt.savefig(os.path.join('figs', 'fig_3_norway_species_arrival_time.png'))   
+        plt.show()
\ No newline at end of file
@@ -1,64 +1,45 @@
 import os 
-import pickle
 import numpy as np
-import matplotlib.pyplot as plt
-from utils import expand_to_valid_dets, get_opt_spec_bn_threshs
-from scipy.spatial.distance import pdist
-from scipy.cluster.hierarchy import linkage, dendrogram
-from scipy.signal import convolve2d
+from utils import (get_opt_spec_bn_threshs, load_agg_cubes, rollup_agg_cube, get_agg_cube_day_nums, day_nums_to_strs, 
+                   get_ds_input_paths, cached_compute, use_dataset)
 from datetime import datetime
+from profiling import profiled
 
-def do_plot(spec_prec_thresh=0.9, min_dets_per_spec=20, force_compute=False):
-    ds = {'short_name': 'taiwan', 'name': 'Taiwan', 'mins_per_f': 5}
-
-    temp_fig_data_path = os.path.join('temp_fig_data', 'fig3_{}.pickle'.format(ds['short_name']))
-
-    if not os.path.exists(temp_fig_data_path) or force_compute:
+@profiled('taiwan_dets_mat', n_items=lambda res: res[0].size)
+def get_dets_mat(ds, spec_prec_thresh, min_dets_per_spec):
+    spec_opt_threshs, spec_precisions, _, num_valid_spec_dets = get_opt_spec_bn_threshs(ds['short_name'])
+    specs = np.asarray(list(spec_opt_threshs.keys()))
+    allowed_specs = specs[(spec_precisions >= spec_prec_thresh) & (num_valid_spec_dets >= min_dets_per_spec)]
 
-        comb_data_dir = 'combined_detection_data'
-        comb_dets_path = os.path.join(comb_data_dir, '{}_combined_dets_0-8_thresh.pickle'.format(ds['short_name']))
+    print('Building detections matrix')
+    cube = load_agg_cubes(ds['short_name'])['calibrated']
+    spec_day_counts = rollup_agg_cube(cube, ('spec', 'day'), spec_names=allowed_specs)
 
-        spec_opt_threshs, spec_precisions, _, num_valid_spec_dets = get_opt_spec_bn_threshs(ds['short_name'])
-        specs = np.asarray(list(spec_opt_threshs.keys()))
-        allowed_specs = specs[(spec_precisions >= spec_prec_thresh) & (num_valid_spec_dets >= min_dets_per_spec)]
+    det_day_ixs = np.where((np.sum(spec_day_counts, axis=0) > 0))[0]
+    unq_days = list(day_nums_to_strs(get_agg_cube_day_nums(cube)[det_day_ixs]))
+    dets_mat = (spec_day_counts[:, det_day_ixs] > 0).astype('float64')
 
-        print('Loading detections')
-        with open(comb_dets_path, 'rb') as f_handle:
-            all_f_dets = pickle.load(f_handle)
-        all_dets = expand_to_valid_dets(all_f_dets)
+    return dets_mat, unq_days, allowed_specs
 
-        print('Applying species specific optimal thresholds')
-        all_valid_dets = []
-        for det in all_dets:
-            if det['common_name'] in allowed_specs and det['confidence'] > spec_opt_threshs[det['common_name']]:
-                all_valid_dets.append(det)
 
-        all_valid_specs = np.asarray([d['common_name'] for d in all_valid_dets])
-
-        all_det_dts = np.asarray([d['det_dt'] for d in all_valid_dets])
-        all_det_days = np.asarray([dt.strftime('%Y-%m-%d') for dt in all_det_dts])
-        unq_days = np.unique(all_det_days)
-        unq_days = sorted(unq_days)
-
-        print('Building detections matrix')
-        dets_mat = np.empty((len(allowed_specs), len(unq_days)))
-        for spec_ix, spec in enumerate(allowed_specs):
-            match_spec_ixs = np.where((all_valid_specs == spec))[0]
-            
-            for day_ix, day in enumerate(unq_days):
-                match_site_ixs = np.where((all_det_days == day))[0]
-                match_det_ixs = np.intersect1d(match_spec_ixs, match_site_ixs)
+def load_dets_mat(spec_prec_thresh=0.9, min_dets_per_spec=20, force_compute=False):
+    ds = {'short_name': 'taiwan', 'name': 'Taiwan', 'mins_per_f': 5}
 
-                val = 1 if len(match_det_ixs) > 0 else 0
-                dets_mat[spec_ix, day_ix] = val
+    return cached_compute('fig3_{}'.format(ds['short_name']), {'spec_prec_thresh': spec_prec_thresh, 'min_dets_per_spec': min_dets_per_spec},
+                          get_ds_input_paths(ds['short_name']), lambda: get_dets_mat(ds, spec_prec_thresh, min_dets_per_spec), force_compute)
 
-        with open(temp_fig_data_path, 'wb') as handle:
-            pickle.dump([dets_mat, unq_days, allowed_specs], handle)
 
-    else:
-        with open(temp_fig_data_path, 'rb') as f_handle:
-            dets_mat, unq_days, allowed_specs = pickle.load(f_handle)
+@profiled('taiwan_do_plot')
+def do_plot(spec_prec_thresh=0.9, min_dets_per_spec=20, force_compute=False, dataset=None):
+    # The plotting stack and scipy are only imported once something is drawn. dataset is optionally the Taiwan 
+    # detection store already loaded with get_dataset
+    import matplotlib.pyplot as plt
+    if dataset is not None: use_dataset(dataset)
+    from scipy.spatial.distance import pdist
+    from scipy.cluster.hierarchy import linkage, dendrogram
+    from scipy.signal import convolve2d
 
+    dets_mat, unq_days, allowed_specs = load_dets_mat(spec_prec_thresh, min_dets_per_spec, force_compute)
 
     row_clusters = linkage(pdist(dets_mat, metric='euclidean'), method='complete')
     row_dendr = dendrogram(row_clusters, no_plot=True)
@@ -78,6 +59,7 @@ def do_plot(spec_prec_thresh=0.9, min_dets_per_spec=20, force_compute=False):
 
     unq_days_labs = []
     tick_ixs = []
+    new_year_line_ix = None
     for d_ix, d in enumerate(unq_days):
         dt = datetime.strptime(d, '%Y-%m-%d')
         if dt.day == 1 and dt.month == 1:
@@ -91,7 +73,7 @@ def do_plot(spec_prec_thresh=0.9, min_dets_per_spec=20, force_compute=False):
             new_year_line_ix = d_ix
 
     plt.xticks(tick_ixs, unq_days_labs, ha='center', rotation=0)
-    plt.axvline(x=new_year_line_ix, c='k', ls='--')
+    if new_year_line_ix is not None: plt.axvline(x=new_year_line_ix, c='k', ls='--')
 
     plt.gca().tick_params(bottom=True, top=False, left=True, right=False)
     plt.gca().tick_params(labelbottom=True, labeltop=False, labelleft=True, labelright=False)
@@ -100,6 +82,7 @@ def do_plot(spec_prec_thresh=0.9, min_dets_per_spec=20, force_compute=False):
     
 
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
     plt.figure(figsize=((16,6)))
     do_plot()
     plt.savefig(os.path.join('figs', 'fig_3_taiwan_seasonal.png'))
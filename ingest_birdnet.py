@@ -0,0 +1,242 @@
+import os
+import re
+import csv
+import time
+import shutil
+import argparse
+from datetime import datetime
+from profiling import stage
+from utils import (f_dets_to_det_store, append_det_store_chunk, write_det_store_meta, merge_det_store_counts, truncate_det_store,
+                   read_det_store_meta, det_store_from_meta, get_det_store_dir, get_datasets_dict, get_tz, dt_to_epoch, EPOCH_DT,
+                   EPOCH_DT_UTC)
+
+MIN_DET_CONF = 0.8
+DEFAULT_CHUNK_SIZE = 1000000
+
+# Column names used by the BirdNET output formats (BirdNET-Analyzer csv, Raven selection tables and
+# the older semicolon separated BirdNET-Lite csv)
+BIRDNET_COLUMNS = {'start_time': ['Start (s)', 'Begin Time (s)'],
+                   'common_name': ['Common name', 'Common Name'],
+                   'confidence': ['Confidence']}
+BIRDNET_RESULT_SUFFIXES = ('.BirdNET.results.csv', '.BirdNET.selection.table.txt', '.BirdNET.csv', '.BirdNET.txt')
+
+AUDIOMOTH_DT_RE = re.compile(r'(\d{8})_(\d{6})')
+
+# Source ids of every ingested result file, one per line, kept alongside the store columns
+INGESTED_FILES_LIST = 'ingested_files.txt'
+
+
+def iter_birdnet_result_paths(results_dir, suffixes=BIRDNET_RESULT_SUFFIXES):
+    for root, dirs, files in os.walk(results_dir):
+        dirs.sort()
+        for f in sorted(files):
+            if f.endswith(suffixes): yield os.path.join(root, f)
+
+
+def iter_birdnet_dets(result_path, min_conf=MIN_DET_CONF):
+    with open(result_path, newline='') as f_handle:
+        header = f_handle.readline()
+        delimiter = '\t' if '\t' in header else ';' if ';' in header else ','
+        header = [h.strip() for h in header.strip().split(delimiter)]
+
+        col_ixs = {}
+        for k, col_names in BIRDNET_COLUMNS.items():
+            col_ixs[k] = [header.index(c) for c in col_names if c in header][0]
+        view_ix = header.index('View') if 'View' in header else None
+
+        for row in csv.reader(f_handle, delimiter=delimiter):
+            if len(row) < len(header): continue
+            # Raven tables can repeat each selection for the waveform view
+            if view_ix is not None and row[view_ix].startswith('Waveform'): continue
+
+            conf = float(row[col_ixs['confidence']])
+            if conf < min_conf: continue
+
+            common_name = row[col_ixs['common_name']].strip()
+            if common_name.lower() == 'nocall': continue
+
+            yield {'common_name': common_name, 'confidence': conf, 'start_time': float(row[col_ixs['start_time']])}
+
+
+def localize_dt(dt, tz):
+    tz = get_tz(tz)
+    return tz.localize(dt) if hasattr(tz, 'localize') else dt.replace(tzinfo=tz)
+
+
+def get_audiomoth_file_meta(result_path, results_dir, site_lat_longs=None, f_len_mins=None, tz=None):
+    # Sites are the top level directories of results_dir, and recording times come from AudioMoth style
+    # YYYYMMDD_HHMMSS file names. Files without a parseable time keep the 1970 placeholder date
+    # that the analyses already filter out. With tz (as get_tz takes it) the file name times are taken
+    # to be in tz and made tz aware, for stores holding tz aware times
+    rel_path = os.path.relpath(result_path, results_dir)
+    site = rel_path.split(os.sep)[0] if os.sep in rel_path else os.path.basename(os.path.normpath(results_dir))
+
+    dt_match = AUDIOMOTH_DT_RE.search(os.path.basename(result_path))
+    if dt_match: dt = datetime.strptime(''.join(dt_match.groups()), '%Y%m%d%H%M%S')
+    else: dt = EPOCH_DT
+    if tz is not None: dt = EPOCH_DT_UTC if dt == EPOCH_DT else localize_dt(dt, tz)
+
+    f_meta = {'site': site, 'dt': dt, 'src_id': rel_path}
+    if site_lat_longs is not None and site in site_lat_longs.keys():
+        f_meta['lat'], f_meta['long'] = site_lat_longs[site]
+    if f_len_mins is not None:
+        f_meta['f_len_mins'] = f_len_mins
+
+    return f_meta
+
+
+def read_site_lat_longs(site_info_csv_path):
+    site_lat_longs = {}
+    with open(site_info_csv_path, newline='') as csvfile:
+        for row in csv.DictReader(csvfile):
+            site_lat_longs[row['site']] = (float(row['lat']), float(row['long']))
+
+    return site_lat_longs
+
+
+def iter_f_dets(result_paths, get_file_meta, min_conf=MIN_DET_CONF):
+    # Per-file dicts in the combined detections format, built one result file at a time
+    for result_path in result_paths:
+        f_dets = get_file_meta(result_path)
+        if f_dets is None: continue
+
+        f_dets['dets'] = list(iter_birdnet_dets(result_path, min_conf))
+        yield f_dets
+
+
+def iter_f_dets_chunks(all_f_dets, chunk_size=DEFAULT_CHUNK_SIZE):
+    # Groups whole files into chunks of roughly chunk_size detections (or files, for files without any)
+    chunk = []
+    chunk_n_rows = 0
+    for f_dets in all_f_dets:
+        chunk.append(f_dets)
+        chunk_n_rows += max(len(f_dets['dets']), 1)
+
+        if chunk_n_rows >= chunk_size:
+            yield chunk
+            chunk = []
+            chunk_n_rows = 0
+
+    if len(chunk) > 0: yield chunk
+
+
+def write_f_dets_chunks(all_f_dets, store_dir, det_store, chunk_size=DEFAULT_CHUNK_SIZE):
+    # Appends per-file dicts to the store in store_dir chunk by chunk. det_store holds the store's names and 
+    # counts, which are updated (and committed to meta.json) after every chunk
+    ingested_list_path = os.path.join(store_dir, INGESTED_FILES_LIST)
+    n_start_dets = det_store['n_dets']
+    start_t = time.time()
+
+    for chunk in iter_f_dets_chunks(all_f_dets, chunk_size):
+        with stage('ingest_chunk') as stage_rec:
+            det_store_chunk = f_dets_to_det_store(chunk, det_store['spec_names'], det_store['site_names'], det_store['n_files'])
+            append_det_store_chunk(det_store_chunk, store_dir)
+            merge_det_store_counts(det_store, det_store_chunk)
+
+            with open(ingested_list_path, 'ab') as f_handle:
+                f_handle.write(''.join(['{}\n'.format(f_dets.get('src_id', '')) for f_dets in chunk]).encode('utf-8'))
+                det_store['ingested_files_nbytes'] = f_handle.tell()
+            write_det_store_meta(det_store, store_dir)
+            stage_rec['n_items'] = det_store_chunk['n_dets']
+
+        elapsed_t = time.time() - start_t
+        print('{} files, {} detections ingested ({} rows/s)'.format(f'{det_store["n_files"]:,}', f'{det_store["n_dets"]:,}',
+                                                                    f'{int((det_store["n_dets"] - n_start_dets) / max(elapsed_t, 1e-9)):,}'))
+
+    elapsed_t = time.time() - start_t
+    return {'n_files': det_store['n_files'], 'n_dets': det_store['n_dets'], 'n_new_dets': det_store['n_dets'] - n_start_dets,
+            'secs': elapsed_t, 'rows_per_sec': (det_store['n_dets'] - n_start_dets) / max(elapsed_t, 1e-9)}
+
+
+def write_f_dets_to_det_store(all_f_dets, store_dir, chunk_size=DEFAULT_CHUNK_SIZE):
+    # Streams per-file dicts into a new detection store so only one chunk is held in memory at a time.
+    # The store is assembled next to store_dir and only swapped in once complete
+    tmp_store_dir = '{}.tmp'.format(os.path.normpath(store_dir))
+    if os.path.exists(tmp_store_dir): shutil.rmtree(tmp_store_dir)
+
+    det_store = f_dets_to_det_store([])
+    append_det_store_chunk(det_store, tmp_store_dir)
+    write_det_store_meta(det_store, tmp_store_dir)
+
+    ingest_stats = write_f_dets_chunks(all_f_dets, tmp_store_dir, det_store, chunk_size)
+
+    if os.path.exists(store_dir): shutil.rmtree(store_dir)
+    os.rename(tmp_store_dir, store_dir)
+
+    return ingest_stats
+
+
+def read_ingested_src_ids(store_dir, ingested_files_nbytes):
+    ingested_list_path = os.path.join(store_dir, INGESTED_FILES_LIST)
+    if not os.path.exists(ingested_list_path): return set()
+
+    with open(ingested_list_path, 'rb') as f_handle:
+        return set(f_handle.read(ingested_files_nbytes).decode('utf-8').splitlines())
+
+
+def append_f_dets_to_det_store(all_f_dets, store_dir, chunk_size=DEFAULT_CHUNK_SIZE):
+    # Appends to an existing store in place, anything written by an interrupted earlier append is dropped first
+    det_store = det_store_from_meta(read_det_store_meta(store_dir))
+    truncate_det_store(store_dir, det_store['n_files'], det_store['n_dets'])
+
+    ingested_list_path = os.path.join(store_dir, INGESTED_FILES_LIST)
+    if os.path.exists(ingested_list_path): os.truncate(ingested_list_path, det_store['ingested_files_nbytes'])
+
+    return write_f_dets_chunks(all_f_dets, store_dir, det_store, chunk_size)
+
+
+def get_new_file_meta_filter(store_dir, get_file_meta):
+    # Wraps get_file_meta so result files already ingested, or not newer than their site's latest 
+    # recording in the store, are skipped before they are read. Files with the placeholder date are
+    # only skipped if already ingested, as they can't be placed against the watermark
+    meta = read_det_store_meta(store_dir)
+    ingested_src_ids = read_ingested_src_ids(store_dir, meta['ingested_files_nbytes'])
+    site_watermarks = dict(zip(meta['site_names'], meta['site_watermarks']))
+
+    def get_new_file_meta(result_path):
+        f_meta = get_file_meta(result_path)
+        if f_meta.get('src_id') in ingested_src_ids: return None
+        if f_meta['dt'] in [EPOCH_DT, EPOCH_DT_UTC]: return f_meta
+        if f_meta['site'] in site_watermarks.keys() and dt_to_epoch(f_meta['dt']) <= site_watermarks[f_meta['site']]: return None
+        return f_meta
+
+    return get_new_file_meta
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build (or append to) a dataset detection store from raw BirdNET result files')
+    parser.add_argument('results_dir', help='Directory of BirdNET result files, one sub-directory per site')
+    parser.add_argument('ds_short_name', help='Short name of the dataset to write, e.g. norway')
+    parser.add_argument('--site-info', default=None, help='CSV with site, lat and long columns')
+    parser.add_argument('--mins-per-f', type=float, default=None, help='Recording length of each file in minutes')
+    parser.add_argument('--min-conf', type=float, default=MIN_DET_CONF, help='Detections below this confidence are dropped')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Detections held in memory per write')
+    parser.add_argument('--append', action='store_true', help='Only add result files newer than each site\'s latest recording in the store')
+    parser.add_argument('--tz', default=None, help='Time zone of the file name times (tz database name or UTC offset in hours), making the '
+                                                   'stored times tz aware. Appends to a tz aware store default to the dataset\'s tz')
+    args = parser.parse_args()
+
+    store_dir = get_det_store_dir(args.ds_short_name)
+    tz = args.tz
+    try: tz = float(tz)
+    except (TypeError, ValueError): pass
+    if tz is None and args.append and read_det_store_meta(store_dir)['tz_aware']:
+        ds_tzs = {ds['short_name']: ds.get('tz') for ds in get_datasets_dict()}
+        if ds_tzs.get(args.ds_short_name) is None:
+            raise ValueError('The {} store holds tz aware times, so --tz is needed to append to it'.format(args.ds_short_name))
+        tz = ds_tzs[args.ds_short_name]
+
+    site_lat_longs = read_site_lat_longs(args.site_info) if args.site_info is not None else None
+    get_file_meta = lambda p: get_audiomoth_file_meta(p, args.results_dir, site_lat_longs, args.mins_per_f, tz)
+
+    result_paths = iter_birdnet_result_paths(args.results_dir)
+
+    if args.append:
+        get_file_meta = get_new_file_meta_filter(store_dir, get_file_meta)
+        ingest_stats = append_f_dets_to_det_store(iter_f_dets(result_paths, get_file_meta, args.min_conf), store_dir, args.chunk_size)
+    else:
+        ingest_stats = write_f_dets_to_det_store(iter_f_dets(result_paths, get_file_meta, args.min_conf), store_dir, args.chunk_size)
+
+    print('Done: {} new detections in {:.1f}s ({} rows/s), store now has {} files and {} detections'.format(
+          f'{ingest_stats["n_new_dets"]:,}', ingest_stats['secs'], f'{int(ingest_stats["rows_per_sec"]):,}',
+          f'{ingest_stats["n_files"]:,}', f'{ingest_stats["n_dets"]:,}'))
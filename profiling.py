@@ -0,0 +1,117 @@
+import os
+import csv
+import json
+import time
+import functools
+from contextlib import contextmanager
+from datetime import datetime
+
+# Set BIRD_PROFILE to a report path (.jsonl or .csv, or 1 for profile_report.jsonl) to record stages. When it
+# isn't set, profiled() hands back the undecorated function and stage() a do-nothing context manager
+PROFILE_PATH = os.environ.get('BIRD_PROFILE', '')
+if PROFILE_PATH == '1': PROFILE_PATH = 'profile_report.jsonl'
+PROFILE_FIELDS = ['started', 'pid', 'stage', 'path', 'wall_secs', 'cpu_secs', 'peak_rss_mb', 'rss_mb', 'n_items', 'info']
+
+_stage_stack = []
+
+
+def read_rss_kbs():
+    # Current and peak resident set size (kB), from /proc on Linux, otherwise getrusage's lifetime peak only
+    try:
+        with open('/proc/self/status', 'r') as f_handle:
+            status = dict([l.split(':', 1) for l in f_handle.read().splitlines() if ':' in l])
+        return int(status['VmRSS'].split()[0]), int(status['VmHWM'].split()[0])
+    except (OSError, KeyError, ValueError):
+        pass
+
+    try:
+        import resource
+        import sys
+        peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin': peak_kb = peak_kb // 1024
+        return None, peak_kb
+    except ImportError:
+        return None, None
+
+
+def reset_peak_rss():
+    # Resets the kernel's peak RSS so it covers just the stage being entered (Linux only)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f_handle:
+            f_handle.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def write_stage_record(rec):
+    is_csv = PROFILE_PATH.endswith('.csv')
+    with open(PROFILE_PATH, 'a', newline='') as f_handle:
+        if is_csv:
+            writer = csv.DictWriter(f_handle, fieldnames=PROFILE_FIELDS)
+            if f_handle.tell() == 0: writer.writeheader()
+            writer.writerow(rec)
+        else:
+            f_handle.write(json.dumps(rec) + '\n')
+
+
+def max_kb(a, b):
+    if a is None: return b
+    if b is None: return a
+    return max(a, b)
+
+
+@contextmanager
+def _profiled_stage(name, n_items=None):
+    # Nested stages are recorded with their full path, and a parent's peak RSS takes in its children's
+    if len(_stage_stack) > 0: _stage_stack[-1]['peak_kb'] = max_kb(_stage_stack[-1]['peak_kb'], read_rss_kbs()[1])
+    peak_is_reset = reset_peak_rss()
+
+    rec = {'started': datetime.now().isoformat(timespec='milliseconds'), 'pid': os.getpid(), 'stage': name,
+           'path': '/'.join([s['rec']['stage'] for s in _stage_stack] + [name]), 'n_items': n_items, 'info': None}
+    stack_entry = {'rec': rec, 'peak_kb': None if peak_is_reset else read_rss_kbs()[1]}
+    _stage_stack.append(stack_entry)
+
+    start_wall_t = time.perf_counter()
+    start_cpu_t = time.process_time()
+    try:
+        yield rec
+    finally:
+        rec['wall_secs'] = time.perf_counter() - start_wall_t
+        rec['cpu_secs'] = time.process_time() - start_cpu_t
+        _stage_stack.pop()
+
+        rss_kb, peak_kb = read_rss_kbs()
+        peak_kb = max_kb(stack_entry['peak_kb'], peak_kb)
+        if len(_stage_stack) > 0: _stage_stack[-1]['peak_kb'] = max_kb(_stage_stack[-1]['peak_kb'], peak_kb)
+
+        rec['rss_mb'] = None if rss_kb is None else rss_kb / 1024
+        rec['peak_rss_mb'] = None if peak_kb is None else peak_kb / 1024
+        write_stage_record(rec)
+
+
+class _NullStage:
+    def __enter__(self): return {}
+    def __exit__(self, *exc_info): return False
+
+
+def stage(name, n_items=None):
+    # Usage: with stage('expand', n_dets) as rec: ... the yielded record's n_items/info can be filled in late
+    if not PROFILE_PATH: return _NullStage()
+    return _profiled_stage(name, n_items)
+
+
+def profiled(name=None, n_items=None):
+    # Decorator version of stage(), n_items optionally being a function of the return value
+    def decorator(fn):
+        if not PROFILE_PATH: return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with _profiled_stage(name or fn.__name__) as rec:
+                res = fn(*args, **kwargs)
+                if n_items is not None: rec['n_items'] = n_items(res)
+                return res
+        return wrapper
+
+    return decorator
@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import time
+import pickle
+import argparse
+import platform
+import subprocess
+import tracemalloc
+import numpy as np
+from datetime import datetime
+from utils import (get_datasets_dict, load_det_store, build_det_store, expand_to_valid_dets, compute_opt_spec_bn_threshs, compute_agg_cubes,
+                   compute_opt_spec_prec_cis, get_opt_spec_bn_threshs, load_agg_cubes, evict_dataset, get_comb_dets_path, DET_STORE_COLUMNS,
+                   BOOT_BLOCK_BYTES)
+from synthetic_data import write_synth_dataset, link_auxiliary_data, SYNTH_DATASETS
+import fig_3
+import fig_3_brazil_diurnal
+import fig_3_costarica_land_use_activity
+import fig_3_norway_species_latitudinal
+import fig_3_taiwan_seasonal
+
+DEFAULT_SIZES = [1e5, 1e6]
+MAX_PICKLE_DETS = 1e6
+REGRESSION_TOL = 1.25
+# Slowdowns smaller than this are treated as timing noise
+MIN_REGRESSION_SECS = 0.05
+# Peak memory (MB) a stage must stay under whatever the sizes, failing the run otherwise. Bootstrap CIs are
+# worked out in threshold blocks of about BOOT_BLOCK_BYTES, leaving the same again for the clips and draws
+STAGE_MAX_PEAK_MB = {'calib_cis': 2 * BOOT_BLOCK_BYTES / 1024**2}
+
+# Each panel's aggregation step, run with the calibration and aggregate cube caches already warm
+PANEL_AGGS = {'brazil': lambda ds, workers: fig_3_brazil_diurnal.get_hourly_activity(ds, 0.9, 20),
+              'costa-rica': lambda ds, workers: fig_3_costarica_land_use_activity.get_hab_rates_table(ds, workers),
+              'norway': lambda ds, workers: fig_3_norway_species_latitudinal.get_spec_site_day_cube(ds, fig_3_norway_species_latitudinal.START_DT,
+                                                                                                    fig_3_norway_species_latitudinal.END_DT),
+              'taiwan': lambda ds, workers: fig_3_taiwan_seasonal.get_dets_mat(ds, 0.9, 20)}
+
+
+def render_panel(ds_short_name):
+    # Draws and saves the panel off screen, as the figures are when built
+    import matplotlib
+    matplotlib.use('Agg')
+    fig_3.make_fig_3_panel(ds_short_name, 'figs')
+
+
+def run_stage(stage_fn, track_mem=True):
+    # Wall time of one run, then (optionally) a second run under tracemalloc for the peak of memory
+    # allocated during the stage, kept separate so tracing overhead doesn't skew the timings. Both runs start
+    # without any datasets loaded, so neither reuses the other's
+    evict_dataset()
+    start_t = time.perf_counter()
+    res = stage_fn()
+    secs = time.perf_counter() - start_t
+
+    peak_mb = None
+    if track_mem:
+        evict_dataset()
+        tracemalloc.start()
+        stage_fn()
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1024**2
+        tracemalloc.stop()
+
+    return res, secs, peak_mb
+
+
+def load_all_columns(ds_short_name):
+    # Memory-mapped columns are only read when touched, so copy them in to time the actual read
+    det_store = load_det_store(ds_short_name)
+    for c in DET_STORE_COLUMNS.keys(): det_store[c] = np.array(det_store[c])
+    return det_store
+
+
+def load_pickle(ds_short_name):
+    with open(get_comb_dets_path(ds_short_name), 'rb') as f_handle:
+        return pickle.load(f_handle)
+
+
+def bench_dataset(ds, n_dets, args):
+    ds_short_name = ds['short_name']
+    write_pickle = n_dets <= args.max_pickle_dets
+    stage_fns = []
+
+    stage_fns.append(('generate', lambda: write_synth_dataset(ds_short_name, n_dets, args.n_sites, args.n_specs, args.dets_per_f,
+                                                              args.n_clips, write_pickle, seed=args.seed), n_dets))
+    if write_pickle:
+        stage_fns.append(('pickle_load', lambda: load_pickle(ds_short_name), n_dets))
+        stage_fns.append(('build_store', lambda: build_det_store(ds_short_name), n_dets))
+    stage_fns.append(('load', lambda: load_all_columns(ds_short_name), n_dets))
+    stage_fns.append(('expand', lambda: expand_to_valid_dets(load_det_store(ds_short_name), 0.8), n_dets))
+    stage_fns.append(('calibrate', lambda: compute_opt_spec_bn_threshs(ds_short_name, workers=args.workers), args.n_clips))
+    stage_fns.append(('calib_cis', lambda: compute_opt_spec_prec_cis(ds_short_name, thresh_step=args.ci_thresh_step, n_boot=args.n_boot,
+                                                                     workers=args.workers), args.n_clips))
+    stage_fns.append(('agg_cubes', lambda: compute_agg_cubes(ds_short_name, ds.get('tz'), args.workers), n_dets))
+    stage_fns.append(('panel', lambda: PANEL_AGGS[ds_short_name](ds, args.workers), n_dets))
+    stage_fns.append(('render', lambda: render_panel(ds_short_name), n_dets))
+
+    results = []
+    for stage, stage_fn, n_items in stage_fns:
+        if stage in ['panel', 'render']:
+            get_opt_spec_bn_threshs(ds_short_name)
+            load_agg_cubes(ds_short_name, ds.get('tz'))
+
+        # Generation is only run once, it isn't what's being measured
+        _, secs, peak_mb = run_stage(stage_fn, args.mem and stage != 'generate')
+        over_budget = peak_mb is not None and peak_mb > STAGE_MAX_PEAK_MB.get(stage, np.inf)
+        results.append({'n_dets': n_dets, 'ds': ds_short_name, 'stage': stage, 'secs': secs, 'peak_mb': peak_mb,
+                        'items_per_sec': n_items / max(secs, 1e-9), 'over_budget': bool(over_budget)})
+
+        print('{}{} {} {}: {:.3f}s{}'.format('OVER BUDGET ' if over_budget else '', f'{n_dets:,}', ds_short_name, stage, secs,
+                                             '' if peak_mb is None else ', {:.1f} MB peak'.format(peak_mb)))
+
+    return results
+
+
+def get_git_rev():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def compare_results(prev_results, results, tol=REGRESSION_TOL):
+    # Stages that got more than tol times slower (or hungrier) than in prev_results
+    prev_lookup = {(r['n_dets'], r['ds'], r['stage']): r for r in prev_results}
+
+    n_regressions = 0
+    for r in results:
+        prev_r = prev_lookup.get((r['n_dets'], r['ds'], r['stage']))
+        if prev_r is None: continue
+
+        secs_ratio = r['secs'] / max(prev_r['secs'], 1e-9)
+        mem_ratio = r['peak_mb'] / max(prev_r['peak_mb'], 1e-9) if r['peak_mb'] is not None and prev_r['peak_mb'] is not None else None
+        regressed = (secs_ratio > tol and r['secs'] - prev_r['secs'] > MIN_REGRESSION_SECS) or (mem_ratio is not None and mem_ratio > tol)
+        n_regressions += regressed
+
+        print('{}{} {} {}: {:.3f}s -> {:.3f}s ({:.2f}x){}'.format('REGRESSION ' if regressed else '', f'{r["n_dets"]:,}', r['ds'], r['stage'],
+                                                                prev_r['secs'], r['secs'], secs_ratio,
+                                                                '' if mem_ratio is None else ', peak {:.2f}x'.format(mem_ratio)))
+
+    return n_regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time and memory profile each pipeline stage on synthetic datasets')
+    parser.add_argument('--out-dir', default='bench_data', help='Scratch directory the synthetic datasets are written to')
+    parser.add_argument('--sizes', type=float, nargs='+', default=DEFAULT_SIZES, help='Detections per dataset, e.g. 1e5 1e6 1e7')
+    parser.add_argument('--datasets', nargs='+', default=list(SYNTH_DATASETS.keys()), choices=list(SYNTH_DATASETS.keys()))
+    parser.add_argument('--n-sites', type=int, default=20)
+    parser.add_argument('--n-specs', type=int, default=100)
+    parser.add_argument('--dets-per-f', type=int, default=5)
+    parser.add_argument('--n-clips', type=int, default=2000)
+    parser.add_argument('--n-boot', type=int, default=10000, help='Bootstrap replicates for the calib_cis stage')
+    parser.add_argument('--ci-thresh-step', default='exact', type=lambda s: s if s == 'exact' else float(s),
+                        help='Threshold grid for the calib_cis stage, a step or exact (every distinct clip confidence)')
+    parser.add_argument('--max-pickle-dets', type=float, default=MAX_PICKLE_DETS,
+                        help='Larger sizes are written straight to the detection store, skipping the pickle stages')
+    parser.add_argument('--no-mem', dest='mem', action='store_false', help='Skip the tracemalloc runs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes the partitioned aggregations are spread over')
+    parser.add_argument('--results', default=None, help='Where to save the results json (default: in out-dir, by start time)')
+    parser.add_argument('--compare', default=None, help='Results json from an earlier run to check for regressions against')
+    parser.add_argument('--tol', type=float, default=REGRESSION_TOL, help='Slowdown ratio counted as a regression')
+    args = parser.parse_args()
+
+    started = datetime.now()
+    all_datasets = {ds['short_name']: ds for ds in get_datasets_dict()}
+    results_path = args.results or os.path.join(args.out_dir, 'bench_results_{}.json'.format(started.strftime('%Y%m%d_%H%M%S')))
+    results_path = os.path.abspath(results_path)
+
+    results = []
+    for n_dets in args.sizes:
+        size_dir = os.path.join(args.out_dir, '{}_dets'.format(int(n_dets)))
+        if not os.path.exists(size_dir): os.makedirs(size_dir)
+        link_auxiliary_data(size_dir)
+
+        start_cwd = os.getcwd()
+        os.chdir(size_dir)
+        for ds_short_name in args.datasets:
+            results.extend(bench_dataset(all_datasets[ds_short_name], int(n_dets), args))
+        os.chdir(start_cwd)
+
+    with open(results_path, 'w') as f_handle:
+        json.dump({'started': started.isoformat(timespec='seconds'), 'git_rev': get_git_rev(), 'python': platform.python_version(),
+                   'numpy': np.__version__, 'args': vars(args), 'results': results}, f_handle, indent=1)
+    print('Results saved to {}'.format(results_path))
+
+    n_over_budget = sum(r['over_budget'] for r in results)
+    if n_over_budget > 0: print('{} stages went over their peak memory budget'.format(n_over_budget))
+
+    n_regressions = 0
+    if args.compare is not None:
+        with open(args.compare, 'r') as f_handle:
+            n_regressions = compare_results(json.load(f_handle)['results'], results, args.tol)
+    if n_regressions > 0 or n_over_budget > 0: sys.exit(1)
@@ -0,0 +1,169 @@
+import numpy as np
+from utils import (get_dataset, get_ds_input_paths, cached_compute, get_utc_offsets, get_local_day_nums, AGG_CACHE_DIR)
+from profiling import profiled
+
+# Zenith angle of the sun's centre at sunrise and sunset, allowing for refraction and the size of the disc
+SUN_ZENITH_DEG = 90.833
+JULIAN_DAY_EPOCH = 2440587.5
+JULIAN_DAY_J2000 = 2451545.0
+
+
+def get_sun_declin_eq_of_time(epochs):
+    # Solar declination (radians) and the equation of time (minutes) at UTC epochs, from the NOAA solar equations
+    julian_cent = (JULIAN_DAY_EPOCH + np.asarray(epochs, dtype='float64') / 86400 - JULIAN_DAY_J2000) / 36525
+    mean_long = np.radians((280.46646 + julian_cent * (36000.76983 + julian_cent * 0.0003032)) % 360)
+    mean_anom = np.radians(357.52911 + julian_cent * (35999.05029 - 0.0001537 * julian_cent))
+    eccent = 0.016708634 - julian_cent * (0.000042037 + 0.0000001267 * julian_cent)
+
+    eq_of_ctr = np.radians(np.sin(mean_anom) * (1.914602 - julian_cent * (0.004817 + 0.000014 * julian_cent)) +
+                           np.sin(2 * mean_anom) * (0.019993 - 0.000101 * julian_cent) + np.sin(3 * mean_anom) * 0.000289)
+    omega = np.radians(125.04 - 1934.136 * julian_cent)
+    app_long = mean_long + eq_of_ctr - np.radians(0.00569 + 0.00478 * np.sin(omega))
+
+    mean_obliq = 23 + (26 + (21.448 - julian_cent * (46.815 + julian_cent * (0.00059 - julian_cent * 0.001813))) / 60) / 60
+    obliq = np.radians(mean_obliq + 0.00256 * np.cos(omega))
+    declin = np.arcsin(np.sin(obliq) * np.sin(app_long))
+
+    var_y = np.tan(obliq / 2) ** 2
+    eq_of_time_mins = 4 * np.degrees(var_y * np.sin(2 * mean_long) - 2 * eccent * np.sin(mean_anom) +
+                                     4 * eccent * var_y * np.sin(mean_anom) * np.cos(2 * mean_long) -
+                                     0.5 * var_y ** 2 * np.sin(4 * mean_long) - 1.25 * eccent ** 2 * np.sin(2 * mean_anom))
+
+    return declin, eq_of_time_mins
+
+
+def get_sun_cos_hour_angle(lat_rads, declin, zenith_deg=SUN_ZENITH_DEG):
+    with np.errstate(invalid='ignore'):
+        return np.cos(np.radians(zenith_deg)) / (np.cos(lat_rads) * np.cos(declin)) - np.tan(lat_rads) * np.tan(declin)
+
+
+def get_sun_times(lats, longs, day_nums, zenith_deg=SUN_ZENITH_DEG, n_refines=1):
+    # Sunrise and sunset (UTC epochs in seconds, as floats) of the days day_nums (days since 1970-01-01 by the
+    # local calendar) at lats/longs (degrees, east positive), all broadcast together. The sun's position is taken
+    # at solar noon, then again at each estimated sunrise and sunset n_refines times. Both are NaN when the sun
+    # doesn't cross zenith_deg that day (or the site has no valid position), is_polar_day telling the midnight
+    # sun apart from polar night
+    lats = np.asarray(lats, dtype='float64')
+    lat_rads = np.radians(np.where(np.abs(lats) <= 90, lats, np.nan))
+    longs = np.asarray(longs, dtype='float64')
+    day_starts = np.asarray(day_nums, dtype='float64') * 86400
+
+    noon_epochs = day_starts + (720 - 4 * longs) * 60
+    noon_declin, _ = get_sun_declin_eq_of_time(noon_epochs)
+    is_polar_day = get_sun_cos_hour_angle(lat_rads, noon_declin, zenith_deg) < -1
+
+    sun_times = []
+    for direction in [-1, 1]:
+        event_epochs = noon_epochs
+        for _ in range(n_refines + 1):
+            declin, eq_of_time_mins = get_sun_declin_eq_of_time(event_epochs)
+            with np.errstate(invalid='ignore'):
+                hour_angle_mins = 4 * np.degrees(np.arccos(get_sun_cos_hour_angle(lat_rads, declin, zenith_deg)))
+            event_epochs = day_starts + (720 - 4 * longs - eq_of_time_mins + direction * hour_angle_mins) * 60
+        sun_times.append(event_epochs)
+
+    return sun_times[0], sun_times[1], is_polar_day
+
+
+def get_utc_epochs(epochs, det_store, ds):
+    # UTC instants of store epochs. Tz aware stores hold UTC already, naive ones hold wall clock times, taken to
+    # be in the dataset's wall_clock_tz (or UTC without one)
+    epochs = np.asarray(epochs, dtype='int64')
+    if det_store['tz_aware'] or ds.get('wall_clock_tz') is None: return epochs
+
+    # The offset at the wall clock time is only a first guess near clock changes, so it is looked up again
+    return epochs - get_utc_offsets(epochs - get_utc_offsets(epochs, ds['wall_clock_tz']), ds['wall_clock_tz'])
+
+
+def get_store_day_nums(epochs, det_store, ds):
+    # Local calendar days of store epochs, the same days the aggregate cubes of ds use
+    if det_store['tz_aware']: return get_local_day_nums(epochs, ds.get('tz'))
+    return np.asarray(epochs, dtype='int64') // 86400
+
+
+def get_site_positions(det_store):
+    # Lat/long of every site code, from its files (NaN for sites without a recorded position)
+    site_lats = np.full(len(det_store['site_names']), np.nan)
+    site_longs = np.full(len(det_store['site_names']), np.nan)
+    site_lats[det_store['file_site_ixs']] = det_store['file_lats']
+    site_longs[det_store['file_site_ixs']] = det_store['file_longs']
+
+    return site_lats, site_longs
+
+
+@profiled(n_items=lambda sun_table: len(sun_table['site_day_keys']))
+def build_site_day_sun_table(det_store, ds):
+    # Sunrise and sunset (UTC epochs) of every site on every local day it has recordings starting on,
+    # ordered by site-day key (site_ix * n_day_nums + day_num - first_day_num)
+    f_day_nums = get_store_day_nums(det_store['file_epochs'], det_store, ds)
+    first_day_num = int(np.min(f_day_nums, initial=0))
+    n_day_nums = int(np.max(f_day_nums, initial=0)) - first_day_num + 1
+
+    site_day_keys = np.unique(np.asarray(det_store['file_site_ixs'], dtype='int64') * n_day_nums + f_day_nums - first_day_num)
+    site_day_site_ixs = site_day_keys // n_day_nums
+    site_day_day_nums = site_day_keys % n_day_nums + first_day_num
+
+    site_lats, site_longs = get_site_positions(det_store)
+    sunrise_epochs, sunset_epochs, is_polar_day = get_sun_times(site_lats[site_day_site_ixs], site_longs[site_day_site_ixs], site_day_day_nums)
+
+    return {'site_day_keys': site_day_keys, 'first_day_num': first_day_num, 'n_day_nums': n_day_nums, 'site_lats': site_lats,
+            'site_longs': site_longs, 'sunrise_epochs': sunrise_epochs, 'sunset_epochs': sunset_epochs, 'is_polar_day': is_polar_day}
+
+
+def load_site_day_sun_table(ds, force_compute=False):
+    # ds is an entry of get_datasets_dict (or like one)
+    return cached_compute('sun_{}'.format(ds['short_name']), {'tz': ds.get('tz'), 'wall_clock_tz': ds.get('wall_clock_tz'),
+                                                              'zenith_deg': SUN_ZENITH_DEG},
+                          get_ds_input_paths(ds['short_name'], labelled=False),
+                          lambda: build_site_day_sun_table(get_dataset(ds['short_name']), ds), force_compute, cache_dir=AGG_CACHE_DIR)
+
+
+def get_site_day_sun_times(sun_table, site_ixs, day_nums):
+    # Sunrise, sunset and is_polar_day for each (site, local day) pair, looked up in the table, with pairs
+    # the table doesn't hold (e.g. days after a recording ran past midnight) calculated directly
+    site_ixs = np.asarray(site_ixs, dtype='int64')
+    day_nums = np.asarray(day_nums, dtype='int64')
+    pair_keys = site_ixs * sun_table['n_day_nums'] + day_nums - sun_table['first_day_num']
+
+    table_ixs = np.minimum(np.searchsorted(sun_table['site_day_keys'], pair_keys), max(len(sun_table['site_day_keys']) - 1, 0))
+    in_table = ((day_nums >= sun_table['first_day_num']) & (day_nums < sun_table['first_day_num'] + sun_table['n_day_nums']) &
+                (len(sun_table['site_day_keys']) > 0))
+    in_table[in_table] = sun_table['site_day_keys'][table_ixs[in_table]] == pair_keys[in_table]
+
+    sunrise_epochs = np.empty(len(pair_keys))
+    sunset_epochs = np.empty(len(pair_keys))
+    is_polar_day = np.empty(len(pair_keys), dtype='bool')
+    sunrise_epochs[in_table] = sun_table['sunrise_epochs'][table_ixs[in_table]]
+    sunset_epochs[in_table] = sun_table['sunset_epochs'][table_ixs[in_table]]
+    is_polar_day[in_table] = sun_table['is_polar_day'][table_ixs[in_table]]
+
+    missing_ixs = np.where((~in_table))[0]
+    sunrise_epochs[missing_ixs], sunset_epochs[missing_ixs], is_polar_day[missing_ixs] = get_sun_times(
+        sun_table['site_lats'][site_ixs[missing_ixs]], sun_table['site_longs'][site_ixs[missing_ixs]], day_nums[missing_ixs])
+
+    return sunrise_epochs, sunset_epochs, is_polar_day
+
+
+def get_det_sun_rel_mins(det_store, ds, sun_table=None):
+    # Minutes from local sunrise and from local sunset (negative before) to each detection of a store or store-like
+    # table (e.g. from select_dets), NaN on days the sun doesn't rise or set at the detection's site
+    if sun_table is None: sun_table = load_site_day_sun_table(ds)
+
+    if 'det_site_ixs' in det_store.keys(): det_site_ixs = det_store['det_site_ixs']
+    else: det_site_ixs = det_store['file_site_ixs'][det_store['det_file_ixs']]
+
+    sunrise_epochs, sunset_epochs, _ = get_site_day_sun_times(sun_table, det_site_ixs, get_store_day_nums(det_store['det_epochs'], det_store, ds))
+    det_utc_epochs = get_utc_epochs(det_store['det_epochs'], det_store, ds)
+
+    return (det_utc_epochs - sunrise_epochs) / 60, (det_utc_epochs - sunset_epochs) / 60
+
+
+def get_local_dec_hours(utc_epochs, tz=None):
+    # Local time of day in decimal hours of UTC epochs (NaN stays NaN)
+    utc_epochs = np.asarray(utc_epochs, dtype='float64')
+    is_valid = np.isfinite(utc_epochs)
+    dec_hours = np.full(utc_epochs.shape, np.nan)
+    valid_epochs = np.floor(utc_epochs[is_valid]).astype('int64')
+    dec_hours[is_valid] = ((valid_epochs + get_utc_offsets(valid_epochs, tz)) % 86400) / 3600
+
+    return dec_hours
@@ -0,0 +1,189 @@
+import os
+import shutil
+import pickle
+import argparse
+import numpy as np
+import pandas as pd
+from datetime import datetime, timezone
+from utils import (f_dets_to_det_store, set_det_store_counts, append_det_store_chunk, merge_det_store_counts, write_det_store_meta,
+                   get_det_store_dir, get_comb_dets_path, get_labelled_clips_path, dt_to_epoch, epoch_to_dt, DET_STORE_COLUMNS,
+                   check_n_specs, COSTA_RICA_SITE_INFO_PATH, COMB_DATA_DIR, LABELLED_DATA_DIR)
+
+DEFAULT_CHUNK_SIZE = 1000000
+MIN_DET_CONF = 0.8
+LOW_PREC_SPEC_FRAC = 0.2
+
+# The species the fig_3 panels plot by default come first, so they are also the most common
+SYNTH_SPEC_NAMES = ['Willow Warbler', 'Yellow-throated Toucan']
+
+# Recording set ups loosely following the real datasets, so every fig_3 panel has data in its window
+SYNTH_DATASETS = {'norway': {'start_dt': datetime(2022, 4, 20), 'n_days': 60, 'f_len_mins': 5, 'lat_range': (58, 70), 'long_range': (5, 30)},
+                  'taiwan': {'start_dt': datetime(2019, 10, 1), 'n_days': 365, 'f_len_mins': 5, 'lat_range': (22, 25), 'long_range': (120, 122)},
+                  'costa-rica': {'start_dt': datetime(2021, 3, 1), 'n_days': 30, 'f_len_mins': 1, 'lat_range': (8.4, 8.8),
+                                 'long_range': (-83.6, -83.2)},
+                  'brazil': {'start_dt': datetime(2021, 6, 1, tzinfo=timezone.utc), 'n_days': 30, 'f_len_mins': 1, 'lat_range': (-2.2, -2.0),
+                             'long_range': (-47.6, -47.4)}}
+
+
+def get_synth_spec_names(n_specs):
+    return (SYNTH_SPEC_NAMES + ['Synthetic species {:04d}'.format(ix) for ix in range(n_specs)])[:n_specs]
+
+
+def get_synth_site_names(ds_short_name, n_sites):
+    # Costa Rica sites are named after the rows of the site info sheet so they pick up a habitat
+    if ds_short_name == 'costa-rica' and os.path.exists(COSTA_RICA_SITE_INFO_PATH):
+        sheet_sites = [s.strip().split('_') for s in pd.read_csv(COSTA_RICA_SITE_INFO_PATH)['Site']]
+        site_names = list(dict.fromkeys(['{}_Site-{}'.format(s[0], s[-1]) for s in sheet_sites]))
+        if len(site_names) >= n_sites: return site_names[:n_sites]
+
+    return ['{} site {:03d}'.format(ds_short_name, ix) for ix in range(n_sites)]
+
+
+def iter_synth_det_store_chunks(ds_short_name, n_dets, n_sites=20, n_specs=100, dets_per_f=5, chunk_size=DEFAULT_CHUNK_SIZE, seed=0):
+    # Detection store chunks (as f_dets_to_det_store would give) generated directly in numpy, so stores of
+    # 10^8 detections can be written without building per-file dicts. Files take turns between sites and are
+    # spread evenly over the recording period (so every day has files once there are more files than days), and
+    # species follow a Zipf-like abundance curve
+    ds_cfg = SYNTH_DATASETS[ds_short_name]
+    rng = np.random.default_rng(seed)
+
+    spec_names = np.asarray(get_synth_spec_names(n_specs), dtype='str')
+    site_names = np.asarray(get_synth_site_names(ds_short_name, n_sites), dtype='str')
+    spec_ps = 1 / np.arange(1, n_specs + 1)**1.1
+    spec_ps = spec_ps / np.sum(spec_ps)
+    site_lats = rng.uniform(ds_cfg['lat_range'][0], ds_cfg['lat_range'][1], n_sites)
+    site_longs = rng.uniform(ds_cfg['long_range'][0], ds_cfg['long_range'][1], n_sites)
+
+    n_files = max(int(np.ceil(n_dets / dets_per_f)), 1)
+    start_epoch = dt_to_epoch(ds_cfg['start_dt'])
+    f_len_secs = ds_cfg['f_len_mins'] * 60
+
+    chunk_n_files = max(chunk_size // dets_per_f, 1)
+    for first_f_ix in range(0, n_files, chunk_n_files):
+        f_ixs = np.arange(first_f_ix, min(first_f_ix + chunk_n_files, n_files))
+        f_site_ixs = f_ixs % n_sites
+        f_epochs = start_epoch + f_ixs * (ds_cfg['n_days'] * 86400) // n_files
+
+        # Detections are shared out so the chunks add up to exactly n_dets
+        chunk_n_dets = int(round(n_dets * (f_ixs[-1] + 1) / n_files)) - int(round(n_dets * first_f_ix / n_files))
+        det_file_ixs = np.sort(rng.integers(f_ixs[0], f_ixs[-1] + 1, chunk_n_dets))
+        det_start_times = rng.integers(0, max(f_len_secs // 3, 1), chunk_n_dets) * 3
+
+        # Confidences stay float64 at BirdNET's 4 dp, as in real result files, and are only narrowed when the store is written
+        det_store_chunk = {'det_spec_ixs': rng.choice(n_specs, chunk_n_dets, p=spec_ps).astype(DET_STORE_COLUMNS['det_spec_ixs']),
+                           'det_confs': np.round(rng.uniform(MIN_DET_CONF, 1, chunk_n_dets), 4),
+                           'det_epochs': f_epochs[det_file_ixs - first_f_ix] + det_start_times,
+                           'det_file_ixs': det_file_ixs.astype(DET_STORE_COLUMNS['det_file_ixs']),
+                           'file_site_ixs': f_site_ixs.astype(DET_STORE_COLUMNS['file_site_ixs']), 'file_epochs': f_epochs,
+                           'file_lats': site_lats[f_site_ixs], 'file_longs': site_longs[f_site_ixs],
+                           'file_len_mins': np.full(len(f_ixs), ds_cfg['f_len_mins'], dtype='float64'),
+                           'spec_names': spec_names, 'site_names': site_names, 'tz_aware': ds_cfg['start_dt'].tzinfo is not None}
+
+        yield set_det_store_counts(det_store_chunk)
+
+
+def det_store_chunk_to_f_dets(det_store_chunk, first_f_ix=0):
+    # Per-file dicts in the combined pickle format, first_f_ix being the chunk's first file index
+    f_det_bounds = np.searchsorted(det_store_chunk['det_file_ixs'], first_f_ix + np.arange(det_store_chunk['n_files'] + 1))
+
+    all_f_dets = []
+    for f_ix in range(det_store_chunk['n_files']):
+        f_epoch = det_store_chunk['file_epochs'][f_ix]
+        f_dets = {'site': str(det_store_chunk['site_names'][det_store_chunk['file_site_ixs'][f_ix]]),
+                  'dt': epoch_to_dt(f_epoch, det_store_chunk['tz_aware']), 'lat': float(det_store_chunk['file_lats'][f_ix]),
+                  'long': float(det_store_chunk['file_longs'][f_ix]), 'f_len_mins': float(det_store_chunk['file_len_mins'][f_ix]), 'dets': []}
+
+        for det_ix in range(f_det_bounds[f_ix], f_det_bounds[f_ix + 1]):
+            f_dets['dets'].append({'common_name': str(det_store_chunk['spec_names'][det_store_chunk['det_spec_ixs'][det_ix]]),
+                                   'confidence': float(det_store_chunk['det_confs'][det_ix]),
+                                   'start_time': float(det_store_chunk['det_epochs'][det_ix] - f_epoch)})
+        all_f_dets.append(f_dets)
+
+    return all_f_dets
+
+
+def make_synth_labelled_clips(spec_names, n_clips=2000, seed=0):
+    # Each species gets its own confidence at which half its clips are correct, so calibration finds a spread
+    # of thresholds. LOW_PREC_SPEC_FRAC of the species (never the ones the panels plot) instead have every other
+    # clip wrong from the most confident down, so they stay at or below 0.5 precision at every threshold
+    rng = np.random.default_rng(seed)
+
+    clip_spec_ixs = rng.integers(0, len(spec_names), n_clips)
+    clip_confs = np.round(rng.uniform(MIN_DET_CONF, 1, n_clips), 3)
+    spec_mid_confs = rng.uniform(0.6, 0.95, len(spec_names))
+    p_correct = 1 / (1 + np.exp(-(clip_confs - spec_mid_confs[clip_spec_ixs]) * 40))
+    is_correct = rng.random(n_clips) < p_correct
+
+    is_low_prec_spec = rng.random(len(spec_names)) < LOW_PREC_SPEC_FRAC
+    is_low_prec_spec[:len(SYNTH_SPEC_NAMES)] = False
+    sort_ixs = np.lexsort((-clip_confs, clip_spec_ixs))
+    spec_conf_ranks = np.empty(n_clips, dtype='int64')
+    spec_conf_ranks[sort_ixs] = np.arange(n_clips) - np.searchsorted(clip_spec_ixs[sort_ixs], clip_spec_ixs[sort_ixs], side='left')
+    is_correct = np.where(is_low_prec_spec[clip_spec_ixs], spec_conf_ranks % 2 == 1, is_correct)
+    clip_decisions = np.where(is_correct, 'yes', 'no')
+
+    return pd.DataFrame({'Common name': np.asarray(spec_names)[clip_spec_ixs], 'Confidence': clip_confs, 'BirdNET correct?': clip_decisions})
+
+
+def link_auxiliary_data(out_dir):
+    # The Costa Rica site info sheet is read relative to the working directory
+    aux_dir = os.path.dirname(COSTA_RICA_SITE_INFO_PATH)
+    out_aux_dir = os.path.join(out_dir, aux_dir)
+    if not os.path.exists(out_aux_dir): os.symlink(os.path.join(os.path.dirname(os.path.abspath(__file__)), aux_dir), out_aux_dir)
+
+
+def write_synth_dataset(ds_short_name, n_dets, n_sites=20, n_specs=100, dets_per_f=5, n_clips=2000, write_pickle=False,
+                        chunk_size=DEFAULT_CHUNK_SIZE, seed=0):
+    # Writes a synthetic dataset (labelled clips, plus either the combined pickle or the detection store
+    # directly) under the current directory, replacing whatever was there for ds_short_name
+    check_n_specs(n_specs)
+    for d in [COMB_DATA_DIR, LABELLED_DATA_DIR]:
+        if not os.path.exists(d): os.makedirs(d)
+
+    make_synth_labelled_clips(get_synth_spec_names(n_specs), n_clips, seed).to_excel(get_labelled_clips_path(ds_short_name), index=False)
+
+    store_dir = get_det_store_dir(ds_short_name)
+    comb_dets_path = get_comb_dets_path(ds_short_name)
+    if os.path.exists(store_dir): shutil.rmtree(store_dir)
+    if os.path.exists(comb_dets_path): os.remove(comb_dets_path)
+
+    chunks = iter_synth_det_store_chunks(ds_short_name, n_dets, n_sites, n_specs, dets_per_f, chunk_size, seed)
+    if write_pickle:
+        # The store is left to be built from the pickle on first load, as for the real data
+        all_f_dets = []
+        for chunk in chunks: all_f_dets.extend(det_store_chunk_to_f_dets(chunk, len(all_f_dets)))
+        with open(comb_dets_path, 'wb') as f_handle:
+            pickle.dump(np.asarray(all_f_dets, dtype='object'), f_handle)
+        return {'n_files': len(all_f_dets), 'n_dets': sum([len(f_dets['dets']) for f_dets in all_f_dets])}
+
+    det_store = f_dets_to_det_store([], get_synth_spec_names(n_specs), get_synth_site_names(ds_short_name, n_sites))
+    append_det_store_chunk(det_store, store_dir)
+    for chunk in chunks:
+        append_det_store_chunk(chunk, store_dir)
+        merge_det_store_counts(det_store, chunk)
+    write_det_store_meta(det_store, store_dir)
+
+    return {'n_files': det_store['n_files'], 'n_dets': det_store['n_dets']}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic datasets in the layout the analysis scripts read')
+    parser.add_argument('out_dir', help='Directory to write to (the analysis scripts are then run from there)')
+    parser.add_argument('--datasets', nargs='+', default=list(SYNTH_DATASETS.keys()), choices=list(SYNTH_DATASETS.keys()))
+    parser.add_argument('--n-dets', type=float, default=1e5, help='Detections per dataset')
+    parser.add_argument('--n-sites', type=int, default=20)
+    parser.add_argument('--n-specs', type=int, default=100)
+    parser.add_argument('--dets-per-f', type=int, default=5, help='Mean detections per recording file')
+    parser.add_argument('--n-clips', type=int, default=2000, help='Labelled clips per dataset')
+    parser.add_argument('--pickle', action='store_true', help='Write the combined pickle rather than the detection store')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.out_dir): os.makedirs(args.out_dir)
+    link_auxiliary_data(args.out_dir)
+    os.chdir(args.out_dir)
+
+    for ds_short_name in args.datasets:
+        synth_stats = write_synth_dataset(ds_short_name, int(args.n_dets), args.n_sites, args.n_specs, args.dets_per_f, args.n_clips,
+                                          args.pickle, seed=args.seed)
+        print('{}: {} files, {} detections'.format(ds_short_name, f'{synth_stats["n_files"]:,}', f'{synth_stats["n_dets"]:,}'))
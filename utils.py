@@ -1,58 +1,868 @@
 import os 
-import pandas as pd 
 import numpy as np 
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
 import csv 
+import json
 import pickle 
+import hashlib
+import time
+import shutil
+import tempfile
+import fcntl
+from concurrent.futures import ProcessPoolExecutor
+from profiling import profiled, stage
 
-def get_opt_spec_bn_threshs(ds_short_name, target_prec=0.9):
-    comb_data_dir = 'combined_detection_data'
-    comb_dets_path = os.path.join(comb_data_dir, '{}_combined_dets_0-8_thresh.pickle'.format(ds_short_name))
-    with open(comb_dets_path, 'rb') as f_handle:
+COMB_DATA_DIR = 'combined_detection_data'
+LABELLED_DATA_DIR = 'precision_labelled_data'
+CALIB_CACHE_DIR = 'temp_calib_data'
+FIG_CACHE_DIR = 'temp_fig_data'
+AGG_CACHE_DIR = 'temp_agg_data'
+COSTA_RICA_SITE_INFO_PATH = os.path.join('auxiliary_data', 'costa_rica_site_info.csv')
+# How the Costa Rica site info CSV spells locations that the recording site names spell differently
+COSTA_RICA_LOC_ALIASES = {'sq260': 'sq2601', 'mangrove': 'mangroves', 'palma': 'lapalma', 'elsi': 'elsicroc', 'rancho': 'ranchobajo',
+                          'miramar': 'mirenmar', 'nuevo': 'rionuevo', 'gamba': 'lagamba', 'tarde': 'latarde', 'lareserva': 'indigenousreserve',
+                          'sendero': 'golfito'}
+# Site info CSV columns given shorter attribute names, the other columns keep their own
+COSTA_RICA_SITE_ATTR_NAMES = {'Lat': 'lat', 'Long': 'long', 'Habitat': 'habitat', 'Elevation': 'elevation'}
+# Every species seen in any dataset, one common name per line, its line number being the species' ID across datasets
+SPEC_INDEX_PATH = os.path.join(COMB_DATA_DIR, 'species_index.txt')
+CACHE_LOG_NAME = 'cache_log.csv'
+CACHE_MAX_BYTES = int(os.environ.get('BIRD_CACHE_MAX_BYTES', 2 * 1024**3))
+# Cap on the in-memory arrays (memory-mapped columns don't count) held by the dataset registry
+DATASET_MAX_BYTES = int(os.environ.get('BIRD_DATASET_MAX_BYTES', 4 * 1024**3))
+DET_FLOOR_THRESH = 0.8
+# Smaller stores aren't worth splitting over worker processes
+DET_PARTITION_MIN_ROWS = 1000000
+# Arrays handed to workers are written here (shared memory on Linux) and memory-mapped by each of them
+SHARED_ARRAY_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+# Detection orderings kept in each store's directory for select_dets, by time and by species or site then time
+QUERY_INDEX_DIR_NAME = 'query_index'
+QUERY_INDEX_KEYS = ('time', 'spec', 'site')
+QUERY_INDEX_VERSION = 2
+
+# Columns of the on-disk detection store. Detections are stored file by file (in the same order
+# as the combined pickles) and link back to the file index through det_file_ixs
+DET_STORE_COLUMNS = {'det_spec_ixs': 'int16', 'det_confs': 'float32', 'det_epochs': 'int64', 'det_file_ixs': 'int32',
+                     'file_site_ixs': 'int32', 'file_epochs': 'int64', 'file_lats': 'float64', 'file_longs': 'float64',
+                     'file_len_mins': 'float64'}
+DET_STORE_VERSION = 2
+
+EPOCH_DT = datetime(1970, 1, 1)
+EPOCH_DT_UTC = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def get_comb_dets_path(ds_short_name):
+    return os.path.join(COMB_DATA_DIR, '{}_combined_dets_0-8_thresh.pickle'.format(ds_short_name))
+
+
+def get_labelled_clips_path(ds_short_name):
+    return os.path.join(LABELLED_DATA_DIR, '{}_labelled_clips.xlsx'.format(ds_short_name))
+
+
+def get_det_store_dir(ds_short_name):
+    return os.path.join(COMB_DATA_DIR, '{}_combined_dets_0-8_thresh'.format(ds_short_name))
+
+
+def dt_to_epoch(dt):
+    # Naive datetimes are stored by their wall clock time, aware ones are converted to UTC
+    if dt.tzinfo is None: return int((dt - EPOCH_DT).total_seconds())
+    return int((dt - EPOCH_DT_UTC).total_seconds())
+
+
+def epoch_to_dt(epoch, tz_aware=False):
+    if tz_aware: return EPOCH_DT_UTC + timedelta(seconds=int(epoch))
+    return EPOCH_DT + timedelta(seconds=int(epoch))
+
+
+def check_n_specs(n_specs):
+    # Species codes are stored as int16, so past its range they would wrap
+    max_specs = int(np.iinfo(DET_STORE_COLUMNS['det_spec_ixs']).max) + 1
+    if n_specs > max_specs: raise ValueError('{} species is more than the {} a detection store can hold'.format(n_specs, max_specs))
+
+
+def f_dets_to_det_store(all_f_dets, spec_names=None, site_names=None, first_f_ix=0):
+    # Existing spec_names/site_names keep their codes and new names are appended, so chunks converted 
+    # in turn (with first_f_ix advanced by the files already written) can be appended to one store
+    spec_names = [] if spec_names is None else list(spec_names)
+    site_names = [] if site_names is None else list(site_names)
+    spec_codes = {s: ix for ix, s in enumerate(spec_names)}
+    site_codes = {s: ix for ix, s in enumerate(site_names)}
+
+    cols = {c: [] for c in DET_STORE_COLUMNS.keys()}
+    tz_aware = None
+    for f_ix, f_dets in enumerate(all_f_dets):
+        if f_dets['site'] not in site_codes:
+            site_codes[f_dets['site']] = len(site_names)
+            site_names.append(f_dets['site'])
+
+        # Epochs are stored the same way for every file, so a dataset can't mix naive and tz aware times
+        f_epoch = dt_to_epoch(f_dets['dt'])
+        if tz_aware is None: tz_aware = f_dets['dt'].tzinfo is not None
+        elif tz_aware != (f_dets['dt'].tzinfo is not None):
+            raise ValueError('File {} of site {} has a {} time, unlike the files before it'.format(first_f_ix + f_ix, f_dets['site'],
+                             'tz aware' if f_dets['dt'].tzinfo is not None else 'naive'))
+        cols['file_site_ixs'].append(site_codes[f_dets['site']])
+        cols['file_epochs'].append(f_epoch)
+        cols['file_lats'].append(float(f_dets['lat']) if 'lat' in f_dets.keys() else np.nan)
+        cols['file_longs'].append(float(f_dets['long']) if 'long' in f_dets.keys() else np.nan)
+        cols['file_len_mins'].append(f_dets['f_len_mins'] if 'f_len_mins' in f_dets.keys() else np.nan)
+
+        for d in f_dets['dets']:
+            if d['common_name'] not in spec_codes:
+                spec_codes[d['common_name']] = len(spec_names)
+                spec_names.append(d['common_name'])
+
+            cols['det_spec_ixs'].append(spec_codes[d['common_name']])
+            cols['det_confs'].append(d['confidence'])
+            cols['det_epochs'].append(f_epoch + int(d['start_time']))
+            cols['det_file_ixs'].append(first_f_ix + f_ix)
+
+    check_n_specs(len(spec_names))
+    det_store = {c: np.asarray(vals, dtype=DET_STORE_COLUMNS[c]) for c, vals in cols.items()}
+    det_store['spec_names'] = np.asarray(spec_names, dtype='str')
+    det_store['site_names'] = np.asarray(site_names, dtype='str')
+    det_store['tz_aware'] = bool(tz_aware)
+
+    return set_det_store_counts(det_store)
+
+
+def set_det_store_counts(det_store):
+    det_store['n_files'] = len(det_store['file_epochs'])
+    det_store['n_dets'] = len(det_store['det_epochs'])
+
+    # Derived counts kept in the store metadata and updated when new data is appended
+    det_store['spec_n_dets'] = np.bincount(det_store['det_spec_ixs'], minlength=len(det_store['spec_names']))
+    det_store['site_n_files'] = np.bincount(det_store['file_site_ixs'], minlength=len(det_store['site_names']))
+    det_store['site_watermarks'] = np.full(len(det_store['site_names']), np.iinfo('int64').min, dtype='int64')
+    np.maximum.at(det_store['site_watermarks'], det_store['file_site_ixs'], det_store['file_epochs'])
+
+    return det_store
+
+
+def merge_det_store_counts(det_store, det_store_chunk):
+    # Adds the derived counts of a chunk converted with det_store's species/site names onto det_store
+    check_n_specs(len(det_store_chunk['spec_names']))
+    if det_store['n_files'] > 0 and det_store_chunk['n_files'] > 0 and det_store_chunk['tz_aware'] != det_store['tz_aware']:
+        raise ValueError('Appended files have {} times but the store\'s are {}'.format(
+                         *['tz aware' if a else 'naive' for a in [det_store_chunk['tz_aware'], det_store['tz_aware']]]))
+
+    n_old_specs = len(det_store['spec_n_dets'])
+    n_old_sites = len(det_store['site_n_files'])
+
+    det_store['spec_n_dets'] = det_store_chunk['spec_n_dets'] + np.pad(det_store['spec_n_dets'], (0, len(det_store_chunk['spec_n_dets']) - n_old_specs))
+    det_store['site_n_files'] = det_store_chunk['site_n_files'] + np.pad(det_store['site_n_files'], (0, len(det_store_chunk['site_n_files']) - n_old_sites))
+    det_store['site_watermarks'] = np.maximum(det_store_chunk['site_watermarks'], 
+                                              np.pad(det_store['site_watermarks'], (0, len(det_store_chunk['site_watermarks']) - n_old_sites), 
+                                                     constant_values=np.iinfo('int64').min))
+
+    det_store['spec_names'] = det_store_chunk['spec_names']
+    det_store['site_names'] = det_store_chunk['site_names']
+    det_store['tz_aware'] = det_store_chunk['tz_aware'] if det_store_chunk['n_files'] > 0 else det_store['tz_aware']
+    det_store['n_files'] += det_store_chunk['n_files']
+    det_store['n_dets'] += det_store_chunk['n_dets']
+
+    return det_store
+
+
+def save_det_store(det_store, store_dir):
+    if not os.path.exists(store_dir): os.makedirs(store_dir)
+
+    for c in DET_STORE_COLUMNS.keys():
+        np.asarray(det_store[c], dtype=DET_STORE_COLUMNS[c]).tofile(os.path.join(store_dir, '{}.bin'.format(c)))
+
+    write_det_store_meta(det_store, store_dir)
+
+
+def append_det_store_chunk(det_store_chunk, store_dir):
+    # Rows past the counts in meta.json are ignored by load_det_store, so meta must be rewritten 
+    # (with write_det_store_meta) once the appended rows should become visible
+    if not os.path.exists(store_dir): os.makedirs(store_dir)
+
+    for c in DET_STORE_COLUMNS.keys():
+        with open(os.path.join(store_dir, '{}.bin'.format(c)), 'ab') as f_handle:
+            np.asarray(det_store_chunk[c], dtype=DET_STORE_COLUMNS[c]).tofile(f_handle)
+
+
+def truncate_det_store(store_dir, n_files, n_dets):
+    # Drops any rows left past the given counts, e.g. by an append that never got to update meta.json
+    for c, dtype in DET_STORE_COLUMNS.items():
+        col_path = os.path.join(store_dir, '{}.bin'.format(c))
+        n_rows = n_dets if c.startswith('det_') else n_files
+        if os.path.exists(col_path): os.truncate(col_path, n_rows * np.dtype(dtype).itemsize)
+
+
+def write_det_store_meta(det_store, store_dir):
+    # Metadata is written last so a partially written store is never picked up
+    meta = {'version': DET_STORE_VERSION, 'spec_names': list(det_store['spec_names']), 
+            'site_names': list(det_store['site_names']), 'tz_aware': bool(det_store['tz_aware']),
+            'n_files': int(det_store['n_files']), 'n_dets': int(det_store['n_dets']),
+            'spec_n_dets': [int(n) for n in det_store['spec_n_dets']], 'site_n_files': [int(n) for n in det_store['site_n_files']],
+            'site_watermarks': [int(e) for e in det_store['site_watermarks']],
+            'ingested_files_nbytes': int(det_store.get('ingested_files_nbytes', 0)),
+            'comb_dets_fingerprint': det_store.get('comb_dets_fingerprint')}
+
+    tmp_meta_path = os.path.join(store_dir, 'meta.json.tmp')
+    with open(tmp_meta_path, 'w') as f_handle:
+        json.dump(meta, f_handle)
+    os.replace(tmp_meta_path, os.path.join(store_dir, 'meta.json'))
+
+
+@profiled(n_items=lambda det_store: det_store['n_dets'])
+def build_det_store(ds_short_name):
+    with open(get_comb_dets_path(ds_short_name), 'rb') as f_handle:
         all_f_dets = pickle.load(f_handle)
 
-    annotated_xlsx_path = os.path.join('precision_labelled_data', '{}_labelled_clips.xlsx'.format(ds_short_name))
-    bn_thresh_vals = np.linspace(0.8, 0.99, 20)
+    det_store = f_dets_to_det_store(all_f_dets)
+    det_store['comb_dets_fingerprint'] = get_file_fingerprint(get_comb_dets_path(ds_short_name))
+    save_det_store(det_store, get_det_store_dir(ds_short_name))
 
-    _, all_specs = get_spec_precisions(annotated_xlsx_path, bn_thresh_vals[0])
-    all_specs_precs = np.ones((len(bn_thresh_vals), len(all_specs))) * -1
+    return det_store
 
-    for bn_thresh_ix, bn_thresh in enumerate(bn_thresh_vals):
-        bars, labs = get_spec_precisions(annotated_xlsx_path, bn_thresh)
-        prop_right = bars[:,0]
-        
-        for spec_ix, spec in enumerate(labs):
-            spec_match_ix = np.where((all_specs == spec))[0]
-            all_specs_precs[bn_thresh_ix, spec_match_ix] = prop_right[spec_ix]
 
-    opt_spec_bn_threshs = {}
-    prec_at_opt_threshs = []
+def read_det_store_meta(store_dir):
+    with open(os.path.join(store_dir, 'meta.json'), 'r') as f_handle:
+        return json.load(f_handle)
 
-    for spec_ix, spec in enumerate(all_specs):
-        spec_precs = all_specs_precs[:, spec_ix]
 
-        if max(spec_precs) > target_prec:
-            first_over_thresh_ix = np.where((spec_precs >= target_prec))[0][0]
-            prec_at_opt_threshs.append(spec_precs[first_over_thresh_ix])
-            opt_spec_bn_threshs[spec] = np.round(bn_thresh_vals[first_over_thresh_ix], 3)
+def det_store_from_meta(meta):
+    return {'spec_names': np.asarray(meta['spec_names'], dtype='str'), 'site_names': np.asarray(meta['site_names'], dtype='str'),
+            'tz_aware': meta['tz_aware'], 'n_files': meta['n_files'], 'n_dets': meta['n_dets'],
+            'spec_n_dets': np.asarray(meta['spec_n_dets'], dtype='int64'), 'site_n_files': np.asarray(meta['site_n_files'], dtype='int64'),
+            'site_watermarks': np.asarray(meta['site_watermarks'], dtype='int64'), 'ingested_files_nbytes': meta['ingested_files_nbytes'],
+            'comb_dets_fingerprint': meta.get('comb_dets_fingerprint')}
+
+
+# Datasets already warned about (once per process) having a changed pickle but a store that is kept
+_kept_store_warnings = set()
+
+
+def det_store_is_stale(ds_short_name):
+    # A store is rebuilt when the combined pickle differs from the one it was built from. Stores holding
+    # result files added with ingest_birdnet are never rebuilt from the pickle, as that would drop them
+    meta_path = os.path.join(get_det_store_dir(ds_short_name), 'meta.json')
+    if not os.path.exists(meta_path): return True
+    meta = read_det_store_meta(get_det_store_dir(ds_short_name))
+    if meta['version'] != DET_STORE_VERSION: return True
+
+    comb_dets_path = get_comb_dets_path(ds_short_name)
+    if not os.path.exists(comb_dets_path): return False
+    if meta.get('comb_dets_fingerprint') is None and meta['ingested_files_nbytes'] == 0:
+        return os.path.getmtime(comb_dets_path) > os.path.getmtime(meta_path)
+    if get_file_fingerprint(comb_dets_path) == meta.get('comb_dets_fingerprint'): return False
+
+    if meta['ingested_files_nbytes'] > 0:
+        if ds_short_name not in _kept_store_warnings:
+            _kept_store_warnings.add(ds_short_name)
+            print('Warning: {} has changed but the {} detection store holds ingested result files, so it is not rebuilt from it'.format(
+                  comb_dets_path, ds_short_name))
+        return False
+    return True
+
+
+@profiled(n_items=lambda det_store: det_store['n_dets'])
+def load_det_store(ds_short_name, columns=None):
+    # Memory-map only the requested columns, (re)building the store from the combined pickle first 
+    # if it is missing or the pickle has changed since it was built
+    update_det_store(ds_short_name)
+
+    store_dir = get_det_store_dir(ds_short_name)
+    meta = read_det_store_meta(store_dir)
+
+    det_store = det_store_from_meta(meta)
+    det_store['spec_ids'] = get_spec_ids(det_store['spec_names'])
+
+    if columns is None: columns = DET_STORE_COLUMNS.keys()
+    for c in columns:
+        n_rows = meta['n_dets'] if c.startswith('det_') else meta['n_files']
+        if n_rows == 0: 
+            det_store[c] = np.empty(0, dtype=DET_STORE_COLUMNS[c])
         else:
-            best_thresh = bn_thresh_vals[np.argmax(spec_precs)]
-            prec_at_opt_threshs.append(max(spec_precs))
-            opt_spec_bn_threshs[spec] = np.round(best_thresh, 3)
-    
-    all_dets = expand_to_valid_dets(all_f_dets, 0.8)
-    all_valid_dets = expand_to_valid_dets(all_f_dets, opt_spec_bn_threshs)
+            det_store[c] = np.memmap(os.path.join(store_dir, '{}.bin'.format(c)), dtype=DET_STORE_COLUMNS[c], 
+                                     mode='r', shape=(n_rows,))
+
+    return det_store
+
+
+def read_spec_index(index_path=SPEC_INDEX_PATH):
+    if not os.path.exists(index_path): return []
+    with open(index_path, 'r', encoding='utf-8') as f_handle:
+        return f_handle.read().splitlines()
+
+
+def get_spec_ids(spec_names, index_path=SPEC_INDEX_PATH):
+    # Global species IDs of spec_names, any names not yet in the index being appended to it. IDs never change as the 
+    # index is only appended to, under a lock so datasets loaded in parallel don't lose each other's new names
+    spec_codes = {s: ix for ix, s in enumerate(read_spec_index(index_path))}
+    if not all([s in spec_codes.keys() for s in spec_names]):
+        index_dir = os.path.dirname(index_path)
+        if index_dir and not os.path.exists(index_dir): os.makedirs(index_dir)
+
+        with open(index_path, 'a+', encoding='utf-8') as f_handle:
+            fcntl.flock(f_handle, fcntl.LOCK_EX)
+            f_handle.seek(0)
+            spec_codes = {s: ix for ix, s in enumerate(f_handle.read().splitlines())}
+            new_specs = [s for s in dict.fromkeys([str(s) for s in spec_names]) if s not in spec_codes.keys()]
+            f_handle.write(''.join(['{}\n'.format(s) for s in new_specs]))
+            for s in new_specs: spec_codes[s] = len(spec_codes)
+
+    return np.asarray([spec_codes[s] for s in spec_names], dtype='int32')
+
+
+def get_store_spec_ids(det_store):
+    # Global IDs of a store's species, by its species codes (stores not read by load_det_store get them here)
+    if 'spec_ids' not in det_store.keys(): det_store['spec_ids'] = get_spec_ids(det_store['spec_names'])
+    return det_store['spec_ids']
+
+
+def spec_ids_to_bitset(spec_ids, n_specs):
+    # Packed membership bits over the species index, 1 bit per species
+    is_member = np.zeros(n_specs, dtype='bool')
+    is_member[spec_ids] = True
+    return np.packbits(is_member)
+
+
+def bitsets_to_member_counts(bitsets, n_specs):
+    # Number of bitsets each species is in. n_specs can be past the end of older (shorter) bitsets
+    if len(bitsets) == 0: return np.zeros(n_specs, dtype='int64')
+    return np.sum([np.unpackbits(b, count=n_specs) for b in bitsets], axis=0, dtype='int64')
+
+
+# Datasets loaded in this process by short name, each with its detection store and (once asked for) its
+# detections over the BirdNET floor, so analyses in one process share a single load and expansion
+_dataset_registry = {}
+
+
+def get_dataset_nbytes(entry):
+    all_cols = list(entry['det_store'].values()) + list(entry.get('floor_dets', {}).values()) + list(entry.get('query_index', {}).values())
+    return sum([c.nbytes for c in all_cols if isinstance(c, np.ndarray) and not isinstance(c, np.memmap)])
+
+
+def enforce_dataset_cap(keep_ds_short_name, max_bytes=DATASET_MAX_BYTES):
+    # Least recently used datasets are dropped until the registry fits, apart from the one just used
+    lru_ds_names = sorted(_dataset_registry.keys(), key=lambda d: _dataset_registry[d]['last_used'])
+    tot_bytes = sum([get_dataset_nbytes(e) for e in _dataset_registry.values()])
+
+    for ds_short_name in lru_ds_names:
+        if tot_bytes <= max_bytes: break
+        if ds_short_name == keep_ds_short_name: continue
+        tot_bytes -= get_dataset_nbytes(_dataset_registry.pop(ds_short_name))
+
+
+def register_dataset(det_store):
+    # Makes an already loaded detection store (with its short_name set) the one handed out for its dataset
+    ds_short_name = det_store['short_name']
+    meta_fingerprint = get_file_fingerprint(os.path.join(get_det_store_dir(ds_short_name), 'meta.json'))
+    entry = _dataset_registry.get(ds_short_name)
+    if entry is None or entry['det_store'] is not det_store:
+        _dataset_registry[ds_short_name] = {'det_store': det_store, 'meta_fingerprint': meta_fingerprint}
+    _dataset_registry[ds_short_name]['last_used'] = time.monotonic()
+    enforce_dataset_cap(ds_short_name)
+
+    return det_store
+
+
+def get_dataset(ds):
+    # The shared detection store (every column memory-mapped) of ds, which can be a short name, an entry of 
+    # get_datasets_dict or a store from an earlier call. It is reloaded if the store on disk has changed since
+    if isinstance(ds, dict) and 'n_dets' in ds.keys(): return register_dataset(ds)
+    ds_short_name = ds if isinstance(ds, str) else ds['short_name']
+
+    update_det_store(ds_short_name)
+    meta_fingerprint = get_file_fingerprint(os.path.join(get_det_store_dir(ds_short_name), 'meta.json'))
+    entry = _dataset_registry.get(ds_short_name)
+    if entry is not None and entry['meta_fingerprint'] == meta_fingerprint:
+        entry['last_used'] = time.monotonic()
+        return entry['det_store']
+
+    det_store = load_det_store(ds_short_name)
+    det_store['short_name'] = ds_short_name
+    return register_dataset(det_store)
+
+
+def get_dataset_floor_dets(ds):
+    # Detections of ds over the BirdNET floor, expanded once per dataset
+    det_store = get_dataset(ds)
+    entry = _dataset_registry[det_store['short_name']]
+    if 'floor_dets' not in entry.keys():
+        entry['floor_dets'] = expand_to_valid_dets(det_store, DET_FLOOR_THRESH)
+        enforce_dataset_cap(det_store['short_name'])
+
+    return entry['floor_dets']
+
+
+def use_dataset(ds):
+    # Short name of ds (as get_dataset takes it), a passed in detection store being registered so the 
+    # calls ds goes on to reuse it rather than loading their own
+    if isinstance(ds, str): return ds
+    if 'n_dets' in ds.keys(): register_dataset(ds)
+    return ds['short_name']
+
+
+def evict_dataset(ds_short_name=None):
+    # Drops one dataset from the registry, or all of them
+    if ds_short_name is None: _dataset_registry.clear()
+    else: _dataset_registry.pop(ds_short_name, None)
+
+
+def publish_array(arr, shared_dir):
+    # Writes arr to shared_dir once, returning what attach_array needs to memory-map it (a small, picklable dict)
+    arr = np.ascontiguousarray(arr)
+    arr_path = os.path.join(shared_dir, '{}.bin'.format(len(os.listdir(shared_dir))))
+    arr.tofile(arr_path)
+    return {'shared_path': arr_path, 'dtype': arr.dtype.str, 'shape': arr.shape}
+
+
+def attach_array(arr_handle):
+    if np.prod(arr_handle['shape']) == 0: return np.empty(arr_handle['shape'], dtype=arr_handle['dtype'])
+    return np.memmap(arr_handle['shared_path'], dtype=arr_handle['dtype'], mode='r', shape=arr_handle['shape'])
+
+
+def is_shared_array_handle(arg):
+    return isinstance(arg, dict) and 'shared_path' in arg.keys()
+
+
+def is_registered_disk_store(det_store):
+    # Whether det_store is the registry's store for its dataset, with every column memory-mapped from its store directory
+    if 'short_name' not in det_store.keys() or _dataset_registry.get(det_store['short_name'], {}).get('det_store') is not det_store:
+        return False
+    return all([isinstance(det_store[c], np.memmap) or len(det_store[c]) == 0 for c in DET_STORE_COLUMNS.keys()])
+
+
+def publish_det_store(det_store, shared_dir):
+    # A store loaded from disk by get_dataset is attached to by name, as workers can memory-map the same
+    # column files, anything else (such as a filtered or generated store) has its arrays published
+    if is_registered_disk_store(det_store): return {'short_name': det_store['short_name']}
+
+    return {'det_store': {k: publish_array(v, shared_dir) if isinstance(v, np.ndarray) and (k.startswith('det_') or k.startswith('file_'))
+                          else v for k, v in det_store.items()}}
+
+
+def attach_det_store(det_store_handle):
+    if 'short_name' in det_store_handle.keys(): return get_dataset(det_store_handle['short_name'])
+    return {k: attach_array(v) if is_shared_array_handle(v) else v for k, v in det_store_handle['det_store'].items()}
+
+
+def get_det_partition_bounds(n_dets, n_parts):
+    bounds = np.linspace(0, n_dets, n_parts + 1).astype('int64')
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def slice_det_store(det_store, start_det_ix, end_det_ix):
+    # Detections start_det_ix - end_det_ix as a store of their own (views of the columns, nothing is copied). 
+    # File columns are left whole, so det_file_ixs still index them
+    det_store_part = {k: v[start_det_ix:end_det_ix] if k.startswith('det_') else v for k, v in det_store.items() if k != 'spec_n_dets'}
+    det_store_part['n_dets'] = end_det_ix - start_det_ix
+    return det_store_part
+
+
+def run_det_partition(det_store_handle, start_det_ix, end_det_ix, part_fn, part_args):
+    det_store = attach_det_store(det_store_handle)
+    part_args = [attach_array(a) if is_shared_array_handle(a) else a for a in part_args]
+    return part_fn(slice_det_store(det_store, start_det_ix, end_det_ix), *part_args)
+
+
+def map_det_partitions(det_store, part_fn, part_args=(), workers=1):
+    # part_fn(det_store_part, *part_args) for contiguous partitions of the detections, spread over worker processes. 
+    # Workers memory-map the columns (and any array arguments) rather than being sent copies. part_fn has to be a 
+    # module level function, and its results are returned in detection order for the caller to combine
+    if workers <= 1 or det_store['n_dets'] < DET_PARTITION_MIN_ROWS: return [part_fn(det_store, *part_args)]
+
+    shared_dir = tempfile.mkdtemp(prefix='bird_shared_', dir=SHARED_ARRAY_DIR)
+    try:
+        det_store_handle = publish_det_store(det_store, shared_dir)
+        part_args = [publish_array(a, shared_dir) if isinstance(a, np.ndarray) else a for a in part_args]
+
+        part_bounds = get_det_partition_bounds(det_store['n_dets'], workers)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(run_det_partition, [det_store_handle] * workers, [b[0] for b in part_bounds], [b[1] for b in part_bounds],
+                                     [part_fn] * workers, [part_args] * workers))
+    finally:
+        shutil.rmtree(shared_dir, ignore_errors=True)
+
+
+@profiled(n_items=lambda query_index: len(query_index['time_order']))
+def build_query_index(det_store):
+    # Detection rows ordered by time, by species then time and by site then time. Each ordering has the detection
+    # times in that order and every key's offset into it, so the rows of any key and time range are found by
+    # binary search
+    det_epochs = np.asarray(det_store['det_epochs'])
+    det_keys = {'time': np.zeros(det_store['n_dets'], dtype='int64'), 'spec': np.asarray(det_store['det_spec_ixs'], dtype='int64'),
+                'site': np.asarray(det_store['file_site_ixs'], dtype='int64')[det_store['det_file_ixs']]}
+    n_keys = {'time': 1, 'spec': len(det_store['spec_names']), 'site': len(det_store['site_names'])}
+    order_dtype = get_min_uint_dtype(max(det_store['n_dets'] - 1, 0))
+
+    query_index = {}
+    for k in QUERY_INDEX_KEYS:
+        key_order = np.lexsort((det_epochs, det_keys[k]))
+        query_index['{}_order'.format(k)] = key_order.astype(order_dtype)
+        query_index['{}_epochs'.format(k)] = det_epochs[key_order]
+        query_index['{}_offsets'.format(k)] = np.concatenate([[0], np.cumsum(np.bincount(det_keys[k], minlength=n_keys[k]))]).astype('int64')
+
+    # Every detection's species code * 2 + confidence, sorted, so each species' confidences are sorted within 
+    # its spec_offsets range and counts over any thresholds are one binary search (see get_spec_conf_counts)
+    query_index['spec_conf_keys'] = np.sort(det_keys['spec'] * 2 + np.asarray(det_store['det_confs'], dtype='float64'))
+
+    return query_index
+
+
+def read_query_index(index_dir, meta_fingerprint):
+    # The query index in index_dir memory-mapped, or None if it is missing or was built from a different store meta.json
+    index_meta_path = os.path.join(index_dir, 'meta.json')
+    if not os.path.exists(index_meta_path): return None
+    with open(index_meta_path, 'r') as f_handle:
+        index_meta = json.load(f_handle)
+    if index_meta['meta_fingerprint'] != meta_fingerprint or index_meta.get('version') != QUERY_INDEX_VERSION: return None
+
+    query_index = {}
+    for k, (dtype, n_rows) in index_meta['arrays'].items():
+        if n_rows == 0: query_index[k] = np.empty(0, dtype=dtype)
+        else: query_index[k] = np.memmap(os.path.join(index_dir, '{}.bin'.format(k)), dtype=dtype, mode='r', shape=(n_rows,))
+
+    return query_index
+
+
+def load_query_index(det_store):
+    # Query index of a store loaded from disk, kept in its store directory and rebuilt whenever the store's 
+    # meta.json has changed since. It is written next to the store and swapped in once complete
+    store_dir = get_det_store_dir(det_store['short_name'])
+    index_dir = os.path.join(store_dir, QUERY_INDEX_DIR_NAME)
+    meta_fingerprint = get_file_fingerprint(os.path.join(store_dir, 'meta.json'))
+
+    query_index = read_query_index(index_dir, meta_fingerprint)
+    if query_index is not None: return query_index
+
+    query_index = build_query_index(det_store)
+    tmp_index_dir = tempfile.mkdtemp(prefix='{}.'.format(QUERY_INDEX_DIR_NAME), dir=store_dir)
+    for k, arr in query_index.items():
+        arr.tofile(os.path.join(tmp_index_dir, '{}.bin'.format(k)))
+    with open(os.path.join(tmp_index_dir, 'meta.json'), 'w') as f_handle:
+        json.dump({'version': QUERY_INDEX_VERSION, 'meta_fingerprint': meta_fingerprint, 
+                   'arrays': {k: [str(v.dtype), len(v)] for k, v in query_index.items()}}, f_handle)
+
+    if os.path.exists(index_dir): shutil.rmtree(index_dir, ignore_errors=True)
+    try:
+        os.rename(tmp_index_dir, index_dir)
+    except OSError:
+        # Another process got there first
+        shutil.rmtree(tmp_index_dir, ignore_errors=True)
+
+    return read_query_index(index_dir, meta_fingerprint) or query_index
+
+
+def get_query_index(det_store):
+    # The query index of det_store, kept with its dataset when det_store is the registry's. Stores loaded from disk
+    # have theirs persisted next to the store, any other store (such as a generated one) gets one built in memory
+    if 'short_name' not in det_store.keys() or _dataset_registry.get(det_store['short_name'], {}).get('det_store') is not det_store:
+        return build_query_index(det_store)
+
+    entry = _dataset_registry[det_store['short_name']]
+    if 'query_index' not in entry.keys():
+        if is_registered_disk_store(det_store): entry['query_index'] = load_query_index(det_store)
+        else: entry['query_index'] = build_query_index(det_store)
+        enforce_dataset_cap(det_store['short_name'])
+
+    return entry['query_index']
+
+
+def get_spec_conf_counts(det_store, bn_conf_thresh=0.8, strict=False):
+    # Detections of each species code with confidence over bn_conf_thresh, which can be a scalar, a dict of per species
+    # thresholds (species missing from it count nothing) or an array of thresholds with species codes along its last
+    # axis, e.g. thresholds x species for a whole grid at once. Counted by binary search in the sorted confidences
+    # of the query index, so the detections are never scanned
+    query_index = get_query_index(det_store)
+    n_specs = len(det_store['spec_names'])
+    if isinstance(bn_conf_thresh, dict) or np.ndim(bn_conf_thresh) == 0: 
+        bn_conf_thresh = get_spec_thresh_lookup(det_store['spec_names'], bn_conf_thresh)
+
+    # Thresholds compare with the float32 confidences as in expand_to_valid_dets, and are kept within 
+    # each species' key range (confidences are in [0, 1])
+    spec_threshs = np.clip(np.asarray(bn_conf_thresh, dtype='float32').astype('float64'), -0.5, 1.5)
+    spec_ixs = np.arange(n_specs)
+    thresh_key_ixs = np.searchsorted(query_index['spec_conf_keys'], spec_ixs * 2 + spec_threshs, 'right' if strict else 'left')
+
+    return query_index['spec_offsets'][spec_ixs + 1] - thresh_key_ixs
+
+
+def get_name_codes(all_names, names):
+    # Unique codes of names within all_names, names that aren't there being left out
+    name_codes = {s: ix for ix, s in enumerate(all_names)}
+    return np.unique(np.asarray([name_codes[s] for s in names if s in name_codes.keys()], dtype='int64'))
+
+
+def searchsorted_ranges(vals, range_starts, range_ends, v, side='left'):
+    # np.searchsorted of v in each of the sorted ranges vals[range_starts[i]:range_ends[i]], as positions in vals,
+    # bisecting all the ranges together rather than one at a time
+    lo, hi = np.array(range_starts, dtype='int64'), np.array(range_ends, dtype='int64')
+    while np.any(lo < hi):
+        is_open = lo < hi
+        mid = (lo + hi) // 2
+        mid_vals = vals[np.minimum(mid, len(vals) - 1)]
+        go_right = is_open & ((mid_vals < v) if side == 'left' else (mid_vals <= v))
+        lo = np.where(go_right, mid + 1, lo)
+        hi = np.where(is_open & ~go_right, mid, hi)
+    return lo
+
+
+def get_query_rows(query_index, key, key_ixs, start_epoch, end_epoch):
+    # Rows of the given keys recorded from start_epoch to end_epoch inclusive, in store order. The ranges are found
+    # and gathered for all the keys at once, and only sorted if they don't come out in store order already
+    key_offsets = query_index['{}_offsets'.format(key)]
+    key_epochs = query_index['{}_epochs'.format(key)]
+    key_order = query_index['{}_order'.format(key)]
+
+    key_ixs = np.asarray(key_ixs, dtype='int64')
+    range_starts, range_ends = key_offsets[key_ixs], key_offsets[key_ixs + 1]
+    if start_epoch > np.iinfo('int64').min: range_starts = searchsorted_ranges(key_epochs, range_starts, range_ends, start_epoch, 'left')
+    if end_epoch < np.iinfo('int64').max: range_ends = searchsorted_ranges(key_epochs, range_starts, range_ends, end_epoch, 'right')
+
+    range_lens = np.maximum(range_ends - range_starts, 0)
+    range_firsts = np.cumsum(range_lens) - range_lens
+    row_positions = np.repeat(range_starts - range_firsts, range_lens) + np.arange(np.sum(range_lens), dtype='int64')
+    rows = np.asarray(key_order[row_positions], dtype='int64')
+
+    if np.any(rows[1:] < rows[:-1]): rows.sort()
+    return rows
+
+
+@profiled(n_items=lambda sel_dets: sel_dets['n_dets'])
+def select_dets(det_store, species=None, sites=None, start=None, end=None, min_conf=None):
+    # Detections of the given species and sites (lists of names, None for all) recorded from start to end inclusive
+    # (datetimes or epochs, None for no bound) with confidence of at least min_conf (scalar or dict of per species
+    # thresholds), as a store-like table like expand_to_valid_dets returns, with each row's store index in det_ixs.
+    # Rows are found through the query index by species or by site, whichever has fewer, so only matching time 
+    # ranges are read
+    query_index = get_query_index(det_store)
+    start_epoch = np.iinfo('int64').min if start is None else start if not isinstance(start, datetime) else dt_to_epoch(start)
+    end_epoch = np.iinfo('int64').max if end is None else end if not isinstance(end, datetime) else dt_to_epoch(end)
+
+    key_ixs = {}
+    if species is not None: key_ixs['spec'] = get_name_codes(det_store['spec_names'], species)
+    if sites is not None: key_ixs['site'] = get_name_codes(det_store['site_names'], sites)
+
+    if len(key_ixs) == 0:
+        det_ixs = get_query_rows(query_index, 'time', [0], start_epoch, end_epoch)
+    else:
+        key_n_dets = {k: np.sum(query_index['{}_offsets'.format(k)][ixs + 1] - query_index['{}_offsets'.format(k)][ixs]) 
+                      for k, ixs in key_ixs.items()}
+        query_key = min(key_n_dets.keys(), key=lambda k: key_n_dets[k])
+        det_ixs = get_query_rows(query_index, query_key, key_ixs[query_key], start_epoch, end_epoch)
+
+    det_spec_ixs = det_store['det_spec_ixs'][det_ixs]
+    det_site_ixs = det_store['file_site_ixs'][det_store['det_file_ixs'][det_ixs]]
+
+    keep_dets = np.ones(len(det_ixs), dtype='bool')
+    if 'spec' in key_ixs.keys():
+        is_query_spec = np.zeros(len(det_store['spec_names']), dtype='bool')
+        is_query_spec[key_ixs['spec']] = True
+        keep_dets &= is_query_spec[det_spec_ixs]
+    if 'site' in key_ixs.keys():
+        is_query_site = np.zeros(len(det_store['site_names']), dtype='bool')
+        is_query_site[key_ixs['site']] = True
+        keep_dets &= is_query_site[det_site_ixs]
+    if min_conf is not None:
+        keep_dets &= det_store['det_confs'][det_ixs] >= get_spec_thresh_lookup(det_store['spec_names'], min_conf)[det_spec_ixs]
+
+    sel_dets = {k: v for k, v in det_store.items() if not k.startswith('det_') and k != 'spec_n_dets'}
+    sel_dets['det_ixs'] = det_ixs[keep_dets]
+    for c in det_store.keys():
+        if c.startswith('det_'): sel_dets[c] = det_store[c][sel_dets['det_ixs']]
+    sel_dets['det_site_ixs'] = det_site_ixs[keep_dets]
+    sel_dets['n_dets'] = len(sel_dets['det_ixs'])
+
+    return sel_dets
+
+
+def get_file_fingerprint(path):
+    if not os.path.exists(path): return None
+    f_stat = os.stat(path)
+    return [os.path.basename(path), f_stat.st_size, f_stat.st_mtime_ns]
+
+
+def update_det_store(ds_short_name):
+    # (Re)builds the detection store from the combined pickle if it is out of date, returning whether it was
+    if not det_store_is_stale(ds_short_name): return False
+    build_det_store(ds_short_name)
+    return True
+
+
+def get_ds_input_paths(ds_short_name, labelled=True):
+    # Files a dataset's results depend on, after making sure the detection store is up to date
+    update_det_store(ds_short_name)
+
+    input_paths = [get_comb_dets_path(ds_short_name), os.path.join(get_det_store_dir(ds_short_name), 'meta.json')]
+    if labelled: input_paths.append(get_labelled_clips_path(ds_short_name))
+
+    return input_paths
 
-    all_det_specs = np.asarray([d['common_name'] for d in all_dets])
-    all_valid_det_specs = np.asarray([d['common_name'] for d in all_valid_dets])
+
+def log_cache_event(cache_dir, event, cache_entry, secs=0):
+    with open(os.path.join(cache_dir, CACHE_LOG_NAME), 'a') as f_handle:
+        f_handle.write('{},{},{},{:.3f}\n'.format(datetime.now().isoformat(timespec='seconds'), event, cache_entry, secs))
+
+
+def evict_cache(cache_dir=FIG_CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+    # Least recently used entries go first, reads refresh an entry's mtime
+    cache_fs = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith('.pickle')]
+    cache_fs = sorted(cache_fs, key=os.path.getmtime)
+    tot_bytes = sum([os.path.getsize(f) for f in cache_fs])
+
+    for cache_f in cache_fs[:-1]:
+        if tot_bytes <= max_bytes: break
+        tot_bytes -= os.path.getsize(cache_f)
+        os.remove(cache_f)
+        log_cache_event(cache_dir, 'evict', os.path.splitext(os.path.basename(cache_f))[0])
+
+
+def cached_compute(cache_name, params, input_paths, compute_fn, force_compute=False, cache_dir=FIG_CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+    # Returns compute_fn() from the cache when an entry exists for the same name, parameters and input
+    # file fingerprints (so results are only reused while they are valid), otherwise computes and stores it
+    cache_key = json.dumps([cache_name, params, [get_file_fingerprint(p) for p in input_paths]], sort_keys=True, default=str)
+    cache_hash = hashlib.sha1(cache_key.encode('utf-8')).hexdigest()[:16]
+    cache_entry = '{}_{}'.format(cache_name, cache_hash)
+    cache_path = os.path.join(cache_dir, '{}.pickle'.format(cache_entry))
+
+    if not os.path.exists(cache_dir): os.makedirs(cache_dir, exist_ok=True)
+
+    with stage('cache:{}'.format(cache_name)) as stage_rec:
+        if os.path.exists(cache_path) and not force_compute:
+            # An entry that can't be read (e.g. left half written by an older version, or evicted meanwhile) is a miss
+            try:
+                with open(cache_path, 'rb') as f_handle:
+                    res = pickle.load(f_handle)
+                os.utime(cache_path)
+                log_cache_event(cache_dir, 'hit', cache_entry)
+                stage_rec['info'] = 'hit'
+                return res
+            except (pickle.UnpicklingError, EOFError, FileNotFoundError):
+                pass
+
+        start_t = time.time()
+        res = compute_fn()
+        # Written next to the entry and moved into place, so processes sharing the cache never read a partial entry
+        tmp_cache_path = '{}.tmp.{}'.format(cache_path, os.getpid())
+        with open(tmp_cache_path, 'wb') as handle:
+            pickle.dump(res, handle)
+        os.replace(tmp_cache_path, cache_path)
+        log_cache_event(cache_dir, 'force' if force_compute else 'miss', cache_entry, time.time() - start_t)
+        stage_rec['info'] = 'force' if force_compute else 'miss'
+
+        evict_cache(cache_dir, max_bytes)
+
+    return res
+
+
+def get_opt_spec_bn_threshs(ds_short_name, target_prec=0.9, use_cache=True, thresh_step=None, select_by='point', ci_method='bootstrap', 
+                            conf_level=0.95, n_boot=10000, workers=1):
+    # select_by='lower' picks each species' threshold by the lower bound of its precision confidence interval 
+    # (and reports that bound as its precision) rather than by the point estimate. ds_short_name can also be
+    # a dataset from get_dataset
+    ds_short_name = use_dataset(ds_short_name)
+    calib_args = (ds_short_name, target_prec, thresh_step, select_by, ci_method, conf_level, n_boot, workers)
+    if not use_cache: return compute_opt_spec_bn_threshs(*calib_args)
+
+    # Results are keyed on the inputs, so any change to the detections or the labelled 
+    # spreadsheet leads to a fresh calibration
+    params = {'target_prec': float(target_prec), 'thresh_step': thresh_step}
+    if select_by != 'point': params.update({'select_by': select_by, 'ci_method': ci_method, 'conf_level': conf_level, 'n_boot': n_boot})
+    return cached_compute('calib_{}'.format(ds_short_name), params, get_ds_input_paths(ds_short_name), 
+                          lambda: compute_opt_spec_bn_threshs(*calib_args), cache_dir=CALIB_CACHE_DIR)
+
+
+def get_opt_spec_prec_cis(ds_short_name, target_prec=0.9, thresh_step=None, select_by='point', ci_method='bootstrap', conf_level=0.95, 
+                          n_boot=10000, workers=1):
+    # Lower and upper precision bounds at each species' calibrated threshold, in the order of get_opt_spec_bn_threshs
+    ds_short_name = use_dataset(ds_short_name)
+    calib_args = (ds_short_name, target_prec, thresh_step, select_by, ci_method, conf_level, n_boot, workers)
+    params = {'target_prec': float(target_prec), 'thresh_step': thresh_step, 'select_by': select_by, 'ci_method': ci_method, 
+              'conf_level': conf_level, 'n_boot': n_boot}
+    return cached_compute('calib_cis_{}'.format(ds_short_name), params, get_ds_input_paths(ds_short_name), 
+                          lambda: compute_opt_spec_prec_cis(*calib_args), cache_dir=CALIB_CACHE_DIR)
+
+
+def round_bn_thresh(bn_thresh, thresh_step=None):
+    # Exact thresholds sit on a clip confidence, so rounding could let through clips below it
+    if thresh_step == 'exact': return bn_thresh
+    return np.round(bn_thresh, 3)
+
+
+def get_spec_calib_curves(ds_short_name, thresh_step=None, ci_method=None, conf_level=0.95, n_boot=10000, workers=1):
+    # Precision of each species with labelled clips over the lowest threshold at every candidate threshold 
+    # (-1 where it has no clips), with lower/upper confidence bounds (nan where no clips) if ci_method is given
+    bn_confs, all_clip_specs, all_decisions = read_labelled_clips(get_labelled_clips_path(ds_short_name))
+    bn_thresh_vals = get_bn_thresh_vals(bn_confs, thresh_step)
+
+    props, num_clips, unq_specs = get_spec_precision_curves(bn_confs, all_clip_specs, all_decisions, bn_thresh_vals)
+
+    # Only species with labelled clips over the lowest threshold are calibrated
+    calib_spec_ixs = np.where((num_clips[0] > 0))[0]
+    curves = {'specs': unq_specs[calib_spec_ixs], 'bn_thresh_vals': bn_thresh_vals, 'num_clips': num_clips[:, calib_spec_ixs]}
+    curves['precs'] = props[:, calib_spec_ixs, 0]
+    curves['precs'][curves['num_clips'] == 0] = -1
+
+    if ci_method is not None:
+        prec_lower, prec_upper, _ = get_precision_cis(bn_confs, all_clip_specs, all_decisions, bn_thresh_vals, ci_method, conf_level, 
+                                                      n_boot, workers)
+        curves['prec_lower'], curves['prec_upper'] = prec_lower[:, calib_spec_ixs], prec_upper[:, calib_spec_ixs]
+
+    return curves
+
+
+def select_spec_bn_thresh_ixs(spec_precs, target_prec=0.9):
+    # For each species (column), the first threshold reaching target_prec, or the one with the best precision
+    thresh_ixs = []
+    for spec_ix in range(spec_precs.shape[1]):
+        if max(spec_precs[:, spec_ix]) > target_prec:
+            thresh_ixs.append(np.where((spec_precs[:, spec_ix] >= target_prec))[0][0])
+        else:
+            thresh_ixs.append(np.argmax(spec_precs[:, spec_ix]))
+
+    return np.asarray(thresh_ixs, dtype='int64')
+
+
+def get_selection_precs(curves, select_by='point'):
+    if select_by == 'point': return curves['precs']
+    if select_by == 'lower': return np.where(np.isnan(curves['prec_lower']), -1, curves['prec_lower'])
+    raise ValueError('select_by should be point or lower, not {}'.format(select_by))
+
+
+def compute_opt_spec_prec_cis(ds_short_name, target_prec=0.9, thresh_step=None, select_by='point', ci_method='bootstrap', conf_level=0.95, 
+                              n_boot=10000, workers=1):
+    curves = get_spec_calib_curves(ds_short_name, thresh_step, ci_method, conf_level, n_boot, workers)
+    thresh_ixs = select_spec_bn_thresh_ixs(get_selection_precs(curves, select_by), target_prec)
+
+    spec_ixs = np.arange(len(curves['specs']))
+    return curves['prec_lower'][thresh_ixs, spec_ixs], curves['prec_upper'][thresh_ixs, spec_ixs]
+
+
+@profiled(n_items=lambda res: len(res[0]))
+def compute_opt_spec_bn_threshs(ds_short_name, target_prec=0.9, thresh_step=None, select_by='point', ci_method='bootstrap', conf_level=0.95, 
+                                n_boot=10000, workers=1):
+    ds_short_name = use_dataset(ds_short_name)
+    curves = get_spec_calib_curves(ds_short_name, thresh_step, None if select_by == 'point' else ci_method, conf_level, n_boot, workers)
+    all_specs = curves['specs']
+    all_specs_precs = get_selection_precs(curves, select_by)
+
+    thresh_ixs = select_spec_bn_thresh_ixs(all_specs_precs, target_prec)
+    prec_at_opt_threshs = all_specs_precs[thresh_ixs, np.arange(len(all_specs))]
+    opt_spec_bn_threshs = {spec: round_bn_thresh(curves['bn_thresh_vals'][t_ix], thresh_step) for spec, t_ix in zip(all_specs, thresh_ixs)}
+    
+    # Counted in the store's sorted confidences (over the BirdNET floor as well as the calibrated thresholds)
+    det_store = get_dataset(ds_short_name)
+    floor_spec_bn_threshs = {spec: max(bn_thresh, DET_FLOOR_THRESH) for spec, bn_thresh in opt_spec_bn_threshs.items()}
+    all_det_spec_counts = get_spec_conf_counts(det_store, DET_FLOOR_THRESH)
+    all_valid_det_spec_counts = get_spec_conf_counts(det_store, floor_spec_bn_threshs)
+    store_spec_codes = {s: ix for ix, s in enumerate(det_store['spec_names'])}
     
     num_spec_dets = []
     num_valid_spec_dets = []
     for spec_ix, spec in enumerate(all_specs):
-        num_spec_dets.append(len(np.where((all_det_specs == spec))[0]))
-        num_valid_spec_dets.append(len(np.where((all_valid_det_specs == spec))[0]))
+        if spec not in store_spec_codes:
+            num_spec_dets.append(0)
+            num_valid_spec_dets.append(0)
+        else:
+            num_spec_dets.append(all_det_spec_counts[store_spec_codes[spec]])
+            num_valid_spec_dets.append(all_valid_det_spec_counts[store_spec_codes[spec]])
 
-    prec_at_opt_threshs = np.asarray(prec_at_opt_threshs)
     num_spec_dets = np.asarray(num_spec_dets)
     num_valid_spec_dets = np.asarray(num_valid_spec_dets)
 
@@ -60,33 +870,265 @@ def get_opt_spec_bn_threshs(ds_short_name, target_prec=0.9):
 
 
 def get_datasets_dict():
-    return [{'short_name': 'norway', 'name': 'Norway', 'mins_per_f': 5},
-            {'short_name': 'taiwan', 'name': 'Taiwan'},
-            {'short_name': 'costa-rica', 'name': 'Costa Rica', 'mins_per_f': 1},
-            {'short_name': 'brazil', 'name': 'Brazil', 'mins_per_f': 1}]
+    # tz is set for stores holding tz aware (UTC) times, wall_clock_tz is where the naive times of the others were recorded
+    return [{'short_name': 'norway', 'name': 'Norway', 'mins_per_f': 5, 'wall_clock_tz': 'Europe/Oslo'},
+            {'short_name': 'taiwan', 'name': 'Taiwan', 'wall_clock_tz': 'Asia/Taipei'},
+            {'short_name': 'costa-rica', 'name': 'Costa Rica', 'mins_per_f': 1, 'wall_clock_tz': 'America/Costa_Rica'},
+            {'short_name': 'brazil', 'name': 'Brazil', 'mins_per_f': 1, 'tz': 'Brazil/East'}]
 
 
-def expand_to_valid_dets(all_f_dets, bn_conf_thresh=0.80):
-    all_valid_dets = []
-    for f_dets in all_f_dets:
-        for d in f_dets['dets']:
-            if isinstance(bn_conf_thresh, dict):
-                if d['common_name'] not in bn_conf_thresh.keys(): continue
-                else: min_det_conf = bn_conf_thresh[d['common_name']]
-            else: min_det_conf = bn_conf_thresh
+def get_spec_thresh_lookup(spec_names, bn_conf_thresh):
+    # Per species code confidence thresholds, species missing from a threshold dict can never pass
+    if isinstance(bn_conf_thresh, dict):
+        spec_threshs = np.full(len(spec_names), np.inf, dtype='float32')
+        for spec_ix, spec in enumerate(spec_names):
+            if spec in bn_conf_thresh.keys(): spec_threshs[spec_ix] = bn_conf_thresh[spec]
+        return spec_threshs
+
+    return np.full(len(spec_names), bn_conf_thresh, dtype='float32')
+
+
+@profiled(n_items=lambda all_valid_dets: all_valid_dets['n_dets'])
+def expand_to_valid_dets(det_store, bn_conf_thresh=0.80, strict=False):
+    # Accepts a detection store (or the output of a previous call) and returns a store-like table 
+    # holding only the detections passing bn_conf_thresh (scalar or dict of per species thresholds).
+    # A list of per-file dicts in the combined pickle format is converted first and left untouched
+    if not isinstance(det_store, dict): det_store = f_dets_to_det_store(det_store)
+
+    spec_threshs = get_spec_thresh_lookup(det_store['spec_names'], bn_conf_thresh)
+    det_spec_threshs = spec_threshs[det_store['det_spec_ixs']]
+    if strict: keep_det_ixs = np.where((det_store['det_confs'] > det_spec_threshs))[0]
+    else: keep_det_ixs = np.where((det_store['det_confs'] >= det_spec_threshs))[0]
+
+    # Per species counts of the input no longer apply to the filtered detections
+    all_valid_dets = {k: v for k, v in det_store.items() if not k.startswith('det_') and k != 'spec_n_dets'}
+    for c, vals in det_store.items():
+        if c.startswith('det_'): all_valid_dets[c] = vals[keep_det_ixs]
+    all_valid_dets['n_dets'] = len(keep_det_ixs)
+
+    if 'det_site_ixs' not in all_valid_dets.keys() and 'det_file_ixs' in all_valid_dets.keys() and 'file_site_ixs' in det_store.keys():
+        all_valid_dets['det_site_ixs'] = det_store['file_site_ixs'][all_valid_dets['det_file_ixs']]
+
+    return all_valid_dets
+
+
+def get_det_day_nums(all_dets):
+    # Integer day numbers (days since 1970-01-01) of each detection
+    return np.floor_divide(all_dets['det_epochs'], 86400)
+
+
+def day_nums_to_strs(day_nums):
+    # Day keys in the same '%Y-%m-%d' format strftime gives on the detection datetimes
+    return np.datetime_as_string(np.asarray(day_nums).astype('datetime64[D]'), unit='D')
+
+
+def get_det_days(all_dets):
+    return day_nums_to_strs(get_det_day_nums(all_dets))
+
+
+def get_tz(tz):
+    # tz can be None (UTC), a fixed offset in hours, a tzinfo or a tz database name such as 'Brazil/East'
+    if tz is None: return timezone.utc
+    if isinstance(tz, (int, float)): return timezone(timedelta(hours=tz))
+    if isinstance(tz, str):
+        import pytz
+        return pytz.timezone(tz)
+    return tz
+
+
+def get_utc_offsets(epochs, tz=None):
+    # UTC offsets in seconds of each epoch. Offsets only change on the hour, so the tz database is 
+    # looked up once per distinct hour rather than once per epoch
+    epochs = np.asarray(epochs, dtype='int64')
+    tz = get_tz(tz)
+
+    unq_hr_nums, hr_num_ixs = np.unique(epochs // 3600, return_inverse=True)
+    hr_offsets = np.asarray([(EPOCH_DT_UTC + timedelta(hours=int(h))).astimezone(tz).utcoffset().total_seconds() for h in unq_hr_nums], 
+                            dtype='int64')
+
+    return hr_offsets[hr_num_ixs].reshape(epochs.shape)
+
+
+def get_local_epochs(epochs, tz=None):
+    # Local wall clock times as seconds since 1970-01-01, naive epochs are taken to be UTC
+    epochs = np.asarray(epochs, dtype='int64')
+    return epochs + get_utc_offsets(epochs, tz)
+
+
+def get_local_day_nums(epochs, tz=None):
+    return np.floor_divide(get_local_epochs(epochs, tz), 86400)
+
+
+def get_weighted_median(vals, weights):
+    # Value at which the cumulative weight (over the non NaN values, in value order) reaches half, NaN if there are none
+    vals = np.asarray(vals, dtype='float64')
+    weights = np.asarray(weights, dtype='float64')
+    keep_ixs = np.where((~np.isnan(vals)))[0]
+    if len(keep_ixs) == 0: return np.nan
+
+    sort_ixs = keep_ixs[np.argsort(vals[keep_ixs], kind='stable')]
+    cum_weights = np.cumsum(weights[sort_ixs])
+    return vals[sort_ixs[np.searchsorted(cum_weights, cum_weights[-1] / 2)]]
+
+
+def get_spec_row_lookup(spec_names, row_specs):
+    # Maps species codes to their row in row_specs, -1 for species not in row_specs
+    spec_rows = np.full(len(spec_names), -1, dtype='int64')
+    spec_codes = {s: ix for ix, s in enumerate(spec_names)}
+    for row_ix, spec in enumerate(row_specs):
+        if spec in spec_codes: spec_rows[spec_codes[spec]] = row_ix
+
+    return spec_rows
+
+
+def get_min_uint_dtype(max_val):
+    for dtype in ['uint8', 'uint16', 'uint32']:
+        if max_val <= np.iinfo(dtype).max: return dtype
+    return 'uint64'
+
+
+@profiled(n_items=lambda cube: cube['counts'].size)
+def build_spec_site_day_cube(det_store, bn_conf_thresh=0.8, start_dt=None, end_dt=None, site_groups=None):
+    # Detection counts per species x site x day (for all species at once) over the days from start_dt to 
+    # end_dt inclusive, or the whole recording period. Species without detections are left out and counts 
+    # use the smallest unsigned int type that fits. site_groups optionally names a group for each store site,
+    # sites of a group being counted together. spec_site_lats holds the latitude of each species' first 
+    # detection (in store order) at each site or group
+    if start_dt is None: start_epoch = np.min(det_store['file_epochs'])
+    else: start_epoch = dt_to_epoch(start_dt)
+
+    # Without an end_dt the window runs to the last detection over the threshold, or is a single day if there are none
+    window_dets = select_dets(det_store, start=start_epoch, end=None if end_dt is None else dt_to_epoch(end_dt), min_conf=bn_conf_thresh)
+    if end_dt is None: end_epoch = int(np.max(window_dets['det_epochs'], initial=start_epoch))
+    else: end_epoch = dt_to_epoch(end_dt)
+
+    if site_groups is None: site_groups = det_store['site_names']
+    cube_sites, store_site_cube_ixs = np.unique(np.asarray(site_groups, dtype='str'), return_inverse=True)
+
+    det_spec_ixs = window_dets['det_spec_ixs'].astype('int64')
+    det_site_ixs = store_site_cube_ixs[window_dets['det_site_ixs']].astype('int64')
+    first_day_num = start_epoch // 86400
+    det_day_ixs = window_dets['det_epochs'] // 86400 - first_day_num
+    n_days = int(end_epoch // 86400 - first_day_num + 1)
+
+    cube_specs, det_cube_spec_ixs = np.unique(det_spec_ixs, return_inverse=True)
+    n_sites = len(cube_sites)
+    counts = np.bincount((det_cube_spec_ixs * n_sites + det_site_ixs) * n_days + det_day_ixs, minlength=len(cube_specs) * n_sites * n_days)
+    counts = counts.reshape((len(cube_specs), n_sites, n_days))
+
+    # select_dets keeps store order, so the first row of each species x site key is its first detection
+    spec_site_keys, first_det_ixs = np.unique(det_cube_spec_ixs * n_sites + det_site_ixs, return_index=True)
+    spec_site_lats = np.full(len(cube_specs) * n_sites, np.nan)
+    spec_site_lats[spec_site_keys] = window_dets['file_lats'][window_dets['det_file_ixs'][first_det_ixs]]
+
+    return {'counts': counts.astype(get_min_uint_dtype(np.max(counts, initial=0))), 'spec_names': det_store['spec_names'][cube_specs],
+            'site_names': cube_sites, 'spec_site_lats': spec_site_lats.reshape((len(cube_specs), n_sites)), 
+            'first_day_num': int(first_day_num), 'n_days': n_days}
+
+
+def get_cube_days(cube):
+    return [EPOCH_DT + timedelta(days=cube['first_day_num'] + day_ix) for day_ix in range(cube['n_days'])]
+
+
+AGG_CUBE_AXES = ('spec', 'site', 'day', 'hour')
+AGG_CELL_KEYS = ['spec_ixs', 'site_ixs', 'day_nums', 'hours']
 
-            if d['confidence'] >= min_det_conf:
 
-                d['site'] = f_dets['site']
-                d['file_dt'] = f_dets['dt']
-                d['det_dt'] = f_dets['dt'] + timedelta(seconds=d['start_time'])
-                if 'lat' in f_dets.keys(): 
-                    d['lat'] = f_dets['lat']
-                    d['long'] = f_dets['long']
+def sum_agg_cube_cells(cells, n_specs, n_sites):
+    # Merges repeated species x site x day number x hour cells, summing their counts (or counting each 
+    # once if cells has no counts). Cells come out in species, site, day, hour order
+    day_nums = cells['day_nums']
+    first_day_num = int(np.min(day_nums)) if len(day_nums) > 0 else 0
+    n_days = int(np.max(day_nums)) - first_day_num + 1 if len(day_nums) > 0 else 0
+    cube_shape = (n_specs, n_sites, n_days, 24)
 
-                all_valid_dets.append(d)
+    cell_keys = np.ravel_multi_index((cells['spec_ixs'].astype('int64'), cells['site_ixs'].astype('int64'), day_nums - first_day_num, 
+                                      cells['hours'].astype('int64')), cube_shape)
+    if 'counts' not in cells.keys():
+        unq_cell_keys, cell_counts = np.unique(cell_keys, return_counts=True)
+    else:
+        unq_cell_keys, cell_inv_ixs = np.unique(cell_keys, return_inverse=True)
+        cell_counts = np.rint(np.bincount(cell_inv_ixs, weights=cells['counts'], minlength=len(unq_cell_keys))).astype('int64')
 
-    return np.asarray(all_valid_dets)
+    cell_spec_ixs, cell_site_ixs, cell_day_ixs, cell_hours = np.unravel_index(unq_cell_keys, cube_shape)
+    return {'spec_ixs': cell_spec_ixs, 'site_ixs': cell_site_ixs, 'day_nums': cell_day_ixs + first_day_num, 'hours': cell_hours, 
+            'counts': cell_counts}
+
+
+def get_agg_cube_cells(det_store, bn_conf_thresh=0.8, strict=False, tz=None):
+    # Non-zero cells (and counts) of the detections in det_store, with days and hours local to tz
+    all_valid_dets = expand_to_valid_dets(det_store, bn_conf_thresh, strict)
+    local_epochs = get_local_epochs(all_valid_dets['det_epochs'], tz)
+
+    cells = sum_agg_cube_cells({'spec_ixs': all_valid_dets['det_spec_ixs'], 'site_ixs': all_valid_dets['det_site_ixs'], 
+                                'day_nums': local_epochs // 86400, 'hours': (local_epochs // 3600) % 24},
+                               len(det_store['spec_names']), len(det_store['site_names']))
+
+    # Kept compact, as they may be sent back from a worker process
+    return {'spec_ixs': cells['spec_ixs'].astype('int16'), 'site_ixs': cells['site_ixs'].astype('int32'), 
+            'day_nums': cells['day_nums'].astype('int32'), 'hours': cells['hours'].astype('uint8'), 'counts': cells['counts'].astype('int32')}
+
+
+@profiled(n_items=lambda cube: len(cube['counts']))
+def build_agg_cube(det_store, bn_conf_thresh=0.8, strict=False, tz=None, workers=1):
+    # Sparse (coordinate list) detection counts per species x site x day x hour, with days and hours local 
+    # to tz. Only the non-zero cells are kept, so a whole dataset comes down to a few MB. With workers > 1 
+    # partitions of the detections are counted in parallel and their cells merged
+    all_part_cells = map_det_partitions(det_store, get_agg_cube_cells, (bn_conf_thresh, strict, tz), workers)
+    cells = all_part_cells[0]
+    if len(all_part_cells) > 1:
+        cells = sum_agg_cube_cells({k: np.concatenate([c[k] for c in all_part_cells]) for k in AGG_CELL_KEYS + ['counts']},
+                                   len(det_store['spec_names']), len(det_store['site_names']))
+
+    first_day_num = int(np.min(cells['day_nums'])) if len(cells['day_nums']) > 0 else 0
+    n_days = int(np.max(cells['day_nums'])) - first_day_num + 1 if len(cells['day_nums']) > 0 else 0
+
+    return {'spec_ixs': cells['spec_ixs'].astype('int16'), 'site_ixs': cells['site_ixs'].astype('int32'), 
+            'day_ixs': (cells['day_nums'] - first_day_num).astype('int32'), 'hours': cells['hours'].astype('uint8'), 
+            'counts': cells['counts'].astype(get_min_uint_dtype(np.max(cells['counts'], initial=0))),
+            'spec_names': det_store['spec_names'], 'site_names': det_store['site_names'], 'first_day_num': first_day_num, 
+            'n_days': n_days, 'tz': tz}
+
+
+def rollup_agg_cube(cube, keep=('spec',), spec_names=None, start_day_num=None, end_day_num=None):
+    # Dense counts summed over every axis not in keep, with the remaining axes in the order given. spec_names 
+    # picks (and orders) the species rows, and days can be limited to start_day_num - end_day_num inclusive
+    if spec_names is None: spec_names = cube['spec_names']
+    if start_day_num is None: start_day_num = cube['first_day_num']
+    if end_day_num is None: end_day_num = cube['first_day_num'] + cube['n_days'] - 1
+
+    cell_coords = {'spec': get_spec_row_lookup(cube['spec_names'], spec_names)[cube['spec_ixs']], 'site': cube['site_ixs'],
+                   'day': cube['day_ixs'] + cube['first_day_num'] - start_day_num, 'hour': cube['hours']}
+    axis_lens = {'spec': len(spec_names), 'site': len(cube['site_names']), 'day': max(int(end_day_num - start_day_num + 1), 0), 'hour': 24}
+
+    keep_cell_ixs = np.where((cell_coords['spec'] >= 0) & (cell_coords['day'] >= 0) & (cell_coords['day'] < axis_lens['day']))[0]
+    out_shape = tuple([axis_lens[a] for a in keep])
+    out_ixs = np.ravel_multi_index(tuple([cell_coords[a][keep_cell_ixs].astype('int64') for a in keep]), out_shape)
+
+    counts = np.bincount(out_ixs, weights=cube['counts'][keep_cell_ixs], minlength=int(np.prod(out_shape)))
+    return np.round(counts).astype('int64').reshape(out_shape)
+
+
+def get_agg_cube_day_nums(cube, start_day_num=None, end_day_num=None):
+    if start_day_num is None: start_day_num = cube['first_day_num']
+    if end_day_num is None: end_day_num = cube['first_day_num'] + cube['n_days'] - 1
+    return np.arange(start_day_num, end_day_num + 1)
+
+
+def compute_agg_cubes(ds_short_name, tz=None, workers=1):
+    # Cubes at the 0.8 BirdNET floor and at each species' calibrated threshold (strict '>' as in the figures)
+    ds_short_name = use_dataset(ds_short_name)
+    spec_opt_threshs, _, _, _ = get_opt_spec_bn_threshs(ds_short_name)
+
+    det_store = get_dataset(ds_short_name)
+    return {'floor': build_agg_cube(det_store, DET_FLOOR_THRESH, tz=tz, workers=workers), 
+            'calibrated': build_agg_cube(det_store, spec_opt_threshs, strict=True, tz=tz, workers=workers)}
+
+
+def load_agg_cubes(ds_short_name, tz=None, force_compute=False, workers=1):
+    ds_short_name = use_dataset(ds_short_name)
+    return cached_compute('agg_{}'.format(ds_short_name), {'tz': tz}, get_ds_input_paths(ds_short_name), 
+                          lambda: compute_agg_cubes(ds_short_name, tz, workers), force_compute, cache_dir=AGG_CACHE_DIR)
 
 
 def convert_norway_site_to_lat_group(lat, site):
@@ -102,86 +1144,278 @@ def convert_norway_site_to_lat_group(lat, site):
         return 'North'
 
 
+def read_site_attr_table(csv_path, get_row_site_key, attr_names=None):
+    # Every column of a site info CSV as an array (numeric ones as floats, NaN where empty), along with each row's
+    # site key from get_row_site_key(row dict). attr_names renames chosen columns, a repeated column name keeps its first
+    with open(csv_path, newline='') as csvfile:
+        rdr = csv.reader(csvfile, delimiter=',')
+        header = next(rdr)
+        all_rows = [row for row in rdr if len(row) > 0]
+
+    col_ixs = {}
+    for col_ix, col in enumerate(header):
+        if col != '' and col not in col_ixs.keys(): col_ixs[col] = col_ix
+
+    site_keys = np.asarray([get_row_site_key({col: row[col_ix] for col, col_ix in col_ixs.items()}) for row in all_rows], dtype='str')
+
+    attrs = {}
+    for col, col_ix in col_ixs.items():
+        col_vals = [row[col_ix].strip() for row in all_rows]
+        try:
+            attrs[(attr_names or {}).get(col, col)] = np.asarray([float(v) if v != '' else np.nan for v in col_vals], dtype='float64')
+        except ValueError:
+            attrs[(attr_names or {}).get(col, col)] = np.asarray(col_vals, dtype='str')
+
+    return {'site_keys': site_keys, 'attrs': attrs}
+
+
+def join_site_attrs(site_names, site_attr_table, get_site_name_key):
+    # Row of the site attribute table for each site code, matched on site keys through a dict (-1 for sites 
+    # without a row). As when the site info was first matched up, a row goes to the first site by name with its
+    # key only, and the last row of a repeated key wins
+    key_rows = {k: row_ix for row_ix, k in enumerate(site_attr_table['site_keys'])}
+
+    site_rows = np.full(len(site_names), -1, dtype='int64')
+    matched_keys = set()
+    for site_ix in np.argsort(np.asarray(site_names, dtype='str'), kind='stable'):
+        site_key = get_site_name_key(site_names[site_ix])
+        if site_key in key_rows.keys() and site_key not in matched_keys:
+            site_rows[site_ix] = key_rows[site_key]
+            matched_keys.add(site_key)
+
+    return site_rows
+
+
+def get_site_attrs(site_names, site_attr_table, get_site_name_key):
+    # Every attribute per site code (NaN or '' for sites without a row) and each site's table row in site_rows. 
+    # Attributes of files or detections are then a single gather, see get_det_site_attr
+    site_rows = join_site_attrs(site_names, site_attr_table, get_site_name_key)
+    has_row = site_rows >= 0
+
+    site_attrs = {'site_rows': site_rows}
+    for k, vals in site_attr_table['attrs'].items():
+        site_attrs[k] = np.full(len(site_names), np.nan if vals.dtype.kind == 'f' else '', dtype=vals.dtype)
+        site_attrs[k][has_row] = vals[site_rows[has_row]]
+
+    return site_attrs
+
+
+def get_det_site_attr(det_store, site_attr, det_ixs=None):
+    # Values of a per site attribute for every detection (or those in det_ixs) of a store or store-like table
+    if 'det_site_ixs' in det_store.keys():
+        return site_attr[det_store['det_site_ixs'] if det_ixs is None else det_store['det_site_ixs'][det_ixs]]
+
+    det_file_ixs = det_store['det_file_ixs'] if det_ixs is None else det_store['det_file_ixs'][det_ixs]
+    return site_attr[det_store['file_site_ixs'][det_file_ixs]]
+
+
+def get_costarica_info_site_key(row):
+    # Normalised location and site number of a site info CSV row, e.g. "Alto_Site_1" -> "alto1"
+    loc_and_site = row['Site'].strip().lower().replace(' ', '').replace('-', '')
+    loc = loc_and_site.split('_')[0]
+    return '{}{}'.format(COSTA_RICA_LOC_ALIASES.get(loc, loc), loc_and_site.split('_')[-1])
+
+
+def get_costarica_site_name_key(site_name):
+    # Normalised location and site number of a recording site name, e.g. "Alto_Site-1" -> "alto1"
+    return '{}{}'.format(''.join(site_name.split('_')[:-1]).replace('-', '').lower(), site_name.split('-')[-1].lower())
+
+
+def get_costarica_site_attrs(site_names, site_info_path=COSTA_RICA_SITE_INFO_PATH):
+    # Attributes from the Costa Rica site info CSV (lat, long, habitat, elevation and the landscape columns) per site code
+    site_attr_table = read_site_attr_table(site_info_path, get_costarica_info_site_key, COSTA_RICA_SITE_ATTR_NAMES)
+    site_attrs = get_site_attrs(site_names, site_attr_table, get_costarica_site_name_key)
+    print('Total sites {}, {} with habitat data'.format(len(site_names), np.sum(site_attrs['site_rows'] >= 0)))
+
+    return site_attrs
+
+
 def get_costarica_site_info(all_f_dets):
-    all_fd_site_names = np.asarray([fd['site'] for fd in all_f_dets])
+    # all_f_dets can be the per-file dicts or a detection store
+    if isinstance(all_f_dets, dict): all_fd_site_names = np.asarray(all_f_dets['site_names'])
+    else: all_fd_site_names = np.asarray([fd['site'] for fd in all_f_dets])
     unq_site_names = np.unique(all_fd_site_names)
 
-    unq_sites = []
-    for s in unq_site_names:
-        _loc = ''.join(s.split('_')[:-1]).replace('-','').lower()
-        _sn = s.split('-')[-1].lower()
-        unq_sites.append({'name': s, 'loc_site_str': '{}{}'.format(_loc, _sn)})
-
-    all_site_loc_site_strs = np.asarray([s['loc_site_str'] for s in unq_sites])
+    site_attrs = get_costarica_site_attrs(unq_site_names)
+    w_habitat_sites = []
+    for site_ix in np.where((site_attrs['site_rows'] >= 0))[0]:
+        w_habitat_sites.append({'name': unq_site_names[site_ix], 'loc_site_str': get_costarica_site_name_key(unq_site_names[site_ix]),
+                                'lat': site_attrs['lat'][site_ix], 'long': site_attrs['long'][site_ix],
+                                'habitat': site_attrs['habitat'][site_ix], 'elevation': site_attrs['elevation'][site_ix]})
 
-    site_info_csv_path = os.path.join('auxiliary_data', 'costa_rica_site_info.csv')
-    with open(site_info_csv_path, newline='') as csvfile:
-        rdr = csv.reader(csvfile, delimiter=',')
-        for row_ix, row in enumerate(rdr):
-            if row_ix != 0:
-                _lat = row[8]
-                _long = row[9]
-                _habitat = row[2]
-                _loc_and_site = row[1].strip().lower().replace(' ','').replace('-','')
-
-                _loc = _loc_and_site.split('_')[0]
-                if _loc == 'sq260': _loc = 'sq2601'
-                if _loc == 'mangrove': _loc = 'mangroves'
-                if _loc == 'palma': _loc = 'lapalma'
-                if _loc == 'elsi': _loc = 'elsicroc'
-                if _loc == 'rancho': _loc = 'ranchobajo'
-                if _loc == 'miramar': _loc = 'mirenmar'
-                if _loc == 'nuevo': _loc = 'rionuevo'
-                if _loc == 'gamba': _loc = 'lagamba'
-                if _loc == 'tarde': _loc = 'latarde'
-                if _loc == 'lareserva': _loc = 'indigenousreserve'
-                if _loc == 'sendero': _loc = 'golfito'
-
-                _site_num = _loc_and_site.split('_')[-1]
-
-                match_site_ix = np.where((all_site_loc_site_strs == '{}{}'.format(_loc, _site_num)))[0]
-                if len(match_site_ix) > 0:
-                    unq_sites[match_site_ix[0]]['lat'] = _lat
-                    unq_sites[match_site_ix[0]]['long'] = _long
-                    unq_sites[match_site_ix[0]]['habitat'] = _habitat
-
-    w_habitat_sites = [s for s in unq_sites if 'habitat' in s.keys()]
-    print('Total sites {}, {} with habitat data'.format(len(unq_sites), len(w_habitat_sites)))
-    
     return w_habitat_sites
 
-def get_spec_precisions(annotated_xlsx_path, bn_thresh=0.8):
-    annotated_xlsx = os.path.join(annotated_xlsx_path)
-
-    df = pd.read_excel(annotated_xlsx, index_col=None)
+@profiled(n_items=lambda res: len(res[0]))
+def read_labelled_clips(annotated_xlsx_path):
+    # pandas is only needed for the spreadsheet, and is slow to import
+    import pandas as pd
+    df = pd.read_excel(annotated_xlsx_path, index_col=None)
     df = df.where(pd.notnull(df), '')
-    
-    bn_confs = np.asarray(df['Confidence'].to_list())
-    over_thresh_ixs = np.where((bn_confs >= bn_thresh))[0]
-    df = df.loc[over_thresh_ixs]
 
+    bn_confs = np.asarray(df['Confidence'].to_list(), dtype='float64')
     all_specs = np.asarray(df['Common name'].to_list())
-    all_decisions = np.asarray(df['BirdNET correct?'].to_list())
+    all_decisions = np.asarray([str(s).strip().lower() for s in df['BirdNET correct?'].to_list()])
+
+    return bn_confs, all_specs, all_decisions
+
+
+def get_bn_thresh_vals(bn_confs=None, thresh_step=None):
+    # thresh_step=None gives the 20 step grid used in the paper, 'exact' evaluates at every 
+    # distinct labelled clip confidence (where the precision curves actually change)
+    if thresh_step is None: return np.linspace(0.8, 0.99, 20)
+    if thresh_step == 'exact':
+        clip_confs = bn_confs[(bn_confs > 0.8) & (bn_confs <= 0.99)]
+        return np.concatenate([[0.8], np.unique(clip_confs)])
+    return np.round(np.arange(0.8, 0.99 + thresh_step/2, thresh_step), 6)
+
+
+def get_spec_precision_curves(bn_confs, all_specs, all_decisions, bn_thresh_vals):
+    # Proportions of yes/maybe/no decisions for each species over all clips at or above each threshold,
+    # from cumulative counts over the clips sorted by species then confidence. 
+    # Returns props (thresholds x species x [yes, maybe, no]), the number of clips behind each 
+    # proportion and the species. Proportions are nan where there are no clips over the threshold
+    unq_specs, spec_inv_ixs = np.unique(all_specs, return_inverse=True)
+    sort_ixs = np.lexsort((bn_confs, spec_inv_ixs))
+    sorted_confs = bn_confs[sort_ixs]
+    sorted_spec_ixs = spec_inv_ixs[sort_ixs]
+
+    dec_cats = np.stack([all_decisions[sort_ixs] == dec for dec in ['yes', 'maybe', 'no']], axis=1)
+    cum_dec_counts = np.zeros((len(sort_ixs)+1, 3), dtype='int64')
+    cum_dec_counts[1:] = np.cumsum(dec_cats, axis=0)
+
+    spec_starts = np.searchsorted(sorted_spec_ixs, np.arange(len(unq_specs)), side='left')
+    spec_ends = np.searchsorted(sorted_spec_ixs, np.arange(len(unq_specs)), side='right')
+
+    first_over_ixs = np.empty((len(bn_thresh_vals), len(unq_specs)), dtype='int64')
+    for spec_ix in range(len(unq_specs)):
+        spec_confs = sorted_confs[spec_starts[spec_ix]:spec_ends[spec_ix]]
+        first_over_ixs[:, spec_ix] = spec_starts[spec_ix] + np.searchsorted(spec_confs, bn_thresh_vals, side='left')
+
+    num_clips = spec_ends[np.newaxis, :] - first_over_ixs
+    dec_counts = cum_dec_counts[spec_ends][np.newaxis, :, :] - cum_dec_counts[first_over_ixs]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        props = dec_counts / num_clips[:, :, np.newaxis]
+
+    return props, num_clips, unq_specs
+
 
-    unq_specs = np.unique(all_specs)
+BOOT_SPEC_CHUNK = 32
+BOOT_BATCH = 500
+# Rough peak bytes per (replicate, species, threshold) cell while turning counts into precision quantiles
+BOOT_CELL_BYTES = 32
+BOOT_BLOCK_BYTES = 2 ** 28
 
-    labs = []
-    bars = []
-    for spec in unq_specs:
-        match_ixs = np.where((all_specs == spec))[0]
-        spec_decisions = all_decisions[match_ixs]
+def get_quantiles_ignoring_nan(vals, quantiles):
+    # Quantiles over the last axis (interpolated as np.quantile does) leaving out nans, without the slow
+    # per-slice path np.nanquantile takes
+    sorted_vals = np.sort(vals, axis=-1)
+    n_valid = vals.shape[-1] - np.sum(np.isnan(vals), axis=-1)
+    last_valid_ixs = np.maximum(n_valid - 1, 0)[..., np.newaxis]
 
-        spec_decisions = np.asarray([s.strip().lower() for s in spec_decisions])
-        tot_decs = len(spec_decisions)
+    all_q_vals = []
+    for q in quantiles:
+        q_pos = q * last_valid_ixs
+        lower_ixs = np.floor(q_pos).astype('int64')
+        lower_vals = np.take_along_axis(sorted_vals, lower_ixs, axis=-1)
+        upper_vals = np.take_along_axis(sorted_vals, np.minimum(lower_ixs + 1, last_valid_ixs), axis=-1)
+        q_vals = (lower_vals + (upper_vals - lower_vals) * (q_pos - lower_ixs))[..., 0]
+        all_q_vals.append(np.where((n_valid > 0), q_vals, np.nan))
 
-        s_prop_right = len(np.where((spec_decisions == 'yes'))[0])/tot_decs
-        s_prop_maybe = len(np.where((spec_decisions == 'maybe'))[0])/tot_decs  
-        s_prop_no = len(np.where((spec_decisions == 'no'))[0])/tot_decs 
+    return np.asarray(all_q_vals)
 
-        labs.append(spec)
-        bars.append([s_prop_right, s_prop_maybe, s_prop_no])
 
-    bars = np.asarray(bars)
-    labs = np.asarray(labs)
+def get_boot_prec_quantiles(clip_spec_ixs, clip_confs, clip_yes, n_specs, bn_thresh_vals, quantiles, n_boot, seed):
+    sort_ixs = np.argsort(clip_spec_ixs, kind='stable')
+    clip_spec_ixs = clip_spec_ixs[sort_ixs]
+    clip_thresh_ixs = np.searchsorted(bn_thresh_vals, clip_confs[sort_ixs], side='right')
+    clip_yes = clip_yes[sort_ixs]
+    spec_starts = np.searchsorted(clip_spec_ixs, np.arange(n_specs), side='left')
+    spec_ends = np.searchsorted(clip_spec_ixs, np.arange(n_specs), side='right')
+
+    # Counts for every replicate, species and threshold don't fit in memory for fine grids, so thresholds
+    # go in blocks sized to BOOT_BLOCK_BYTES, redrawing the same replicates (same seed) for each block
+    block_len = max(1, BOOT_BLOCK_BYTES // (BOOT_CELL_BYTES * n_boot * max(n_specs, 1)))
+    block_quantiles = []
+    for first_thresh_ix in range(0, len(bn_thresh_vals), block_len):
+        n_block = min(block_len, len(bn_thresh_vals) - first_thresh_ix)
+        # Clips below the block's first threshold pass none of it and those above its last pass all of it
+        n_cats = (n_block + 1) * 2
+        clip_cat_keys = clip_spec_ixs * n_cats + np.clip(clip_thresh_ixs - first_thresh_ix, 0, n_block) * 2 + clip_yes
+
+        rng = np.random.default_rng(seed)
+        cat_counts = np.empty((n_boot, n_specs * n_cats), dtype='int32')
+        for first_boot_ix in range(0, n_boot, BOOT_BATCH):
+            n_batch = min(BOOT_BATCH, n_boot - first_boot_ix)
+            draw_ixs = rng.integers(spec_starts[clip_spec_ixs], spec_ends[clip_spec_ixs], size=(n_batch, len(clip_spec_ixs)))
+            draw_keys = clip_cat_keys[draw_ixs] + np.arange(n_batch)[:, np.newaxis] * (n_specs * n_cats)
+            cat_counts[first_boot_ix:first_boot_ix+n_batch] = np.bincount(draw_keys.ravel(), minlength=n_batch * n_specs * n_cats).reshape((n_batch, -1))
+
+        cum_counts = np.cumsum(cat_counts.reshape((n_boot, n_specs, n_cats // 2, 2)), axis=2, dtype='int32')
+        del cat_counts
+        over_yes = cum_counts[:, :, -1:, 1] - cum_counts[:, :, :-1, 1]
+        over_all = (cum_counts[:, :, -1:, 0] + cum_counts[:, :, -1:, 1]) - (cum_counts[:, :, :-1, 0] + cum_counts[:, :, :-1, 1])
+        del cum_counts
+        with np.errstate(invalid='ignore', divide='ignore'):
+            boot_precs = np.divide(over_yes, over_all, dtype='float32')
+        del over_yes, over_all
+        block_quantiles.append(get_quantiles_ignoring_nan(np.transpose(boot_precs, (2, 1, 0)), quantiles))
+
+    if len(block_quantiles) == 0:
+        return np.empty((len(quantiles), 0, n_specs), dtype='float32')
+
+    return np.concatenate(block_quantiles, axis=1)
+
+
+def get_precision_cis(bn_confs, all_specs, all_decisions, bn_thresh_vals, ci_method='bootstrap', conf_level=0.95, n_boot=10000, workers=1, seed=0):
+    # Lower and upper bounds on the precision curves of get_spec_precision_curves (thresholds x species), nan where
+    # there are no clips. 'bootstrap' gives percentile intervals over n_boot replicates, spread over worker processes 
+    # in chunks of species (results don't depend on the number of workers), 'exact' gives Clopper-Pearson intervals
+    alpha = 1 - conf_level
+    props, num_clips, unq_specs = get_spec_precision_curves(bn_confs, all_specs, all_decisions, bn_thresh_vals)
+
+    if ci_method == 'exact':
+        from scipy.stats import beta
+        yes_counts = np.rint(np.nan_to_num(props[:, :, 0]) * num_clips)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            prec_lower = np.where((yes_counts > 0), beta.ppf(alpha/2, yes_counts, num_clips - yes_counts + 1), 0.0)
+            prec_upper = np.where((yes_counts < num_clips), beta.ppf(1 - alpha/2, yes_counts + 1, num_clips - yes_counts), 1.0)
+
+    elif ci_method == 'bootstrap':
+        spec_inv_ixs = np.unique(all_specs, return_inverse=True)[1]
+        clip_yes = (all_decisions == 'yes').astype('int64')
+
+        chunk_starts = list(range(0, len(unq_specs), BOOT_SPEC_CHUNK))
+        chunk_clip_ixs = [np.where((spec_inv_ixs >= c) & (spec_inv_ixs < c + BOOT_SPEC_CHUNK))[0] for c in chunk_starts]
+        chunk_seeds = np.random.SeedSequence(seed).spawn(len(chunk_starts))
+        chunk_args = [[spec_inv_ixs[ixs] - c for c, ixs in zip(chunk_starts, chunk_clip_ixs)], [bn_confs[ixs] for ixs in chunk_clip_ixs],
+                      [clip_yes[ixs] for ixs in chunk_clip_ixs], [min(BOOT_SPEC_CHUNK, len(unq_specs) - c) for c in chunk_starts],
+                      [bn_thresh_vals] * len(chunk_starts), [[alpha/2, 1 - alpha/2]] * len(chunk_starts), [n_boot] * len(chunk_starts), 
+                      chunk_seeds]
+
+        if workers > 1 and len(chunk_starts) > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(chunk_starts))) as executor:
+                chunk_quantiles = list(executor.map(get_boot_prec_quantiles, *chunk_args))
+        else:
+            chunk_quantiles = list(map(get_boot_prec_quantiles, *chunk_args))
+
+        prec_quantiles = np.concatenate(chunk_quantiles, axis=2) if len(chunk_quantiles) > 0 else np.empty((2,) + num_clips.shape)
+        prec_lower, prec_upper = prec_quantiles[0].astype('float64'), prec_quantiles[1].astype('float64')
+
+    else:
+        raise ValueError('ci_method should be bootstrap or exact, not {}'.format(ci_method))
+
+    prec_lower[num_clips == 0] = np.nan
+    prec_upper[num_clips == 0] = np.nan
+
+    return prec_lower, prec_upper, unq_specs
+
+
+def get_spec_precisions(annotated_xlsx_path, bn_thresh=0.8):
+    bn_confs, all_specs, all_decisions = read_labelled_clips(annotated_xlsx_path)
+    props, num_clips, unq_specs = get_spec_precision_curves(bn_confs, all_specs, all_decisions, [bn_thresh])
+
+    over_thresh_spec_ixs = np.where((num_clips[0] > 0))[0]
+    bars = props[0, over_thresh_spec_ixs, :]
+    labs = unq_specs[over_thresh_spec_ixs]
 
-    return bars, labs
\ No newline at end of file
+    return bars, labs